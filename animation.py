@@ -1,3 +1,5 @@
+import base64
+import hashlib
 import io
 from lxml import etree as ET
 import numpy as np
@@ -7,10 +9,10 @@ import matplotlib
 
 from matplotlib import pyplot as plt
 
-from matplotlib import _path
-from matplotlib.path import Path
 from matplotlib.transforms import Affine2D
 
+from traces import SIMPLIFY_TOLERANCE, simplify
+
 
 POINTS_PER_INCH = 72.0
 
@@ -97,12 +99,63 @@ ANIMATION_SCRIPT = '''
       }
     }
 
+    // An array of `type` from little-endian base64 data
+    function decode_base64(text, type) {
+      var bytes = atob(text);
+      var buffer = new Uint8Array(bytes.length);
+      for (let n = 0; n < bytes.length; n++) buffer[n] = bytes.charCodeAt(n);
+      return new type(buffer.buffer);
+    }
+
+    // Times shared by traces, decoded once from their deltas
+    var time_bases = {};
+
+    function time_base(id) {
+      if (!(id in time_bases)) {
+        var element = svg.getElementById(id);
+        var deltas = decode_base64(element.getAttribute("data-values"), Int16Array);
+        var start = Number(element.getAttribute("data-start"));
+        var scale = Number(element.getAttribute("data-scale"));
+        var times = new Float64Array(deltas.length);
+        var ticks = 0;
+        for (let n = 0; n < deltas.length; n++) {
+          ticks += deltas[n];
+          times[n] = start + ticks*scale;
+        }
+        time_bases[id] = times;
+      }
+      return time_bases[id];
+    }
+
+    // A trace's points, `[x0, y0, x1, y1, ...]`, from the element
+    // written by `animation.encode_trace()`
+    function trace_points(element) {
+      var encoding = element.getAttribute("data-encoding");
+      if (encoding === null || encoding === undefined) {
+        return new Float64Array(JSON.parse("[" + element.getAttribute("d").split(/M|L| /).filter(i => i != "").join(",") + "]"));
+      } else if (encoding == "float32") {
+        return Float64Array.from(decode_base64(element.getAttribute("data-points"), Float32Array));
+      } else if (encoding == "int16") {
+        var times = time_base(element.getAttribute("data-time"));
+        var values = decode_base64(element.getAttribute("data-values"), Int16Array);
+        var scale = Number(element.getAttribute("data-scale"));
+        var offset = Number(element.getAttribute("data-offset"));
+        var xy = new Float64Array(2*values.length);
+        for (let n = 0; n < values.length; n++) {
+          xy[2*n] = times[n];
+          xy[2*n+1] = values[n]*scale + offset;
+        }
+        return xy;
+      }
+      throw new Error("Unknown trace encoding: " + encoding);
+    }
+
     class Trace {
       constructor(id, time_transform=null, value_transform=null, visualiser=null) {
         var path_id = id + "_path";
         this.path = svg.getElementById(path_id);
         if (this.path)
-          this.points = new Float64Array(JSON.parse("[" + this.path.getAttribute("d").split(/M|L| /).filter(i => i != "").join(",") + "]"));
+          this.points = trace_points(this.path);
         var trace = svg.getElementById(id);
         this.line = trace ? trace.getElementsByTagName("path")[0] : null;
         if (this.line) {
@@ -119,64 +172,256 @@ ANIMATION_SCRIPT = '''
         this.visualiser = visualiser;
       }
 
-      paint(time_from, time_to) {
+      // Index in `xy` of the first point after `time`, or at or after it
+      // when `inclusive`, by bisection from index `lo`
+      static search(xy, time, lo, inclusive) {
+        var low = lo/2, high = xy.length/2;
+        while (low < high) {
+          var mid = (low + high) >>> 1;
+          if (xy[2*mid] < time || (!inclusive && xy[2*mid] == time)) low = mid + 1;
+          else high = mid;
+        }
+        return 2*low;
+      }
+
+      // Start the path at the first point just before `start`
+      begin(start) {
+        var xy = this.points;
+        var i = Trace.search(xy, start, 0, true);
+        this.start = start;
+        this.first = i;
+        if (i < xy.length) {
+          if (i > 0 && start < xy[i]) {
+            var dt = start - xy[i-2];
+            var dy = dt*(xy[i+1]-xy[i-1])/(xy[i]-xy[i-2]);
+            this.mx = start; this.my = xy[i-1] + dy;
+          } else {
+            this.mx = xy[i];
+            this.my = xy[i+1];
+          }
+        }
+        // The path up to the cursor, and its length before each point
+        this.head = this.line ? "M " + String(this.mx) + " " + String(this.my) : "";
+        this.lengths = [this.head.length];
+        this.cursor = i + 2;
+      }
+
+      // Markers and visualisers are only updated when `optional`
+      paint(time_from, time_to, optional=true) {
         var mx, my;
         var path = "";
         var xy = this.points;
         var start = this.time_transform.transform(time_from);
         var t = this.time_transform.transform(time_to);
 
-        // Find first point just before `time`
-        var i = 0;
-        while (i < xy.length && xy[i] < start) {
-          i += 2;
-        }
+        if (start !== this.start) this.begin(start);
 
         // Now have start <= xy[i]
+        var i = this.first;
+        if (i < xy.length) {
+          // Points from `base` up to `end` are drawn. During playback the
+          // cursor moves forward a few points each frame; after a seek back
+          // or loop-around we bisect for the new end.
+          var base = i + 2;
+          var end = this.cursor;
+          if (!(t > xy[i])) {
+            end = base;
+          } else if (end < xy.length && xy[end] <= t) {
+            if (this.line) {
+              while (end < xy.length && xy[end] <= t) {
+                if (end == 2) this.head += " L";
+                this.head += " " + String(xy[end]) + " " + String(xy[end+1]);
+                end += 2;
+                this.lengths.push(this.head.length);
+              }
+            } else {
+              end = Trace.search(xy, t, end, false);
+            }
+          } else if (end > base && xy[end-2] > t) {
+            end = Trace.search(xy, t, base, false);
+          }
+          if (end < this.cursor && this.line) {
+            this.head = this.head.substring(0, this.lengths[(end - base)/2]);
+            this.lengths.length = (end - base)/2 + 1;
+          }
+          this.cursor = end;
+
+          if (end > base) {
+            mx = xy[end-2]; my = xy[end-1];
+          } else {
+            mx = this.mx; my = this.my;
+          }
+          path = this.head;
+          if (t > xy[i] && end < xy.length) {  // xy[end-2] <= t < xy[end]
+            var dt = t - xy[end-2];
+            var dy = dt*(xy[end+1]-xy[end-1])/(xy[end]-xy[end-2]);
+            mx = t; my = xy[end-1] + dy;
+            if (this.line)
+              path += " l" + String(dt) + " " + String(dy);
+          }
+          if (this.visualiser && optional)
+            this.visualiser.paint(time_to, this.value_transform.inverse(my));
+        }
+        if (this.line) {
+          if (path == "") {
+            if (optional) this.marker.setAttribute("visibility", "hidden");
+          } else {
+            this.line.setAttribute("d", path);
+            if (optional) {
+              this.marker.setAttribute("cx", mx);
+              this.marker.setAttribute("cy", my);
+              this.marker.setAttribute("visibility", "visible");
+            }
+          }
+        }
+      }
+    };
+
+    // A trace whose path is drawn once in full and revealed up to the
+    // current time by its dash pattern, given the distance along the
+    // path to each point.
+    class RevealTrace extends Trace {
+      constructor(id, time_transform=null, value_transform=null, visualiser=null, distances=null) {
+        super(id, time_transform, value_transform, visualiser);
+        this.distances = distances;
+        this.total = distances[distances.length-1];
+        if (this.line && this.path && this.path.getAttribute("d"))
+          this.line.setAttribute("d", this.path.getAttribute("d"));
+      }
+
+      // Distance along the path at `x`, between points `i-2` and `i`
+      distance(i, x) {
+        var xy = this.points;
+        var d = this.distances;
+        if (i == 0 || i >= xy.length) return d[Math.min(i, xy.length-2)/2];
+        return d[i/2-1] + (x - xy[i-2])*(d[i/2] - d[i/2-1])/(xy[i] - xy[i-2]);
+      }
+
+      // Markers and visualisers are only updated when `optional`
+      paint(time_from, time_to, optional=true) {
+        var mx, my;
+        var xy = this.points;
+        var start = this.time_transform.transform(time_from);
+        var t = this.time_transform.transform(time_to);
+
+        if (start !== this.start) {
+          this.start = start;
+          this.first = Trace.search(xy, start, 0, true);
+          this.cursor = this.first;
+        }
+        var i = this.first;
+        var shown = 0;
         if (i < xy.length) {
+          var from = this.distance(i, start);
           if (i > 0 && start < xy[i]) {
             var dt = start - xy[i-2];
-            var dy = dt*(xy[i+1]-xy[i-1])/(xy[i]-xy[i-2]);
-            mx = start; my = xy[i-1] + dy;
+            mx = start; my = xy[i-1] + dt*(xy[i+1]-xy[i-1])/(xy[i]-xy[i-2]);
           } else {
             mx = xy[i];
             my = xy[i+1];
           }
-          if (this.line)
-            path = "M " + String(mx) + " " + String(my);
           if (t > xy[i]) {
-            i += 2;
-            while (i < xy.length && xy[i] <= t) {
-              mx = xy[i]; my = xy[i+1];
-              if (i == 2) path += " L";
-              if (this.line)
-                path += " " + String(mx) + " " + String(my);
-              i += 2;
+            // First point after `t`, stepping forward during playback
+            // and bisecting after a seek or loop-around
+            var end = this.cursor;
+            if (end > i + 2 && xy[end-2] > t) {
+              end = Trace.search(xy, t, i + 2, false);
+            } else {
+              var limit = end + 16;
+              while (end < xy.length && xy[end] <= t && end < limit) end += 2;
+              if (end == limit) end = Trace.search(xy, t, end, false);
             }
-            if (i < xy.length) {  // xy[i-2] <= t < xy[i]
-              var dt = t - xy[i-2];
-              var dy = dt*(xy[i+1]-xy[i-1])/(xy[i]-xy[i-2]);
-              mx = t; my = xy[i-1] + dy;
-              if (this.line)
-                path += " l" + String(dt) + " " + String(dy);
+            this.cursor = end;
+            if (end < xy.length) {  // xy[end-2] <= t < xy[end]
+              var dt = t - xy[end-2];
+              mx = t; my = xy[end-1] + dt*(xy[end+1]-xy[end-1])/(xy[end]-xy[end-2]);
+              shown = this.distance(end, t) - from;
+            } else {
+              mx = xy[end-2]; my = xy[end-1];
+              shown = this.total - from;
             }
           }
-          if (this.visualiser)
+          if (this.line) {
+            this.line.style.strokeDasharray = String(shown) + " " + String(this.total + 1);
+            this.line.style.strokeDashoffset = String(-from);
+          }
+          if (this.visualiser && optional)
             this.visualiser.paint(time_to, this.value_transform.inverse(my));
         }
         if (this.line) {
-          if (path == "") {
-            this.marker.setAttribute("visibility", "hidden");
+          if (i >= xy.length) {
+            if (optional) this.marker.setAttribute("visibility", "hidden");
           } else {
-            this.line.setAttribute("d", path);
-            this.marker.setAttribute("cx", mx);
-            this.marker.setAttribute("cy", my);
-            this.marker.setAttribute("visibility", "visible");
+            this.line.style.visibility = (shown > 0) ? "visible" : "hidden";
+            if (optional) {
+              this.marker.setAttribute("cx", mx);
+              this.marker.setAttribute("cy", my);
+              this.marker.setAttribute("visibility", "visible");
+            }
           }
         }
       }
     };
 
+    // Frame intervals and work times, over the last `size` frames
+    class FrameStats {
+      constructor(size=240) {
+        this.intervals = new Float64Array(size);
+        this.work = new Float64Array(size);
+        this.count = 0;
+        this.frames = 0;
+        this.dropped = 0;
+        this.skipped = 0;
+        this.refresh = Infinity;
+      }
+      record(interval, work, expected) {
+        var n = this.count % this.intervals.length;
+        this.intervals[n] = interval;
+        this.work[n] = work;
+        this.count += 1;
+        this.frames += 1;
+        // The display's refresh interval is the shortest seen between frames
+        this.refresh = Math.min(this.refresh, interval);
+        var frames = Math.round(interval/Math.max(expected, this.refresh));
+        if (frames > 1) this.dropped += frames - 1;
+      }
+      static percentile(samples, p) {
+        if (samples.length == 0) return 0;
+        var sorted = Float64Array.from(samples).sort();
+        return sorted[Math.min(sorted.length - 1, Math.floor(p*sorted.length))];
+      }
+      summary() {
+        var n = Math.min(this.count, this.intervals.length);
+        var intervals = this.intervals.subarray(0, n);
+        var work = this.work.subarray(0, n);
+        return {
+          frames: this.frames,
+          dropped: this.dropped,
+          skipped: this.skipped,
+          interval_ms: {p50: FrameStats.percentile(intervals, 0.5),
+                        p95: FrameStats.percentile(intervals, 0.95)},
+          work_ms: {p50: FrameStats.percentile(work, 0.5),
+                    p95: FrameStats.percentile(work, 0.95),
+                    max: n ? Math.max(...work) : 0}
+        };
+      }
+    };
+
+    // Longest step, in milliseconds, taken between frames. Browsers stop
+    // sending frames to hidden documents, so playback pauses rather than
+    // jumping ahead when a document is shown again.
+    const MAX_FRAME_STEP = 250;
+
+    // Milliseconds between updates of the document's `data-frame-stats`
+    const STATS_INTERVAL = 1000;
+
+    var request_frame = (typeof requestAnimationFrame !== "undefined")
+                      ? requestAnimationFrame
+                      : (callback => setTimeout(() => callback(performance.now()), 1000/60));
+    var cancel_frame = (typeof cancelAnimationFrame !== "undefined")
+                     ? cancelAnimationFrame
+                     : clearTimeout;
+
     class Animation {
       constructor(start, end) {
         this.start_time = start;
@@ -184,38 +429,155 @@ ANIMATION_SCRIPT = '''
         this.time = this.start_time;
         this.animation = null;
         this.traces = [];
-        this.millisecs = 0;
+        this.millisecs = null;
         this.speed = 1.0;
+        this.period = 0;
+        this.budget = 8;
+        this.first_trace = 0;
+        this.stats = new FrameStats();
+        this.stats_time = 0;
       }
       add_trace(trace) {
         this.traces.push(trace);
       }
-      paint_traces() {
-        for (let trace of this.traces)
-          trace.paint(this.start_time, this.time);
+      // Lines are always painted. Markers and visualisers are skipped once
+      // the frame's work has used up its budget, starting with a different
+      // trace each frame so that skipping is shared between them.
+      paint_traces(frame_start) {
+        var count = this.traces.length;
+        var skipped = false;
+        for (let n = 0; n < count; n++) {
+          var trace = this.traces[(this.first_trace + n) % count];
+          var optional = (performance.now() - frame_start) <= this.budget;
+          if (!optional) {
+            this.stats.skipped += 1;
+            skipped = true;
+          }
+          trace.paint(this.start_time, this.time, optional);
+        }
+        if (skipped) this.first_trace = (this.first_trace + 1) % count;
       }
-      animate() {
-        var dt = Date.now() - this.millisecs;
-        this.millisecs = Date.now();
-        this.paint_traces();
+      animate(now) {
+        this.animation = request_frame(this.animate.bind(this));
+        if (this.millisecs === null) this.millisecs = now;
+        var interval = now - this.millisecs;
+        if (interval < this.period - 1) return;
+        this.millisecs = now;
+        var dt = Math.min(interval, MAX_FRAME_STEP);
+        var frame_start = performance.now();
+        this.paint_traces(frame_start);
+        var work = performance.now() - frame_start;
+        if (interval > 0 && interval <= MAX_FRAME_STEP)
+          this.stats.record(interval, work, this.period);
+        if (now - this.stats_time >= STATS_INTERVAL) {
+          this.stats_time = now;
+          svg.setAttribute("data-frame-stats", JSON.stringify(this.stats.summary()));
+        }
         this.time += dt*this.speed/1000.0;
         if (this.time > this.end_time) this.time = this.start_time;
       }
-      start(speed, period) {
+      // `period` is the shortest time between frames and `budget` the work
+      // allowed each frame, both in milliseconds. Frames otherwise follow
+      // the display.
+      start(speed, period=0, budget=8) {
         this.speed = speed;
-        if (this.animation == null)
-          this.animation = setInterval(this.animate.bind(this), period);
-        this.millisecs = Date.now();
+        this.period = period;
+        this.budget = budget;
+        if (this.animation == null) {
+          this.millisecs = null;
+          this.animation = request_frame(this.animate.bind(this));
+        }
       }
       stop() {
         if (this.animation != null) {
-          clearInterval(this.animation);
+          cancel_frame(this.animation);
           this.animation = null;
         }
       }
+      frame_stats() {
+        return this.stats.summary();
+      }
     };
 '''
 
+# How trace data is embedded in SVG
+
+ENCODINGS = ['text', 'float32', 'int16']
+
+def path_points(d):
+    """
+    The points of an SVG path of `M` and `L` commands, as an (N, 2) array.
+    """
+    return np.array(d.replace('M', ' ').replace('L', ' ').split(), dtype=float).reshape(-1, 2)
+
+def path_distances(d):
+    """
+    The distance along an SVG path of `M` and `L` commands to each of its
+    points.
+    """
+    xy = path_points(d)
+    return np.concatenate(([0.0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))))
+
+def path_d(points, precision=6):
+    """
+    An SVG path of `M` and `L` commands through an (N, 2) array of points,
+    with coordinates rounded to `precision` decimal places.
+    """
+    xy = np.char.rstrip(np.char.rstrip(np.char.mod('%.{}f'.format(precision), points), '0'), '.')
+    return 'M ' + ' L '.join(np.char.add(np.char.add(xy[:, 0], ' '), xy[:, 1]))
+
+def _base64(values, dtype):
+    return base64.b64encode(np.ascontiguousarray(values, dtype=dtype).tobytes()).decode('ascii')
+
+def encode_trace(id, points, encoding='text', time_bases=None, d=None):
+    """
+    SVG definitions holding a trace's points, for `Trace` to read.
+
+    :param points: An (N, 2) array of times and values.
+    :param encoding: `text` writes the points as a path's `d` attribute;
+                     `float32` as base64 encoded Float32 pairs; and `int16`
+                     as base64 encoded Int16 values, with a scale and
+                     offset, and a reference to a separate time base.
+    :param time_bases: Time bases already written, keyed by a digest of
+                       their times. Traces with the same times share one,
+                       holding the differences between successive times as
+                       base64 encoded Int16 steps of a common scale.
+    :param d: The path to use for `text`, instead of one made from `points`.
+    :return: A list of `<defs>` elements.
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError('Unknown trace encoding')
+    if encoding == 'text':
+        if d is None:
+            d = path_d(points)
+        return [ET.XML('<defs><path id="{id}" d="{d}"/></defs>'.format(id=id, d=d))]
+    points = np.asarray(points, dtype=float)
+    if encoding == 'float32':
+        return [ET.XML('<defs><path id="{id}" data-encoding="float32" data-points="{points}"/></defs>'
+                       .format(id=id, points=_base64(points, '<f4')))]
+    xml = []
+    if time_bases is None: time_bases = {}
+    times = points[:, 0]
+    digest = hashlib.sha1(times.tobytes()).hexdigest()
+    if digest not in time_bases:
+        time_bases[digest] = 'time_base_{}'.format(len(time_bases))
+        # Steps can differ by one from the largest step after rounding
+        step = np.max(np.abs(np.diff(times)), initial=0.0)
+        scale = step/32766 if step > 0.0 else 1.0
+        ticks = np.rint((times - times[0])/scale).astype(np.int64)
+        deltas = np.diff(ticks, prepend=0)
+        xml.append(ET.XML('<defs><path id="{id}" data-encoding="delta" data-start="{start!r}" data-scale="{scale!r}" data-values="{values}"/></defs>'
+                          .format(id=time_bases[digest], start=float(times[0]), scale=float(scale),
+                                  values=_base64(deltas, '<i2'))))
+    values = points[:, 1]
+    lower, upper = np.min(values), np.max(values)
+    offset = (upper + lower)/2.0
+    scale = (upper - lower)/65534 if upper > lower else 1.0
+    xml.append(ET.XML('<defs><path id="{id}" data-encoding="int16" data-time="{time}" data-scale="{scale!r}" data-offset="{offset!r}" data-values="{values}"/></defs>'
+                      .format(id=id, time=time_bases[digest], scale=float(scale), offset=float(offset),
+                              values=_base64(np.rint((values - offset)/scale), '<i2'))))
+    return xml
+
 class Visualiser(object):
     def __init__(self, id, position, setup_js='', call_js=''):
         self._id = id
@@ -254,26 +616,25 @@ class CircleVisualiser(Visualiser):
                           dict(id=self._id, cx='%g' % pos[0], cy='%g' % pos[1], r='0', fill=self._fill))
 
 class ChannelVisualiser(Visualiser):
-    def __init__(self, id, position, direction, colour, t, y):
+    def __init__(self, id, position, direction, colour, t, y, encoding='text', time_bases=None,
+                 tolerance=None):
         super().__init__(id, position)
         self._direction = direction
         self._colour = colour
+        self._encoding = encoding
+        self._time_bases = time_bases
+
+        # Simplify the trace, to within `tolerance` of the original data values
+        t = np.asarray(t, dtype=float)
+        y = np.asarray(y, dtype=float)
+        keep = simplify(t, y, tolerance)
 
         # Scale y values so absolute maximum becomes 1
         maxabs = y[np.argmax(abs(y))]
-        if maxabs != 0.0: y /= maxabs
-
-        xy = np.empty((len(t), 2), dtype=np.float_)
-        xy[:, 0] = t
-        xy[:, 1] = y
-
-        # Create a simplified path, scaled to ensure it will have a resonable number of points
-        scale = 1000.0/abs(t[1] - t[0])
-        xfm = Affine2D().scale(scale, scale)
-        simplified = Path(xy).cleaned(transform=xfm, simplify=True)
+        self._points = np.column_stack((t[keep], y[keep]/maxabs if maxabs != 0.0 else y[keep]))
 
-        # Generate the SVG path, transforming back to the original data values
-        self._path = _path.convert_to_string(simplified.transformed(xfm.inverted()), None, None, False, None, 6, [b'M', b'L', b'Q', b'C', b'z'], False).decode('ascii')
+        # Generate the SVG path
+        self._path = path_d(self._points)
 
     def xml(self):
         transform = ["translate({xpos}, {ypos})".format(xpos=self._position[0], ypos=self._position[1])]
@@ -283,20 +644,21 @@ class ChannelVisualiser(Visualiser):
         return [ET.XML('''<g xmlns:xlink="http://www.w3.org/1999/xlink" transform="{transform}">
                             <use xlink:href="#IonChannel" fill="{colour}" x="0" id="{id}_channel"/>
                           </g>'''.format(transform=' '.join(transform), colour=self._colour, id=self._id)),
-                ET.XML('<defs><path id="{id}_data_path" d="{d}"/></defs>'.format(id=self._id, d=self._path))
-                ]
+                ] + encode_trace('{id}_data_path'.format(id=self._id), self._points,
+                                 self._encoding, self._time_bases, d=self._path)
 
     def script(self):
         return 'new Trace("{id}_data", null, null, new IonChannel("{id}_channel"))'.format(id=self._id)
 
 class Animation(object):
-    def __init__(self, id, trace, display, marker, visualiser):
+    def __init__(self, id, trace, display, marker, visualiser, tolerance=None):
         trace.set_gid(id)
         self.id = id
         self.trace = trace
         self.display = display
         self.marker = marker
         self.visualiser = visualiser
+        self.tolerance = tolerance
 
 class Diagram(object):
     def __init__(self, diagram_file, simulation, start_time, end_time, units='ms'):
@@ -313,8 +675,16 @@ class Diagram(object):
                             .format(start=start_time, end=end_time))
         self._xml = [ ]
         self._xml.append(ET.XML(DIAGRAM_ANIMATION_SVG))
-
-    def add_channel(self, variable_id, element_id, position, direction, colour):
+        self._time_bases = {}
+
+    def add_channel(self, variable_id, element_id, position, direction, colour, encoding='text',
+                    tolerance=None):
+        '''
+        :param encoding: How the channel's samples are embedded, one of
+                         `ENCODINGS` (see `encode_trace()`).
+        :param tolerance: Largest error allowed when simplifying the channel's
+                          samples, in the variable's units (see `simplify()`).
+        '''
         # Get the SVG element
         element = self._svg_tree.find('//*/svg:g[@id="{id}"]'.format(id=element_id),
                                       {'svg': 'http://www.w3.org/2000/svg'})
@@ -324,12 +694,14 @@ class Diagram(object):
         if element is not None and variable is not None:
             channel = ChannelVisualiser(element_id, position, direction, colour,
                                         self._times[self._start_index:self._end_index],
-                                        variable.values()[self._start_index:self._end_index])
+                                        variable.values()[self._start_index:self._end_index],
+                                        encoding, self._time_bases, tolerance)
             element.extend(channel.xml())
             self._script.append('animation.add_trace({trace});'.format(trace=channel.script()))
 
-    def generate_svg(self, speed, period):  #  `period` in milliseconds
-        self._script.append('animation.start({speed}, {period});'.format(speed=speed, period=period))
+    def generate_svg(self, speed, period=0, budget=8):  #  `period` and `budget` in milliseconds
+        self._script.append('animation.start({speed}, {period}, {budget});'
+                            .format(speed=speed, period=period, budget=budget))
         script_element = ET.Element('script', {'type': 'application/ecmascript'})
         script_element.text = '<![CDATA[{code}]]>'.format(code='\n'.join(self._script))
         self._xml.append(script_element)
@@ -347,18 +719,24 @@ class Figure(matplotlib.figure.Figure):
         self._next_id = 0
         self._script = []
         self._xml = []
+        self._time_bases = {}
 
     def close(self):
         plt.close(self)
 
-    def add_animation(self, trace, id=None, display='animate', marker=True, timing=None, visualiser=None):
+    def add_animation(self, trace, id=None, display='animate', marker=True, timing=None, visualiser=None,
+                      tolerance=None):
+        '''
+        :param tolerance: Largest error allowed when simplifying the trace,
+                          in the units of its values (see `simplify()`).
+        '''
 # Use trace to get range etc of visualiser...
         if display in [None, 'hidden', 'visible'] and not marker and visualiser is None:
             raise ValueError('Nothing to animate...')
         if id is None:
             id = 'trace_%s' % self._next_id
             self._next_id += 1
-        self._animations.append(Animation(id, trace, display, marker, visualiser))
+        self._animations.append(Animation(id, trace, display, marker, visualiser, tolerance))
         return id
 
     def add_script(self, script):
@@ -375,9 +753,20 @@ class Figure(matplotlib.figure.Figure):
                 .scale(1.0, -1.0)
                 .translate(0.0, POINTS_PER_INCH*self.get_figheight()))
 
-    def generate_svg(self, start, end, step, units='ms', speed=1.0, **kwds):  ## Period in ms
+    def generate_svg(self, start, end, step, units='ms', speed=1.0, reveal=False, budget=8,
+                     encoding='text', **kwds):
+        '''
+        :param reveal: Draw each trace's path once and reveal it as time
+                       passes, rather than rebuilding the path every frame.
+        :param budget: Milliseconds of work per frame before markers and
+                       visualisers are skipped.
+        :param encoding: How trace points are embedded, one of `ENCODINGS`
+                         (see `encode_trace()`).
+        '''
         if units not in ['ms', 's', 'm', 'h', 'd']:
             raise ValueError('Unknown timing units')
+        if encoding not in ENCODINGS:
+            raise ValueError('Unknown trace encoding')
 
         ## Allow for units and scale everything?? Adjust speed ???
 
@@ -388,8 +777,24 @@ class Figure(matplotlib.figure.Figure):
         # Save figure as SVG to an in-memory file and before using transforms
         # since backend can adjust them
 
+        # Animated traces are drawn simplified to within their tolerance,
+        # rather than by matplotlib's own simplification, which can flatten
+        # narrow spikes
+
+        original_data = []
+        for animation in self._animations:
+            (t, y) = animation.trace.get_data()
+            original_data.append((t, y))
+            keep = simplify(t, y, animation.tolerance)
+            animation.trace.set_data(np.asarray(t, dtype=float)[keep], np.asarray(y, dtype=float)[keep])
+
         svg = io.BytesIO()
-        super().savefig(svg, format='svg') #, bbox_inches='tight') #, pad_inches=0, **kwds)  ## dpi=1000,
+        try:
+            with matplotlib.rc_context({'path.simplify': False}):
+                super().savefig(svg, format='svg') #, bbox_inches='tight') #, pad_inches=0, **kwds)  ## dpi=1000,
+        finally:
+            for (animation, (t, y)) in zip(self._animations, original_data):
+                animation.trace.set_data(t, y)
 
         # Get the XML tree for the SVG
 
@@ -405,7 +810,10 @@ class Figure(matplotlib.figure.Figure):
                                  {'svg': 'http://www.w3.org/2000/svg'})
 
             d = path.get('d')
-            self.add_xml(ET.XML('<defs><path id="{id}_path" d="{d}"/></defs>'.format(id=animation.id, d=d)))
+            points = path_points(d) if encoding != 'text' else None
+            for xml in encode_trace('{id}_path'.format(id=animation.id), points,
+                                    encoding, self._time_bases, d=d):
+                self.add_xml(xml)
             '''
             p = path.find('../..')
             p.getparent().remove(p)
@@ -422,10 +830,16 @@ class Figure(matplotlib.figure.Figure):
             else:
                 invoke_visualiser = ''
 
-            self.add_script('animation.add_trace(new Trace("%s", new Transform1D(%f, %f), new Transform1D(%f, %f) %s));'
-                                                % (animation.id,    xfm[0, 0], xfm[0, 2],    xfm[1, 1], xfm[1, 2],
-                                                                                                        invoke_visualiser))
-        self.add_script('animation.start(%g);' % period)
+            if reveal:
+                distances = ','.join(np.char.mod('%.3f', path_distances(d)))
+                self.add_script('animation.add_trace(new RevealTrace("%s", new Transform1D(%f, %f), new Transform1D(%f, %f), %s, [%s]));'
+                                                    % (animation.id,    xfm[0, 0], xfm[0, 2],    xfm[1, 1], xfm[1, 2],
+                                                       invoke_visualiser[2:] if invoke_visualiser else 'null', distances))
+            else:
+                self.add_script('animation.add_trace(new Trace("%s", new Transform1D(%f, %f), new Transform1D(%f, %f) %s));'
+                                                    % (animation.id,    xfm[0, 0], xfm[0, 2],    xfm[1, 1], xfm[1, 2],
+                                                                                                            invoke_visualiser))
+        self.add_script('animation.start(%g, 0, %g);' % (speed, budget))
 
         script_element = ET.Element('script', {'type': 'application/ecmascript'})
         script_element.text = '<![CDATA[%s]]>' % '\n'.join(self._script)
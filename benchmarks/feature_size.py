@@ -0,0 +1,161 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+Compare the size and load time of a diagram's features as GeoJSON, with
+and without quantised coordinates, and as TopoJSON.
+"""
+
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shapely.geometry as geo
+
+import cell_diagram.mathjax as mathjax
+from cell_diagram.parser import Parser
+
+from synthetic import write_synthetic_celldl
+
+# -----------------------------------------------------------------------------
+
+def best_of(repeat, fn):
+    times = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return (min(times), result)
+
+# -----------------------------------------------------------------------------
+
+def decode_topology(topology):
+    """
+    Shapely geometries from a topology, to check it against GeoJSON output.
+    """
+    (sx, sy) = topology['transform']['scale']
+    (tx, ty) = topology['transform']['translate']
+    arcs = []
+    for arc in topology['arcs']:
+        (x, y) = (0, 0)
+        points = []
+        for (dx, dy) in arc:
+            (x, y) = (x + dx, y + dy)
+            points.append((x*sx + tx, y*sy + ty))
+        arcs.append(points)
+    def line(indices):
+        points = []
+        for i in indices:
+            arc = arcs[i] if i >= 0 else arcs[~i][::-1]
+            points.extend(arc if not points else arc[1:])
+        return points
+    def point(p):
+        return (p[0]*sx + tx, p[1]*sy + ty)
+    (objects,) = topology['objects'].values()
+    for obj in objects['geometries']:
+        kind = obj['type']
+        if kind == 'Point':
+            yield geo.Point(point(obj['coordinates']))
+        elif kind == 'LineString':
+            yield geo.LineString(line(obj['arcs']))
+        elif kind == 'MultiLineString':
+            yield geo.MultiLineString([line(a) for a in obj['arcs']])
+        elif kind == 'Polygon':
+            yield geo.Polygon(line(obj['arcs'][0]), [line(a) for a in obj['arcs'][1:]])
+        else:
+            yield None
+
+def max_difference(topology, collection):
+    difference = 0
+    for g, feature in zip(decode_topology(topology), collection['features']):
+        if g is not None:
+            difference = max(difference, g.hausdorff_distance(geo.shape(feature['geometry'])))
+    return difference
+
+# -----------------------------------------------------------------------------
+
+def main(path, step, repeat):
+    start = time.perf_counter()
+    with mathjax.deadline(0):
+        diagram = Parser().parse(path)
+    print('Parsed {} in {:.3f}s'.format(os.path.basename(path), time.perf_counter() - start))
+
+    def geojson(**kwds):
+        fp = io.StringIO()
+        diagram.write_geojson(fp, **kwds)
+        return fp.getvalue()
+    def topojson(**kwds):
+        fp = io.StringIO()
+        diagram.write_topojson(fp, **kwds)
+        return fp.getvalue()
+
+    outputs = [
+        ('GeoJSON', geojson()),
+        ('GeoJSON, quantised', geojson(step=step)),
+        ('GeoJSON, compact, quantised', geojson(compact=True, step=step)),
+        ('TopoJSON', topojson(step=step)),
+        ('TopoJSON, compact', topojson(compact=True, step=step)),
+    ]
+    (reference_size, reference_load) = (None, None)
+    print('{:28} {:>10} {:>10} {:>10} {:>8}'.format('Format', 'Bytes', 'Gzipped', 'Load (ms)', 'Ratio'))
+    for name, text in outputs:
+        (load, _) = best_of(repeat, lambda: json.loads(text))
+        size = len(text.encode('utf-8'))
+        if reference_size is None:
+            (reference_size, reference_load) = (size, load)
+        print('{:28} {:10d} {:10d} {:10.2f} {:7.1f}x'.format(name, size,
+              len(gzip.compress(text.encode('utf-8'))), 1000*load, reference_size/size))
+
+    difference = max_difference(json.loads(outputs[3][1]), json.loads(outputs[1][1]))
+    print('TopoJSON differs from quantised GeoJSON by at most {:g}'.format(difference))
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare GeoJSON and TopoJSON output.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='take the best of this many loads')
+    parser.add_argument('--step', type=float, default=1.0,
+                        help='quantisation grid step in map units')
+    parser.add_argument('--synthetic', metavar='COUNT', type=int,
+                        help='use a synthetic diagram with this many transporters')
+    parser.add_argument('celldl', nargs='?',
+                        default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                             'diagrams', 'saucerman.xml'),
+                        help='CellDL file to export (default `diagrams/saucerman.xml`)')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'synthetic.xml')
+            write_synthetic_celldl(path, args.synthetic)
+            main(path, args.step, args.repeat)
+    else:
+        main(args.celldl, args.step, args.repeat)
+
+# -----------------------------------------------------------------------------
@@ -0,0 +1,85 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+Time GeoJSON export of a large synthetic diagram, comparing per-feature
+coordinate transforms with a single vectorised transform.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shapely.affinity as affine
+
+import cell_diagram.geojson as GeoJSON
+from cell_diagram.parser import Parser
+
+from synthetic import write_synthetic_celldl
+
+# -----------------------------------------------------------------------------
+
+def best_of(repeat, fn):
+    times = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return (min(times), result)
+
+def main(count, repeat):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'synthetic.xml')
+        write_synthetic_celldl(path, count)
+        start = time.perf_counter()
+        diagram = Parser().parse(path)
+        print('Parsed {} transporters in {:.3f}s'.format(count, time.perf_counter() - start))
+
+    (t_generate, features) = best_of(repeat, lambda: diagram.geojson().features)
+    geometries = [feature._geometry for feature in features]
+    print('{} features, generated in {:.4f}s'.format(len(features), t_generate))
+
+    (t_each, _) = best_of(repeat, lambda: [affine.affine_transform(g, GeoJSON.DEFAULT_TRANSFORM)
+                                                for g in geometries])
+    (t_vectorised, _) = best_of(repeat, lambda: GeoJSON.transform_geometries(geometries))
+    print('Transform per feature: {:.4f}s'.format(t_each))
+    print('Transform vectorised:  {:.4f}s ({:.1f}x)'.format(t_vectorised, t_each/t_vectorised))
+
+    (t_export, text) = best_of(repeat, lambda: GeoJSON.dumps(diagram.geojson()))
+    print('Complete export: {:.4f}s, {} bytes'.format(t_export, len(text)))
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark GeoJSON export.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='take the best of this many runs')
+    parser.add_argument('count', type=int, nargs='?', default=1000,
+                        help='number of transporters in the synthetic diagram')
+    args = parser.parse_args()
+
+    main(args.count, args.repeat)
+
+# -----------------------------------------------------------------------------
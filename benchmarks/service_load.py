@@ -0,0 +1,129 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+Throughput and latency of the render service in `celldl_server.py` under
+concurrent load, using the bundled diagrams.
+
+Start the server first, e.g. `python celldl_server.py --workers 0`.
+"""
+
+import asyncio
+import collections
+import json
+import os
+import time
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPClientError
+
+# -----------------------------------------------------------------------------
+
+DIAGRAMS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'diagrams')
+
+# -----------------------------------------------------------------------------
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(p*len(ordered)))]
+
+def load_diagrams(paths):
+    diagrams = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            diagrams.append((os.path.basename(path), f.read()))
+    return diagrams
+
+async def run(url, diagrams, formats, requests, concurrency, unique):
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    latencies = collections.defaultdict(list)
+    statuses = collections.Counter()
+    counter = iter(range(requests))
+
+    async def worker():
+        for n in counter:
+            (name, celldl) = diagrams[n % len(diagrams)]
+            format = formats[(n // len(diagrams)) % len(formats)]
+            if unique:
+                # Defeat the server's caches so that every request is parsed
+                celldl += '<!-- {} -->'.format(n).encode('utf-8')
+            body = json.dumps(dict(celldl=celldl.decode('utf-8'), format=format))
+            start = time.perf_counter()
+            try:
+                response = await client.fetch(HTTPRequest(url, method='POST', body=body,
+                                                          headers={'Content-Type': 'application/json'},
+                                                          request_timeout=600))
+                status = response.code
+            except HTTPClientError as err:
+                status = err.code
+            statuses[status] += 1
+            if status == 200:
+                latencies[name].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for n in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    client.close()
+    return (elapsed, latencies, statuses)
+
+def main(url, paths, formats, requests, concurrency, unique):
+    diagrams = load_diagrams(paths)
+    (elapsed, latencies, statuses) = asyncio.run(run(url, diagrams, formats, requests,
+                                                     concurrency, unique))
+    print('{:24} {:>8} {:>10} {:>10}'.format('Diagram', 'Renders', 'p50 (ms)', 'p99 (ms)'))
+    everything = []
+    for name, times in sorted(latencies.items()):
+        times.sort()
+        everything.extend(times)
+        print('{:24} {:8d} {:10.1f} {:10.1f}'.format(name, len(times),
+              1000*percentile(times, 0.5), 1000*percentile(times, 0.99)))
+    everything.sort()
+    if everything:
+        print('{:24} {:8d} {:10.1f} {:10.1f}'.format('all', len(everything),
+              1000*percentile(everything, 0.5), 1000*percentile(everything, 0.99)))
+    print('{} requests in {:.2f}s, {:.1f} per second; responses {}'.format(
+          requests, elapsed, requests/elapsed,
+          ', '.join('{}: {}'.format(status, count) for status, count in sorted(statuses.items()))))
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Load test the CellDL render service.')
+    parser.add_argument('--url', default='http://127.0.0.1:8004/render',
+                        help='the render endpoint (default http://127.0.0.1:8004/render)')
+    parser.add_argument('--requests', metavar='N', type=int, default=200,
+                        help='total number of requests (default 200)')
+    parser.add_argument('--concurrency', metavar='N', type=int, default=16,
+                        help='requests in flight at once (default 16)')
+    parser.add_argument('--formats', default='svg,geojson',
+                        help='comma separated formats to request (default `svg,geojson`)')
+    parser.add_argument('--unique', action='store_true',
+                        help='make every request distinct so nothing is served from cache')
+    parser.add_argument('diagrams', metavar='CELLDL_FILE', nargs='*',
+                        default=[os.path.join(DIAGRAMS, name)
+                                    for name in ['saucerman.xml', 'noble_1962_celldl.xml',
+                                                 'simple_diagram.xml', 'workshop_diagram.xml']],
+                        help='diagrams to render (default the bundled diagrams that parse)')
+    args = parser.parse_args()
+
+    main(args.url, args.diagrams, args.formats.split(','), args.requests,
+         args.concurrency, args.unique)
+
+# -----------------------------------------------------------------------------
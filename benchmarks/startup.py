@@ -0,0 +1,119 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+Startup cost of `celldl2svg.py`, from `python -X importtime`, for a few
+typical invocations.
+
+With `--check` the exit status is non-zero if any invocation imports a
+heavy module that it shouldn't need, to catch an eager import creeping
+back in.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# -----------------------------------------------------------------------------
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['lxml', 'cssselect2', 'tinycss2', 'numpy', 'shapely', 'networkx', 'tornado']
+
+# Arguments to `celldl2svg.py`, with `{}` for the copied diagram, and the
+# heavy modules that each may import
+INVOCATIONS = [
+    ('help', ['--help'], []),
+    ('SVG, no labels', ['--celldl', '{simple_diagram}'], ['lxml', 'cssselect2', 'tinycss2']),
+    ('SVG', ['--celldl', '{saucerman}', '--typeset-deadline', '0'],
+                        ['lxml', 'cssselect2', 'tinycss2', 'numpy', 'shapely', 'tornado']),
+    ('GeoJSON', ['--celldl', '{saucerman}', '--geojson', '--typeset-deadline', '0'],
+                        ['lxml', 'cssselect2', 'tinycss2', 'numpy', 'shapely', 'tornado']),
+]
+
+# -----------------------------------------------------------------------------
+
+def import_times(stderr):
+    """
+    :return: A dictionary of top-level package names and the cumulative
+             microseconds spent importing each, and the total for all
+             imports.
+    """
+    packages = {}
+    total = 0
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        (_, self_us, cumulative_us, name) = [f.strip() for f in line.replace('import time:', '|').split('|')]
+        total += int(self_us)
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + int(self_us)
+    return (packages, total)
+
+def run(args, repeat):
+    best = None
+    for n in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(ROOT, 'celldl2svg.py')] + args,
+                                cwd=ROOT, capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, result.stderr)
+    return best
+
+def main(repeat, check):
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        files = {}
+        for name in ['simple_diagram', 'saucerman']:
+            files[name] = os.path.join(directory, name + '.xml')
+            shutil.copy(os.path.join(ROOT, 'diagrams', name + '.xml'), files[name])
+        print('{:16} {:>10} {:>12}  {}'.format('Invocation', 'Wall (ms)', 'Import (ms)', 'Heavy modules (ms)'))
+        for (name, args, allowed) in INVOCATIONS:
+            (elapsed, stderr) = run([arg.format(**files) for arg in args], repeat)
+            (packages, total) = import_times(stderr)
+            heavy = [(module, packages[module]) for module in HEAVY_MODULES if module in packages]
+            print('{:16} {:10.1f} {:12.1f}  {}'.format(name, 1000*elapsed, total/1000,
+                  ', '.join('{} {:.1f}'.format(module, us/1000) for module, us in heavy) or '-'))
+            unexpected = [module for module, _ in heavy if module not in allowed]
+            if unexpected:
+                print('    unexpectedly imported: {}'.format(', '.join(unexpected)))
+                failed = True
+    if check and failed:
+        sys.exit(1)
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Measure the startup cost of celldl2svg.py.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='take the fastest of this many runs')
+    parser.add_argument('--check', action='store_true',
+                        help='fail if an invocation imports a heavy module it does not need')
+    args = parser.parse_args()
+
+    main(args.repeat, args.check)
+
+# -----------------------------------------------------------------------------
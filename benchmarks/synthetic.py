@@ -0,0 +1,88 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+Generate large CellDL diagrams for benchmarking.
+"""
+
+# -----------------------------------------------------------------------------
+
+CLASSES = ['sodium', 'potassium', 'calcium', 'chloride']
+
+COLOURS = ['#FE44F9', '#2209E1', '#D93300', '#059996']
+
+def synthetic_celldl(count, latex=False):
+    """
+    A cell with `count` transporters along its top boundary, each with a
+    flow between a potential outside of the cell and one inside.
+
+    :param latex: Use MathJax labels for quantities.
+    """
+    quantities = []
+    transporters = []
+    bond_graph = []
+    styles = []
+    for n in range(count):
+        cls = CLASSES[n % len(CLASSES)]
+        label = ' label="$q_{{{}}}$"'.format(n) if latex else ''
+        quantities.append('<quantity id="qo{n}" class="{cls}"{label}/>'.format(n=n, cls=cls, label=label))
+        transporters.append('<transporter id="t{n}" class="{cls} channel"/>'.format(n=n, cls=cls))
+        transporters.append('<quantity id="qi{n}" class="{cls}"/>'.format(n=n, cls=cls))
+        bond_graph.append('<potential id="uo{n}" quantity="qo{n}"/>'.format(n=n))
+        bond_graph.append('<potential id="ui{n}" quantity="qi{n}"/>'.format(n=n))
+        bond_graph.append(('<flow id="v{n}" transporter="t{n}">'
+                           '<component from="uo{n}" to="ui{n}" class="{cls}"/></flow>')
+                          .format(n=n, cls=cls))
+        styles.append('#t{n} {{ position: top {p:.4f}%; }}'.format(n=n, p=100.0*(n + 0.5)/count))
+        styles.append('#uo{n} {{ position: 100 above #t{n}; }}'.format(n=n))
+        styles.append('#ui{n} {{ position: 100 below #t{n}; }}'.format(n=n))
+        styles.append('#qo{n} {{ position: above; }} #qi{n} {{ position: below; }}'.format(n=n))
+        styles.append('#v{n} {{ position: right; }}'.format(n=n))
+    for cls, colour in zip(CLASSES, COLOURS):
+        styles.append('.{cls} {{ colour: {colour}; stroke: {colour}; }}'.format(cls=cls, colour=colour))
+    return '''<?xml version="1.0" encoding="utf-8"?>
+<cell-diagram xmlns="http://www.cellml.org/celldl/1.0#">
+  <diagram>
+    {quantities}
+    <compartment id="cell" class="cell">
+      {transporters}
+    </compartment>
+  </diagram>
+  <bond-graph>
+    {bond_graph}
+  </bond-graph>
+  <style>
+    diagram {{ width: {width}; height: 1000; }}
+    #cell {{ size: (96%, 50%); position: (2%, 40%); svg-element: CellMembrane; }}
+    .channel {{ svg-element: PMRChannel; }}
+    {styles}
+  </style>
+</cell-diagram>
+'''.format(quantities='\n    '.join(quantities),
+           transporters='\n      '.join(transporters),
+           bond_graph='\n    '.join(bond_graph),
+           styles='\n    '.join(styles),
+           width=100*count)
+
+def write_synthetic_celldl(path, count, latex=False):
+    with open(path, 'w') as f:
+        f.write(synthetic_celldl(count, latex))
+
+# -----------------------------------------------------------------------------
@@ -0,0 +1,239 @@
+//======================================================================
+//
+//  Cell Diagramming Language
+//
+//  Copyright (c) 2018  David Brooks
+//
+//  Licensed under the Apache License, Version 2.0 (the "License");
+//  you may not use this file except in compliance with the License.
+//  You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+//  Unless required by applicable law or agreed to in writing, software
+//  distributed under the License is distributed on an "AS IS" BASIS,
+//  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+//  See the License for the specific language governing permissions and
+//  limitations under the License.
+//
+//======================================================================
+//
+//  Frame cost of `Trace.paint()` and `RevealTrace.paint()` from
+//  `animation.ANIMATION_SCRIPT`, compared with the original linear scan,
+//  run headless under node:
+//
+//      node benchmarks/trace_paint.js [POINTS ...]
+//
+//  The script is taken from `animation.py` and run against a minimal
+//  stand-in for the SVG DOM. Paths drawn by both versions are compared
+//  frame by frame, through playback, seeks and loop-around, as are the
+//  markers of revealed traces. The stand-in doesn't re-parse paths, so
+//  a browser's cost of setting `d` each frame isn't included.
+//
+//======================================================================
+
+const fs = require('fs');
+const path = require('path');
+const vm = require('vm');
+
+//======================================================================
+
+class Element {
+  constructor(attributes={}, children=[]) {
+    this.attributes = Object.assign({}, attributes);
+    this.children = children;
+    this.style = {stroke: '#000'};
+  }
+  getAttribute(name) {
+    return this.attributes[name];
+  }
+  setAttribute(name, value) {
+    this.attributes[name] = value;
+  }
+  getElementsByTagName(tag) {
+    return this.children;
+  }
+}
+
+class Document {
+  constructor() {
+    this.elements = {};
+    this.documentElement = {
+      namespaceURI: 'http://www.w3.org/2000/svg',
+      getElementById: id => this.elements[id] || null,
+      appendChild: element => element
+    };
+  }
+  createElementNS(namespace, tag) {
+    return new Element();
+  }
+}
+
+//======================================================================
+
+function animation_script() {
+  const source = fs.readFileSync(path.join(__dirname, '..', 'animation.py'), 'utf8');
+  const match = source.match(/^ANIMATION_SCRIPT = '''([\s\S]*?)'''/m);
+  if (match === null) throw new Error('No ANIMATION_SCRIPT in animation.py');
+  return match[1];
+}
+
+// `Trace.paint()` as it was, scanning from the first point every frame
+function linear_paint(time_from, time_to) {
+  var mx, my;
+  var path = "";
+  var xy = this.points;
+  var start = this.time_transform.transform(time_from);
+  var t = this.time_transform.transform(time_to);
+  var i = 0;
+  while (i < xy.length && xy[i] < start) {
+    i += 2;
+  }
+  if (i < xy.length) {
+    if (i > 0 && start < xy[i]) {
+      var dt = start - xy[i-2];
+      var dy = dt*(xy[i+1]-xy[i-1])/(xy[i]-xy[i-2]);
+      mx = start; my = xy[i-1] + dy;
+    } else {
+      mx = xy[i];
+      my = xy[i+1];
+    }
+    if (this.line)
+      path = "M " + String(mx) + " " + String(my);
+    if (t > xy[i]) {
+      i += 2;
+      while (i < xy.length && xy[i] <= t) {
+        mx = xy[i]; my = xy[i+1];
+        if (i == 2) path += " L";
+        if (this.line)
+          path += " " + String(mx) + " " + String(my);
+        i += 2;
+      }
+      if (i < xy.length) {
+        var dt = t - xy[i-2];
+        var dy = dt*(xy[i+1]-xy[i-1])/(xy[i]-xy[i-2]);
+        mx = t; my = xy[i-1] + dy;
+        if (this.line)
+          path += " l" + String(dt) + " " + String(dy);
+      }
+    }
+    if (this.visualiser)
+      this.visualiser.paint(time_to, this.value_transform.inverse(my));
+  }
+  if (this.line) {
+    if (path == "") {
+      this.marker.setAttribute("visibility", "hidden");
+    } else {
+      this.line.setAttribute("d", path);
+      this.marker.setAttribute("cx", mx);
+      this.marker.setAttribute("cy", my);
+      this.marker.setAttribute("visibility", "visible");
+    }
+  }
+}
+
+//======================================================================
+
+// Distance along the path to each point, as `animation.path_distances()`
+function path_distances(data) {
+  const xy = data.split(/M|L| /).filter(i => i != '').map(Number);
+  const distances = [0];
+  for (let i = 2; i < xy.length; i += 2)
+    distances.push(distances[distances.length-1] + Math.hypot(xy[i]-xy[i-2], xy[i+1]-xy[i-1]));
+  return distances;
+}
+
+// An action potential like trace, one point per millisecond
+function trace_data(points) {
+  const d = [];
+  for (let n = 0; n < points; n++) {
+    const t = n/1000;
+    d.push('L', t.toFixed(3), (Math.exp(-((t % 1.0)*8))*100 - 85).toFixed(3));
+  }
+  d[0] = 'M';
+  return d.join(' ');
+}
+
+function make_traces(points) {
+  const document = new Document();
+  const context = vm.createContext({document: document, performance: performance,
+                                    setTimeout: setTimeout, clearTimeout: clearTimeout});
+  const classes = vm.runInContext(animation_script()
+                                + '; ({Trace: Trace, RevealTrace: RevealTrace, Transform1D: Transform1D});',
+                                  context);
+  const data = trace_data(points);
+  const traces = [];
+  for (const name of ['cursor', 'linear']) {
+    document.elements[name + '_path'] = new Element({d: data});
+    document.elements[name] = new Element({}, [new Element()]);
+    traces.push(new classes.Trace(name));
+  }
+  traces[1].paint = linear_paint;
+  document.elements['reveal_path'] = new Element({d: data});
+  document.elements['reveal'] = new Element({}, [new Element()]);
+  traces.push(new classes.RevealTrace('reveal', null, null, null, path_distances(data)));
+  return traces;
+}
+
+//======================================================================
+
+function check(points) {
+  const [cursor, linear, reveal] = make_traces(points);
+  const duration = points/1000;
+  // Playback, a seek back, a seek forward, loop-around and a new start
+  const frames = [];
+  for (let t = 0; t <= duration + 0.05; t += 0.0173) frames.push([0, t]);
+  frames.push([0, duration/3], [0, duration/2], [0, 0.0005], [0, 0], [0, duration/4]);
+  for (let t = duration/4; t <= duration/2; t += 0.05) frames.push([0.2005, t]);
+  frames.push([0.2005, 0.1], [0, duration], [0, duration + 1]);
+  for (const [from, to] of frames) {
+    cursor.paint(from, to);
+    linear.paint(from, to);
+    reveal.paint(from, to);
+    if (cursor.line.getAttribute('d') !== linear.line.getAttribute('d'))
+      throw new Error('Paths differ at ' + from + ', ' + to);
+    for (const name of ['cx', 'cy', 'visibility']) {
+      if (cursor.marker.getAttribute(name) !== linear.marker.getAttribute(name))
+        throw new Error('Markers differ at ' + from + ', ' + to);
+      if (reveal.marker.getAttribute(name) !== linear.marker.getAttribute(name))
+        throw new Error('Revealed markers differ at ' + from + ', ' + to);
+    }
+  }
+  return frames.length;
+}
+
+// Milliseconds per frame painting `frames` frames of playback, spread
+// evenly over the trace
+function frame_cost(trace, points, frames) {
+  const duration = points/1000;
+  const step = duration/frames;
+  const start = process.hrtime.bigint();
+  for (let n = 0; n < frames; n++)
+    trace.paint(0, n*step);
+  return Number(process.hrtime.bigint() - start)/1e6/frames;
+}
+
+function main(sizes) {
+  // Each speedup is over the linear scan
+  console.log('Points     Frames  Linear (ms/frame)  Cursor (ms/frame)  Speedup  Reveal (ms/frame)  Speedup');
+  for (const points of sizes) {
+    const compared = check(Math.min(points, 20000));
+    const frames = 200;
+    const [cursor, linear, reveal] = make_traces(points);
+    const linear_ms = frame_cost(linear, points, frames);
+    const cursor_ms = frame_cost(cursor, points, frames);
+    const reveal_ms = frame_cost(reveal, points, frames);
+    console.log(String(points).padEnd(10), String(frames).padStart(6),
+                linear_ms.toFixed(4).padStart(18), cursor_ms.toFixed(4).padStart(18),
+                (linear_ms/cursor_ms).toFixed(1).padStart(7) + 'x',
+                reveal_ms.toFixed(4).padStart(17), (linear_ms/reveal_ms).toFixed(1).padStart(7) + 'x',
+                '  (' + compared + ' frames identical)');
+  }
+}
+
+//======================================================================
+
+const sizes = process.argv.slice(2).map(Number);
+main(sizes.length ? sizes : [1000, 10000, 100000, 600000]);
+
+//======================================================================
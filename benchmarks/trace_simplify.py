@@ -0,0 +1,106 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+Simplify an action potential like trace with `traces.simplify()`, and
+with matplotlib's path simplification as `ChannelVisualiser` used to, and
+compare the points kept, the largest error and whether each upstroke's
+peak survives. The matplotlib half is skipped if it isn't installed.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from matplotlib.path import Path
+    from matplotlib.transforms import Affine2D
+except ModuleNotFoundError:
+    Path = None
+
+from traces import simplify
+
+# -----------------------------------------------------------------------------
+
+def action_potentials(samples, beats):
+    """
+    A trace of `beats` action potentials, each with an upstroke only a few
+    samples wide, over unevenly spaced times.
+    """
+    t = np.cumsum(np.where(np.arange(samples) % 2, 0.7, 1.3))*1e-3
+    phase = (t*beats/t[-1]) % 1.0
+    upstroke = np.exp(-((phase - 0.1)/2e-5)**2)
+    y = -85.0 + 125.0*upstroke + 100.0*np.exp(-8.0*phase)*(phase > 0.1)
+    return (t, y)
+
+def matplotlib_simplify(t, y):
+    xy = np.column_stack((t, y))
+    scale = 1000.0/abs(t[1] - t[0])
+    xfm = Affine2D().scale(scale, scale)
+    simplified = Path(xy).cleaned(transform=xfm, simplify=True).transformed(xfm.inverted())
+    vertices = simplified.vertices
+    if simplified.codes is not None:
+        vertices = vertices[simplified.codes != Path.STOP]
+    return vertices
+
+def report(name, t, y, vertices, elapsed):
+    error = np.max(np.abs(np.interp(t, vertices[:, 0], vertices[:, 1]) - y))
+    peaks = np.flatnonzero(y > 30.0)
+    kept_peak = np.max(np.interp(t[peaks], vertices[:, 0], vertices[:, 1]))
+    print('{:12} {:10.1f} {:10d} {:12.4f} {:12.2f}'.format(name, 1000*elapsed, len(vertices),
+                                                          error, kept_peak))
+
+def main(samples, beats, tolerance):
+    (t, y) = action_potentials(samples, beats)
+    print('{} samples, {} beats, peak {:.2f}, tolerance {}'.format(samples, beats, np.max(y), tolerance))
+    print('{:12} {:>10} {:>10} {:>12} {:>12}'.format('Simplifier', 'Time (ms)', 'Points', 'Max error', 'Peak'))
+
+    start = time.perf_counter()
+    keep = simplify(t, y, tolerance)
+    report('simplify', t, y, np.column_stack((t[keep], y[keep])), time.perf_counter() - start)
+
+    if Path is None:
+        print('{:12} not installed'.format('matplotlib'))
+        return
+    start = time.perf_counter()
+    vertices = matplotlib_simplify(t, y)
+    report('matplotlib', t, y, vertices, time.perf_counter() - start)
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare trace simplifiers.')
+    parser.add_argument('--samples', type=int, default=1000000,
+                        help='number of samples in the trace')
+    parser.add_argument('--beats', type=int, default=20,
+                        help='number of action potentials in the trace')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='largest error allowed by simplify(), in mV')
+    args = parser.parse_args()
+
+    main(args.samples, args.beats, args.tolerance)
+
+# -----------------------------------------------------------------------------
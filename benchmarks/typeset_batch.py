@@ -0,0 +1,92 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+Latency of typesetting labels one request at a time compared with a single
+batch request. Needs a MathJax server, e.g. `node mj_server.js`, or use
+`--stub` to run against the stand-in server in `mj_stub_server.py`.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cell_diagram.mathjax as mathjax
+
+# -----------------------------------------------------------------------------
+
+def labels(count, run):
+    # Labels are unique across runs so that nothing is served from the cache
+    return ['$x_{{{}}}^{{{}}}$'.format(run, n) for n in range(count)]
+
+def time_single(latex_list):
+    mathjax.configure_cache()
+    start = time.perf_counter()
+    for n, latex in enumerate(latex_list):
+        mathjax.typeset(latex, 'ID_{}'.format(n))
+    return time.perf_counter() - start
+
+def time_batch(latex_list):
+    mathjax.configure_cache()
+    start = time.perf_counter()
+    mathjax.typeset_many(latex_list)
+    return time.perf_counter() - start
+
+def main(counts):
+    print('{:>6} {:>12} {:>12} {:>8}'.format('labels', 'single (s)', 'batch (s)', 'speedup'))
+    for run, count in enumerate(counts):
+        single = time_single(labels(count, 2*run))
+        batch = time_batch(labels(count, 2*run + 1))
+        print('{:6d} {:12.4f} {:12.4f} {:8.1f}'.format(count, single, batch, single/batch))
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark batch typesetting.')
+    parser.add_argument('--url', default=mathjax.MATHJAX_URL,
+                        help='the MathJax server (default {})'.format(mathjax.MATHJAX_URL))
+    parser.add_argument('--stub', action='store_true',
+                        help='use an in-process stand-in server')
+    parser.add_argument('--latency', type=float, default=0.001, metavar='SECONDS',
+                        help="the stand-in server's latency per formula")
+    parser.add_argument('counts', metavar='N', type=int, nargs='*', default=[1, 10, 100, 1000],
+                        help='numbers of labels to typeset')
+    args = parser.parse_args()
+
+    if args.stub:
+        from mj_stub_server import StubMathJaxServer
+        server = StubMathJaxServer(0, latency=args.latency).start()
+        mathjax.MATHJAX_URL = server.url
+    else:
+        server = None
+        mathjax.MATHJAX_URL = args.url
+    # Don't let the default deadline cut short large runs
+    mathjax.REQUEST_TIMEOUT = 600
+    try:
+        main(args.counts)
+    finally:
+        if server is not None:
+            server.stop()
+
+# -----------------------------------------------------------------------------
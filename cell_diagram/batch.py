@@ -0,0 +1,264 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+Convert many CellDL files on a pool of worker processes, skipping those
+whose inputs haven't changed since they were last converted.
+"""
+
+# -----------------------------------------------------------------------------
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+
+from lxml import etree
+
+# -----------------------------------------------------------------------------
+
+from . import mathjax
+from . import utils
+from .svg_elements import DefinesStore
+
+# -----------------------------------------------------------------------------
+
+MANIFEST_VERSION = 2
+
+# The command line converter, which sets options the package uses
+CONVERTER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'celldl2svg.py')
+
+# -----------------------------------------------------------------------------
+
+def find_inputs(paths, extension='.xml'):
+    """
+    CellDL files from a list of files, directories (searched recursively)
+    and glob patterns, in order and without duplicates.
+    """
+    files = []
+    seen = set()
+    for path in paths:
+        if os.path.isdir(path):
+            matches = sorted(glob.glob(os.path.join(path, '**', '*' + extension), recursive=True))
+        else:
+            matches = sorted(glob.glob(path, recursive=True)) or [path]
+        for match in matches:
+            match = os.path.normpath(match)
+            if match not in seen:
+                seen.add(match)
+                files.append(match)
+    return files
+
+# -----------------------------------------------------------------------------
+
+_library_fingerprint = None
+
+def library_fingerprint():
+    """
+    A hash of this package's source and of `celldl2svg.py`, so that
+    changes to the converter invalidate earlier results.
+    """
+    global _library_fingerprint
+    if _library_fingerprint is None:
+        digest = hashlib.sha256()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        sources = [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                                                     if name.endswith('.py')]
+        for source in sources + [CONVERTER_SCRIPT]:
+            if os.path.exists(source):
+                digest.update(os.path.basename(source).encode('utf-8'))
+                with open(source, 'rb') as f:
+                    digest.update(f.read())
+        _library_fingerprint = digest.hexdigest()
+    return _library_fingerprint
+
+def stylesheet_files(path):
+    # External stylesheets referenced by `<style href="...">`
+    try:
+        root = etree.parse(path).getroot()
+    except (OSError, etree.XMLSyntaxError):
+        return []
+    directory = os.path.dirname(path)
+    return [os.path.join(directory, e.get('href'))
+                for e in root.iter('{*}style') if e.get('href')]
+
+def input_hash(path, options):
+    """
+    A hash of everything that determines a file's output: its XML, the
+    stylesheets it references, the conversion options and the library.
+    """
+    digest = hashlib.sha256()
+    digest.update(library_fingerprint().encode('utf-8'))
+    digest.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+    for file in [path] + stylesheet_files(path):
+        digest.update(file.encode('utf-8'))
+        try:
+            with open(file, 'rb') as f:
+                digest.update(f.read())
+        except OSError:
+            digest.update(b'\0missing')
+    return digest.hexdigest()
+
+# -----------------------------------------------------------------------------
+
+class Manifest(object):
+    """
+    The input hashes and outputs of files as they were last converted, kept
+    in a JSON file.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._entries = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    manifest = json.load(f)
+                if manifest.get('version') == MANIFEST_VERSION:
+                    self._entries = manifest.get('files', {})
+            except (OSError, ValueError) as err:
+                logging.warning('Ignoring manifest %s: %s', path, err)
+
+    def unchanged(self, file, hash):
+        """
+        Whether a file's inputs are as they were when it was converted, and
+        all of its outputs are still there.
+        """
+        entry = self._entries.get(os.path.abspath(file))
+        return (entry is not None and entry['hash'] == hash
+            and all(os.path.exists(output) for output in entry['outputs']))
+
+    def update(self, file, hash, seconds, outputs):
+        self._entries[os.path.abspath(file)] = dict(hash=hash, seconds=round(seconds, 3),
+                                                    outputs=sorted(set(os.path.abspath(output)
+                                                                       for output in outputs)))
+
+    def save(self):
+        if self._path is None:
+            return
+        # Replace the manifest atomically so an interrupted run can't
+        # leave it truncated
+        temporary = '{}.{}.tmp'.format(self._path, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump(dict(version=MANIFEST_VERSION, files=self._entries), f, indent=1, sort_keys=True)
+        os.replace(temporary, self._path)
+
+# -----------------------------------------------------------------------------
+
+def _convert(convert, file, options):
+    # Each file starts with no SVG definitions from the previous one
+    DefinesStore.clear()
+    start = time.perf_counter()
+    # The conversion joins this deadline, so we can count the labels it
+    # couldn't typeset
+    with mathjax.deadline() as typesetting, utils.recording_outputs() as outputs:
+        try:
+            convert(file, **options)
+            error = None
+        except Exception as err:
+            logging.debug(traceback.format_exc())
+            error = '{}: {}'.format(type(err).__name__, err)
+    return (time.perf_counter() - start, error, typesetting.degraded, outputs)
+
+def convert_files(convert, files, options, manifest=None, jobs=None, force=False, settings=None):
+    """
+    Convert files on a pool of `jobs` processes.
+
+    :param convert: A module level function called as `convert(file, **options)`.
+    :param manifest: A `Manifest` of earlier conversions, used to skip
+                     unchanged files whose outputs are all still there,
+                     and updated as files are converted.
+    :param force: Convert all files, changed or not.
+    :param settings: Other settings that affect the output, such as module
+                     level options, to include in input hashes.
+    :return: A list of `(file, status, seconds, error)` tuples, where
+             status is `converted`, `skipped`, `degraded` or `failed`.
+             A file is `degraded` when some of its labels couldn't be
+             typeset in time and were rendered as plain text. Degraded
+             files aren't recorded in the manifest, so that they are
+             converted again by the next run.
+    """
+    results = {}
+    pending = []
+    if jobs != 1:
+        # Files are already converted in parallel
+        options = dict(options, jobs=1) if 'jobs' in options else options
+    hashed = dict(options, **(settings or {}))
+    hashed.pop('jobs', None)
+    for file in files:
+        hash = input_hash(file, hashed)
+        if not force and manifest is not None and manifest.unchanged(file, hash):
+            results[file] = (file, 'skipped', 0.0, None)
+        else:
+            pending.append((file, hash))
+
+    def finished(file, hash, seconds, error, degraded, outputs):
+        if error is None and degraded:
+            results[file] = (file, 'degraded', seconds,
+                             '{} labels as plain text'.format(degraded))
+            logging.warning('%s: %d labels rendered as plain text', file, degraded)
+        elif error is None:
+            results[file] = (file, 'converted', seconds, None)
+            if manifest is not None:
+                manifest.update(file, hash, seconds, outputs)
+        else:
+            results[file] = (file, 'failed', seconds, error)
+            logging.error('%s: %s', file, error)
+
+    if jobs == 1 or len(pending) <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        for (file, hash) in pending:
+            finished(file, hash, *_convert(convert, file, options))
+    else:
+        # Workers are forked after the heavy imports and are reused
+        # from file to file
+        with ProcessPoolExecutor(max_workers=jobs,
+                                 mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = {executor.submit(_convert, convert, file, options): (file, hash)
+                          for (file, hash) in pending}
+            for future in as_completed(futures):
+                finished(*futures[future], *future.result())
+    if manifest is not None:
+        manifest.save()
+    return [results[file] for file in files]
+
+# -----------------------------------------------------------------------------
+
+def summary(results):
+    """
+    A table of per-file timings, slowest first, and totals.
+    """
+    lines = ['{:>9}  {:10}  {}'.format('Seconds', 'Status', 'File')]
+    for (file, status, seconds, error) in sorted(results, key=lambda r: -r[2]):
+        lines.append('{:9.3f}  {:10}  {}{}'.format(seconds, status, file,
+                                                   '  ({})'.format(error) if error else ''))
+    counts = {}
+    for result in results:
+        counts[result[1]] = counts.get(result[1], 0) + 1
+    lines.append('{:9.3f}  total, {}'.format(sum(r[2] for r in results),
+                                            ', '.join('{} {}'.format(count, status)
+                                                for status, count in sorted(counts.items()))))
+    return '\n'.join(lines)
+
+# -----------------------------------------------------------------------------
@@ -18,15 +18,13 @@
 #
 #------------------------------------------------------------------------------
 
+import functools
 import operator
 from collections import OrderedDict
 
-import shapely.geometry as geo
-
 #------------------------------------------------------------------------------
 
 from . import diagram as dia
-from . import geojson as GeoJSON
 from . import layout
 from . import parser
 from . import svg_elements
@@ -34,6 +32,9 @@ from . import utils
 from .element import Element, PositionedElement
 from .svg_elements import svg_line
 
+geo = utils.LazyModule('shapely.geometry')
+GeoJSON = utils.LazyModule('cell_diagram.geojson')
+
 #------------------------------------------------------------------------------
 
 LINE_OFFSET = 3.5
@@ -64,59 +65,53 @@ class BondGraph(Element):
         for flow in self.flows:
             flow.set_transporter_offsets()
 
-    def svg(self, layer=None, excludes=None):
-        svg = [ ]
+    def _potential_line(self, p, q):
+        return FlowComponent.trimmed_path(geo.LineString([p.coords, q.coords]), p, q)
+
+    def _potential_line_svg(self, p, q):
+        return [svg_line(self._potential_line(p, q),
+                         q.stroke if q.stroke != 'none' else '#808080',
+                         display=self.display())]
+
+    def _potential_line_geojson(self, p, q, compact=False):
+        return GeoJSON.Feature(self._potential_line(p, q), id='{}-{}'.format(p.id, q.id[1:]))
+
+    def layer_items(self):
+        """
+        The parts of the bond graph in drawing order, each as a tuple of
+        its classes and functions that return its SVG and GeoJSON.
+        """
         # First draw all lines
         for p, q in self.potentials.items():
-            classes = p.classes.union(q.classes)
-            if utils.layer_matches(layer, classes, excludes):
-                svg.append(svg_line(FlowComponent.trimmed_path(
-                                        geo.LineString([p.coords, q.coords]), p, q),
-                                    q.stroke if q.stroke != 'none' else '#808080',
-                                    display=self.display()))
+            yield (p.classes.union(q.classes),
+                   functools.partial(self._potential_line_svg, p, q),
+                   functools.partial(self._potential_line_geojson, p, q))
         # Link potentials via flows and their components
         for flow in self.flows:
-            svg.extend(svg_elements.generate(flow.components, layer, excludes))
             ## All these components go through the flow's transporter
             ## so check from/to positions to offset line when it goes
             ## through the transporter and flow...
+            for component in flow.components:
+                yield (component.classes, component.svg, component.geojson)
         for p, q in self.potentials.items():
-            classes = p.classes.union(q.classes)
-            if utils.layer_matches(layer, classes, excludes):
-                svg.extend(p.svg())
+            yield (p.classes.union(q.classes), p.svg, p.geojson)
         for flow in self.flows:
             classes = frozenset(flow.classes)
             for component in flow.components:
                 classes = classes.union(component.classes)
+            yield (classes, flow.svg, flow.geojson)
+
+    def svg(self, layer=None, excludes=None):
+        svg = [ ]
+        for (classes, svg_fn, _) in self.layer_items():
             if utils.layer_matches(layer, classes, excludes):
-                svg.extend(flow.svg())
+                svg.extend(svg_fn())
         return svg
 
-    def geojson(self, layer, excludes):
-        features = [ ]
-        # First draw all lines
-        for p, q in self.potentials.items():
-            classes = p.classes.union(q.classes)
-            if utils.layer_matches(layer, classes, excludes):
-                features.append(
-                    GeoJSON.Feature(
-                        FlowComponent.trimmed_path(
-                            geo.LineString([p.coords, q.coords]), p, q),
-                        id='{}-{}'.format(p.id, q.id[1:])))
-        # Link potentials via flows and their components
-        for flow in self.flows:
-            features.extend(GeoJSON.generate(flow.components, layer, excludes))
-        for p, q in self.potentials.items():
-            classes = p.classes.union(q.classes)
-            if utils.layer_matches(layer, classes, excludes):
-                features.append(p.geojson())
-        for flow in self.flows:
-            classes = frozenset(flow.classes)
-            for component in flow.components:
-                classes = classes.union(component.classes)
+    def geojson(self, layer, excludes, compact=False):
+        for (classes, _, geojson_fn) in self.layer_items():
             if utils.layer_matches(layer, classes, excludes):
-                features.append(flow.geojson())
-        return features
+                yield geojson_fn(compact)
 
 #------------------------------------------------------------------------------
 
@@ -256,7 +251,7 @@ class FlowComponent(Element, PositionedElement):
                 svg.append(svg_line(line, self.colour, style=line_style))
         return svg
 
-    def geojson(self):
+    def geojson(self, compact=False):
         lines = []
         component_points = self._lines['start'].points(self.from_potential.coords, flow=self._flow)
         component_points.extend(self._flow.get_flow_line(self))
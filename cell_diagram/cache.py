@@ -0,0 +1,201 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+# -----------------------------------------------------------------------------
+
+class LRUCache(object):
+    """
+    A bounded, least-recently-used in-memory cache.
+    """
+    def __init__(self, max_entries=1000):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def items(self):
+        return list(self._entries.items())
+
+    def reserve(self, max_entries):
+        """
+        Grow the cache, if need be, to hold at least `max_entries` entries.
+        """
+        self._max_entries = max(self._max_entries, max_entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return dict(entries=len(self._entries), hits=self.hits, misses=self.misses)
+
+# -----------------------------------------------------------------------------
+
+class TypesetCache(object):
+    """
+    A content-addressed store of raw MathJax SVG.
+
+    Entries are keyed by a hash of the typesetting request, so the LaTeX
+    source and all MathJax options contribute to the key. Lookups go to an
+    in-memory LRU tier first and then, if a path is given, to an SQLite
+    database whose total size is bounded by evicting the least recently
+    used entries.
+
+    :param path: SQLite database file for the on-disk tier, or `None` for
+                 an in-memory only cache.
+    :param max_entries: Size of the in-memory tier.
+    :param max_bytes: Upper bound on the SVG bytes kept on disk.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS typeset (
+            key       TEXT PRIMARY KEY,
+            svg       BLOB NOT NULL,
+            size      INTEGER NOT NULL,
+            last_used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS typeset_last_used ON typeset(last_used);"""
+
+    def __init__(self, path=None, max_entries=1000, max_bytes=64*1024*1024):
+        self._memory = LRUCache(max_entries)
+        self._path = path
+        self._max_bytes = max_bytes
+        self._db = None
+        self._db_pid = None
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(params):
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @property
+    def path(self):
+        return self._path
+
+    def _database(self):
+        if self._path is None:
+            return None
+        # SQLite connections must not be shared with forked children
+        if self._db is None or self._db_pid != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self._path))
+            os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self._path, timeout=30)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(self.SCHEMA)
+            self._db_pid = os.getpid()
+        return self._db
+
+    def get(self, key):
+        svg = self._memory.get(key)
+        if svg is not None:
+            return svg
+        db = self._database()
+        if db is not None:
+            try:
+                row = db.execute('SELECT svg FROM typeset WHERE key=?', (key,)).fetchone()
+                if row is not None:
+                    with db:
+                        db.execute('UPDATE typeset SET last_used=? WHERE key=?', (time.time(), key))
+                    svg = bytes(row[0])
+                    self._memory.put(key, svg)
+                    self.disk_hits += 1
+                    return svg
+            except sqlite3.Error as err:
+                logging.warning('Typeset cache: %s', err)
+        self.misses += 1
+        return None
+
+    def put(self, key, svg):
+        self._memory.put(key, svg)
+        db = self._database()
+        if db is not None:
+            try:
+                with db:
+                    db.execute('INSERT OR REPLACE INTO typeset VALUES (?, ?, ?, ?)',
+                               (key, svg, len(svg), time.time()))
+                    self._evict(db)
+            except sqlite3.Error as err:
+                logging.warning('Typeset cache: %s', err)
+
+    def reserve(self, max_entries):
+        """
+        Hold at least `max_entries` entries in memory, so that labels
+        fetched ahead of their use aren't evicted before they are used.
+        """
+        self._memory.reserve(max_entries)
+
+    def _evict(self, db):
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM typeset').fetchone()[0]
+        if total <= self._max_bytes:
+            return
+        for key, size in db.execute('SELECT key, size FROM typeset ORDER BY last_used').fetchall():
+            db.execute('DELETE FROM typeset WHERE key=?', (key,))
+            total -= size
+            if total <= self._max_bytes:
+                break
+
+    def clear(self):
+        self._memory.clear()
+        db = self._database()
+        if db is not None:
+            with db:
+                db.execute('DELETE FROM typeset')
+
+    def stats(self):
+        stats = dict(memory_entries=len(self._memory),
+                     memory_hits=self._memory.hits,
+                     disk_hits=self.disk_hits,
+                     misses=self.misses)
+        db = self._database()
+        if db is not None:
+            (entries, size) = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM typeset').fetchone()
+            stats.update(disk_entries=entries, disk_bytes=size)
+        return stats
+
+# -----------------------------------------------------------------------------
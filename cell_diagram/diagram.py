@@ -19,18 +19,23 @@
 # -----------------------------------------------------------------------------
 
 from collections import OrderedDict
-
-import networkx as nx
-import shapely.affinity as affine
-import shapely.geometry as geo
+import graphlib
+import logging
 
 # -----------------------------------------------------------------------------
 
-from . import geojson as GeoJSON
 from . import layout
+from . import mathjax
 from . import parser
 from . import svg_elements
-from .element import Element, PositionedElement
+from . import utils
+from .element import Element, PositionedElement, LAYOUT_CIRCLE_RESOLUTION
+
+# Geometry and feature export are only loaded when used
+affine = utils.LazyModule('shapely.affinity')
+geo = utils.LazyModule('shapely.geometry')
+GeoJSON = utils.LazyModule('cell_diagram.geojson')
+TopoJSON = utils.LazyModule('cell_diagram.topojson')
 
 # -----------------------------------------------------------------------------
 
@@ -123,12 +128,23 @@ class Quantity(Element, PositionedElement):
     def set_potential(self, potential):
         self._potential = potential
 
-    def geometry(self):
-        if self._geometry is None and self.position.has_coords:
+    def outline(self, quad_segs=LAYOUT_CIRCLE_RESOLUTION):
+        (x, y) = self.coords
+        (w, h) = (layout.QUANTITY_WIDTH, layout.QUANTITY_HEIGHT)
+        return affine.scale(geo.box(x-0.125, y-0.125, x+0.125, y+0.125)
+                               .buffer(0.375, quad_segs=quad_segs), w, h)
+
+    def geojson(self, compact=False):
+        """
+        :param compact: Export the rounded box as a plain box with its
+                        corner radii as properties.
+        """
+        if compact:
             (x, y) = self.coords
             (w, h) = (layout.QUANTITY_WIDTH, layout.QUANTITY_HEIGHT)
-            self._geometry = affine.scale(geo.box(x-0.125, y-0.125, x+0.125, y+0.125).buffer(0.375), w, h)
-        return self._geometry
+            return GeoJSON.Feature(geo.box(x-w/2, y-h/2, x+w/2, y+h/2), id=self.id,
+                                   lengths=dict(rx=0.375*w, ry=0.375*h))
+        return super().geojson()
 
     def parse_geometry(self):
         PositionedElement.parse_geometry(self, default_offset=self.diagram.quantity_offset,
@@ -228,6 +244,7 @@ class Diagram(Container):
         self._flow_offset = self._length_from_style('flow-offset', layout.FLOW_OFFSET)
         self._quantity_offset = self._length_from_style('quantity-offset', layout.QUANTITY_OFFSET)
         self._bond_graph = None
+        self._degraded_labels = 0
 
     def _length_from_style(self, name, default):
         if self.style and name in self.style:
@@ -245,6 +262,14 @@ class Diagram(Container):
     def bond_graph(self):
         return self._bond_graph
 
+    @property
+    def degraded_labels(self):
+        """
+        The number of labels in the last generated SVG that were rendered
+        as plain text because they couldn't be typeset.
+        """
+        return self._degraded_labels
+
     @property
     def elements(self):
         return self._elements
@@ -296,6 +321,15 @@ class Diagram(Container):
             e = self._elements_by_name.get(id_or_name)
         return e if e is not None and isinstance(e, cls) else None
 
+    def latex_labels(self):
+        """
+        The labels that are typeset by MathJax when generating SVG.
+        """
+        return [e.label for e in self._elements
+                    if (isinstance(e, PositionedElement)
+                    and not isinstance(e, Container)
+                    and e.label.startswith('$'))]
+
     def layout(self):
         """
         Set positions (and sizes) of all components in the diagram.
@@ -306,25 +340,27 @@ class Diagram(Container):
         self.position.set_coords(layout.Point())
 
         # Build the dependency graph
-        g = nx.DiGraph()
+        g = graphlib.TopologicalSorter()
         # We want all elements that have a position; some may not have an id
+        positioned = []
         for e in self._elements:
             # We now have the diagram's structure so can parse positions
             e.parse_geometry()
             if e.position:
-                g.add_node(e)
+                positioned.append(e)
+                g.add(e)
         # Add edges
-        for e in list(g):
+        for e in positioned:
             for dependency in e.position.dependencies:
                 if isinstance(dependency, str):
                     id_or_name = dependency
                     dependency = self.find_element(id_or_name)
                     if dependency is None:
                         raise KeyError('Unknown element: {}'.format(id_or_name))
-                g.add_edge(dependency, e)
+                g.add(e, dependency)
         # Now resolve element positions in dependency order
         self.set_unit_converter(layout.UnitConverter(self.pixel_size, self.pixel_size))
-        for e in nx.topological_sort(g):
+        for e in g.static_order():
             if e != self and not e.position_resolved:
                 e.resolve_position()
                 if isinstance(e, Compartment):
@@ -336,34 +372,155 @@ class Diagram(Container):
         # of flow component lines passing through transporters
         self.bond_graph.set_offsets()
 
+    def _svg_header(self):
+        return ['<?xml version="1.0" encoding="UTF-8"?>',
+                ('<svg xmlns="http://www.w3.org/2000/svg"'
+                 ' xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1"'
+                 ' width="{width:g}" height="{height:g}"'
+                 ' viewBox="0 0 {width:g} {height:g}">')
+                .format(width=self._width, height=self._height)]
+
+    @staticmethod
+    def _svg_footer(defines):
+        return ['<defs>'] + list(defines) + ['</defs>', '</svg>']
+
+    def _check_degraded_labels(self, degraded):
+        self._degraded_labels = degraded
+        if self._degraded_labels:
+            logging.warning('%d labels rendered as plain text', self._degraded_labels)
+
     def svg(self, layer=None, excludes=None):
         if excludes is None:
             excludes = frozenset()
 
-        svg = ['<?xml version="1.0" encoding="UTF-8"?>']
-        svg.append(('<svg xmlns="http://www.w3.org/2000/svg"'
-                    ' xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1"'
-                    ' width="{width:g}" height="{height:g}"'
-                    ' viewBox="0 0 {width:g} {height:g}">')
-                   .format(width=self._width, height=self._height))
-        svg.extend(svg_elements.generate(self._compartments, layer, excludes))
-        svg.extend(self.bond_graph.svg(layer=layer, excludes=excludes))
-        svg.extend(svg_elements.generate(self._quantities, layer, excludes))
-        svg.extend(svg_elements.generate(self._transporters, layer, excludes))
-        svg.append('<defs>')
-        svg.extend(svg_elements.DefinesStore.defines())
-        svg.append('</defs>')
-        svg.append('</svg>')
+        svg = self._svg_header()
+        with mathjax.deadline() as typesetting:
+            degraded = typesetting.degraded
+            svg.extend(svg_elements.generate(self._compartments, layer, excludes))
+            svg.extend(self.bond_graph.svg(layer=layer, excludes=excludes))
+            svg.extend(svg_elements.generate(self._quantities, layer, excludes))
+            svg.extend(svg_elements.generate(self._transporters, layer, excludes))
+        self._check_degraded_labels(typesetting.degraded - degraded)
+        svg.extend(self._svg_footer(svg_elements.DefinesStore.defines()))
         return '\n'.join(svg)
 
-    def geojson(self, layer=None, excludes=None):
+    def layer_items(self):
+        """
+        The parts of the diagram in drawing order, each as a tuple of its
+        classes and functions that return its SVG and, except for
+        compartments, its GeoJSON.
+        """
+        for e in self._compartments:
+            yield (e.classes, e.svg, None)
+        yield from self.bond_graph.layer_items()
+        for e in self._quantities:
+            yield (e.classes, e.svg, e.geojson)
+        for e in self._transporters:
+            yield (e.classes, e.svg, e.geojson)
+
+    def render_layers(self, classes, background='background', geojson=False, compact=False):
+        """
+        Render a background layer, of the parts that have none of the
+        classes, and a layer for each class in a single traversal of the
+        diagram. Each part is rendered once and routed to all its layers.
+
+        :param geojson: Also generate each layer's GeoJSON features.
+        :param compact: Generate compact GeoJSON geometries.
+        :return: A dictionary of layer names to tuples of the layer's SVG
+                 and its list of features, or `None` without `geojson`.
+        """
+        router = utils.LayerRouter(classes, background)
+        svg = {layer: self._svg_header() for layer in router.layers}
+        features = {layer: [] for layer in router.layers}
+        # Definitions are tracked per layer
+        used = {layer: set() for layer in router.layers}
+        with mathjax.deadline() as typesetting:
+            degraded = typesetting.degraded
+            for (item_classes, svg_fn, geojson_fn) in self.layer_items():
+                layers = router.route(item_classes)
+                if not layers:
+                    continue
+                with svg_elements.DefinesStore.recording() as defines:
+                    fragment = svg_fn()
+                feature = geojson_fn(compact) if geojson and geojson_fn is not None else None
+                for layer in layers:
+                    svg[layer].extend(fragment)
+                    used[layer].update(defines)
+                    if feature is not None:
+                        features[layer].append(feature)
+        self._check_degraded_labels(typesetting.degraded - degraded)
+        return {layer: ('\n'.join(svg[layer]
+                                  + self._svg_footer(svg_elements.DefinesStore.defines(used[layer]))),
+                        features[layer] if geojson else None)
+                    for layer in router.layers}
+
+    def geojson_features(self, layer=None, excludes=None, compact=False):
+        """
+        Generate the diagram's features, in diagram coordinates.
+
+        :param compact: Export circles as points with a `radius` property
+                        and quantities as boxes with `rx` and `ry` corner
+                        radii, instead of as polygons.
+        """
         if excludes is None:
             excludes = frozenset()
-        features = []
-        #features.extend(GeoJSON.generate(self._compartments, layer, exclude))
-        features.extend(self.bond_graph.geojson(layer, excludes))
-        features.extend(GeoJSON.generate(self._quantities, layer, excludes))
-        features.extend(GeoJSON.generate(self._transporters, layer, excludes))
-        return GeoJSON.FeatureCollection(features)
+        #yield from GeoJSON.generate(self._compartments, layer, exclude)
+        yield from self.bond_graph.geojson(layer, excludes, compact)
+        yield from GeoJSON.generate(self._quantities, layer, excludes, compact)
+        yield from GeoJSON.generate(self._transporters, layer, excludes, compact)
+
+    def geojson(self, layer=None, excludes=None, transform=None, compact=False, step=None,
+                index=None):
+        """
+        :param transform: An affine transform from diagram to map coordinates,
+                          defaults to `geojson.DEFAULT_TRANSFORM`.
+        :param step: If given, quantise map coordinates to a grid of this size.
+        :param index: A `search.SearchIndex` to add the features to.
+        """
+        features = self.geojson_features(layer, excludes, compact)
+        if index is not None:
+            features = index.collect(features, layer)
+        return GeoJSON.FeatureCollection(list(features),
+                                         transform if transform is not None
+                                                   else GeoJSON.DEFAULT_TRANSFORM,
+                                         step)
+
+    def write_geojson(self, fp, layer=None, excludes=None, transform=None,
+                      sequence=False, indent=None, compact=False, step=None,
+                      index=None, index_layer=None, features=None):
+        """
+        Stream features to a file as they are generated, either as a
+        FeatureCollection or as a GeoJSON text sequence (RFC 8142).
+
+        :param index: A `search.SearchIndex` to add the features to.
+        :param index_layer: The name of the file in the index, defaults to
+                            the layer.
+        :param features: Features already generated for the layer, such as
+                         by `render_layers()`.
+        """
+        if features is None:
+            features = self.geojson_features(layer, excludes, compact)
+        if index is not None:
+            features = index.collect(features, index_layer if index_layer is not None else layer)
+        if transform is None:
+            transform = GeoJSON.DEFAULT_TRANSFORM
+        if sequence:
+            GeoJSON.write_sequence(features, fp, transform, indent, step)
+        else:
+            GeoJSON.write_collection(features, fp, transform, indent, step)
+
+    def write_topojson(self, fp, layer=None, excludes=None, transform=None,
+                       indent=None, compact=False, step=None, features=None):
+        """
+        Write features as TopoJSON, with shared arcs stored once.
+
+        :param step: The quantisation grid step, in map units.
+        :param features: Features already generated for the layer.
+        """
+        if features is None:
+            features = self.geojson_features(layer, excludes, compact)
+        TopoJSON.write(features, fp,
+                       transform if transform is not None else GeoJSON.DEFAULT_TRANSFORM,
+                       step, indent=indent)
 
 # -----------------------------------------------------------------------------
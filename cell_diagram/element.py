@@ -18,17 +18,20 @@
 #
 # -----------------------------------------------------------------------------
 
-import shapely.geometry as geo
-
-# -----------------------------------------------------------------------------
-
 from . import diagram
-from . import geojson as GeoJSON
 from . import layout
 from . import parser
 from . import svg_elements
+from . import utils
 from . import SyntaxError
 
+geo = utils.LazyModule('shapely.geometry')
+GeoJSON = utils.LazyModule('cell_diagram.geojson')
+
+# Segments per quarter circle in the geometry used for layout, which is
+# shapely's default
+LAYOUT_CIRCLE_RESOLUTION = 16
+
 # -----------------------------------------------------------------------------
 
 
@@ -169,11 +172,25 @@ class PositionedElement(object):
     def coords(self):
         return self._position.coords
 
+    def outline(self, quad_segs=LAYOUT_CIRCLE_RESOLUTION):
+        return geo.Point(self.coords).buffer(self.radius, quad_segs=quad_segs)
+
     def geometry(self):
+        # Layout, clipping and trimming flow lines all use this, so it
+        # doesn't depend on how features are exported
         if self._geometry is None and self.position.has_coords:
-            self._geometry = geo.Point(self.coords).buffer(self.radius)
+            self._geometry = self.outline()
         return self._geometry
 
+    def export_geometry(self):
+        """
+        The geometry exported as a feature, with `geojson.CIRCLE_RESOLUTION`
+        segments per quarter circle.
+        """
+        if GeoJSON.CIRCLE_RESOLUTION == LAYOUT_CIRCLE_RESOLUTION:
+            return self.geometry()
+        return self.outline(GeoJSON.CIRCLE_RESOLUTION)
+
     def resolve_position(self):
         self._position.resolve()
 
@@ -206,8 +223,15 @@ class PositionedElement(object):
         svg.append('</g>')
         return svg
 
-    def geojson(self):
-        return GeoJSON.Feature(self.geometry(), id=self.id)
+    def geojson(self, compact=False):
+        """
+        :param compact: Export a circle as its centre and radius instead of
+                        as a polygon.
+        """
+        if compact:
+            return GeoJSON.Feature(geo.Point(self.coords), id=self.id,
+                                   lengths=dict(radius=self.radius))
+        return GeoJSON.Feature(self.export_geometry(), id=self.id)
 
 
 
@@ -4,11 +4,15 @@
 
 # -----------------------------------------------------------------------------
 
+import decimal
+import itertools
 import json
+import math
 
 # -----------------------------------------------------------------------------
 
-import shapely.affinity as affine
+import numpy as np
+import shapely
 import shapely.geometry as geo
 
 # -----------------------------------------------------------------------------
@@ -17,34 +21,202 @@ from . import utils
 
 # -----------------------------------------------------------------------------
 
-def generate(elements, layer, excludes):
-    json = []
+# Affine transform from diagram pixels to map coordinates, as
+# `[a, b, d, e, xoff, yoff]` with `x' = a*x + b*y + xoff` and
+# `y' = d*x + e*y + yoff`. The default scales by 10 and flips y.
+DEFAULT_TRANSFORM = (10, 0, 0, -10, 0, 10000)
+
+# Segments per quarter circle when circles are exported as polygons
+CIRCLE_RESOLUTION = 16
+
+def extent_transform(width, height, bounds):
+    """
+    A transform that maps a diagram of the given size onto a map
+    extent, flipping y.
+
+    :param bounds: The map extent as `(min_x, min_y, max_x, max_y)`.
+    """
+    (min_x, min_y, max_x, max_y) = bounds
+    x_scale = (max_x - min_x)/width
+    y_scale = (max_y - min_y)/height
+    return (x_scale, 0, 0, -y_scale, min_x, max_y)
+
+def length_scales(transform):
+    """
+    How a transform scales lengths along x, along y, and on average.
+    """
+    (a, b, d, e, _, _) = transform
+    return (math.hypot(a, d), math.hypot(b, e), math.sqrt(abs(a*e - b*d)))
+
+def transform_coordinates(coords, transform=DEFAULT_TRANSFORM):
+    """
+    Apply an affine transform to an `(N, 2)` array of coordinates.
+    """
+    (a, b, d, e, xoff, yoff) = transform
+    matrix = np.array([[a, d], [b, e]], dtype=float)
+    offset = np.array([xoff, yoff], dtype=float)
+    return coords @ matrix + offset
+
+def transform_geometries(geometries, transform=DEFAULT_TRANSFORM, step=None):
+    """
+    Apply an affine transform to all the coordinates of all
+    geometries in a single vectorised operation.
+
+    :param step: If given, snap transformed coordinates to a grid of this
+                 size, in map units.
+    """
+    geometries = np.array(geometries, dtype=object)
+    if len(geometries) == 0:
+        return geometries
+    if step is None:
+        return shapely.transform(geometries, lambda coords: transform_coordinates(coords, transform))
+    # Round again to the step's decimal places so that values such as 0.3
+    # are written without floating point noise
+    places = max(0, -decimal.Decimal(str(step)).as_tuple().exponent)
+    return shapely.transform(geometries,
+                             lambda coords: np.round(np.round(transform_coordinates(coords, transform)/step)*step,
+                                                     places))
+
+# Geometries whose coordinates are converted in bulk by `geometry_mappings()`
+_POINT, _LINE_STRING, _LINEAR_RING, _POLYGON = range(4)
+_GEOMETRY_TYPES = ['Point', 'LineString', 'LinearRing', 'Polygon']
+
+def geometry_mappings(geometries):
+    """
+    Geometries as GeoJSON objects, as their `__geo_interface__`, but with
+    the coordinates of all points, lines and polygons converted from one
+    array to lists in one step, rather than point by point into nested
+    tuples.
+    """
+    geometries = np.array(geometries, dtype=object)
+    if len(geometries) == 0:
+        return []
+    types = shapely.get_type_id(geometries).tolist()
+    simple = geometries[shapely.get_type_id(geometries) <= _POLYGON]
+    coordinates = shapely.get_coordinates(simple).tolist()
+    sizes = shapely.get_num_coordinates(simple).tolist()
+    (rings, owners) = shapely.get_rings(simple, return_index=True)
+    ring_sizes = shapely.get_num_coordinates(rings).tolist()
+    ring_counts = np.bincount(owners, minlength=len(simple)).tolist()
+    mappings = []
+    (n, start, ring) = (0, 0, 0)
+    for (geometry, type_id) in zip(geometries, types):
+        if type_id > _POLYGON:
+            mappings.append(geometry.__geo_interface__)
+            continue
+        if type_id == _POLYGON:
+            points = []
+            for size in ring_sizes[ring:ring + ring_counts[n]]:
+                points.append(coordinates[start:start + size])
+                start += size
+            ring += ring_counts[n]
+        else:
+            points = coordinates[start:start + sizes[n]]
+            start += sizes[n]
+            if type_id == _POINT:
+                points = points[0] if points else []
+        mappings.append({'type': _GEOMETRY_TYPES[type_id], 'coordinates': points})
+        n += 1
+    return mappings
+
+# -----------------------------------------------------------------------------
+
+def generate(elements, layer, excludes, compact=False):
     for e in elements:
         if utils.layer_matches(layer, e.classes, excludes):
-            json.append(e.geojson())
-    return json
+            yield e.geojson(compact)
 
 # -----------------------------------------------------------------------------
 
 class Feature(object):
-    def __init__(self, geometry, **kwds):
-        self._geometry = affine.affine_transform(geometry, [10, 0, 0, -10, 0, 10000])
+    """
+    :param lengths: Properties that are lengths in diagram units and are
+                    scaled along with the geometry. `rx` is scaled as an x
+                    length, `ry` as a y length, and any others by the
+                    transform's average scale.
+    """
+    def __init__(self, geometry, lengths=None, **kwds):
+        # Geometry is in diagram coordinates until a FeatureCollection
+        # transforms it along with those of all its other features
+        self._geometry = geometry
+        self._transformed = None
+        self._lengths = lengths if lengths is not None else {}
+        self._scales = length_scales(DEFAULT_TRANSFORM)
         self._properties = kwds
 
     @property
-    def __geo_interface__(self):
+    def geometry(self):
+        if self._transformed is None:
+            self._transformed = transform_geometries([self._geometry])[0]
+        return self._transformed
+
+    @property
+    def diagram_geometry(self):
+        return self._geometry
+
+    @property
+    def properties(self):
+        if self._lengths:
+            return dict(self._properties, **self._lengths)
+        return self._properties
+
+    def set_transformed(self, geometry, scales=None):
+        self._transformed = geometry
+        if scales is not None:
+            self._scales = scales
+
+    @property
+    def map_properties(self):
+        """
+        Properties with lengths in map units.
+        """
+        if not self._lengths:
+            return self._properties
+        properties = dict(self._properties)
+        for name, length in self._lengths.items():
+            scale = self._scales[0 if name == 'rx' else 1 if name == 'ry' else 2]
+            properties[name] = length*scale
+        return properties
+
+    def mapping(self, geometry=None):
+        """
+        The feature as a GeoJSON object.
+
+        :param geometry: The GeoJSON object of the feature's geometry, when
+                         already made by `geometry_mappings()`.
+        """
         return {
             'type': 'Feature',
-            'geometry': self._geometry.__geo_interface__,
-            'properties': self._properties,
+            'geometry': geometry if geometry is not None else geometry_mappings([self.geometry])[0],
+            'properties': self.map_properties,
         }
 
+    @property
+    def __geo_interface__(self):
+        return self.mapping()
+
+def feature_mappings(features):
+    """
+    Features as GeoJSON objects, converting their geometries together.
+    """
+    return [feature.mapping(geometry)
+                for (feature, geometry) in zip(features, geometry_mappings([f.geometry for f in features]))]
+
+# -----------------------------------------------------------------------------
+
+def transform_features(features, transform=DEFAULT_TRANSFORM, step=None):
+    transformed = transform_geometries([feature._geometry for feature in features], transform, step)
+    scales = length_scales(transform)
+    for feature, geometry in zip(features, transformed):
+        feature.set_transformed(geometry, scales)
+
 # -----------------------------------------------------------------------------
 
 class FeatureCollection(object):
-    def __init__(self, features, **kwds):
+    def __init__(self, features, transform=DEFAULT_TRANSFORM, step=None, **kwds):
         self.features = features
         self._properties = kwds
+        transform_features(self._features, transform, step)
 
     @property
     def features(self):
@@ -79,15 +251,72 @@ class FeatureCollection(object):
     def __geo_interface__(self):
         return {
             'type': 'FeatureCollection',
-            'features': [
-                feature.__geo_interface__
-                for feature in self.features
-            ],
+            'features': feature_mappings(self.features),
             'properties': self._properties,
         }
 
 # -----------------------------------------------------------------------------
 
+# Precedes each text in a GeoJSON text sequence (RFC 8142)
+RECORD_SEPARATOR = '\x1e'
+
+# Features are transformed and written in chunks of this size
+CHUNK_SIZE = 256
+
+def _transformed_chunks(features, transform, step):
+    features = iter(features)
+    while True:
+        chunk = list(itertools.islice(features, CHUNK_SIZE))
+        if not chunk:
+            break
+        transform_features(chunk, transform, step)
+        yield chunk
+
+def write_sequence(features, fp, transform=DEFAULT_TRANSFORM, indent=None, step=None):
+    """
+    Write features as a GeoJSON text sequence (RFC 8142), one feature at a
+    time as they are generated.
+    """
+    for chunk in _transformed_chunks(features, transform, step):
+        for feature in feature_mappings(chunk):
+            fp.write(RECORD_SEPARATOR)
+            fp.write(json.dumps(feature, indent=indent))
+            fp.write('\n')
+        fp.flush()
+
+def write_collection(features, fp, transform=DEFAULT_TRANSFORM, indent=None, step=None,
+                     **properties):
+    """
+    Incrementally write features as a FeatureCollection. The output is the
+    same as that of `dumps(FeatureCollection(features), indent=indent)`.
+    """
+    if indent is None:
+        (newline, item_separator, inner) = ('', ', ', '')
+    else:
+        inner = '\n' + 2*indent*' '
+        (newline, item_separator) = ('\n' + indent*' ', ',')
+    fp.write('{{{}"type": "FeatureCollection",{}"features": ['
+             .format(newline, newline if indent is not None else ' '))
+    first = True
+    for chunk in _transformed_chunks(features, transform, step):
+        for feature in feature_mappings(chunk):
+            text = json.dumps(feature, indent=indent)
+            if indent is not None:
+                text = text.replace('\n', inner)
+            fp.write(('' if first else item_separator) + inner + text)
+            first = False
+        fp.flush()
+    properties = json.dumps(properties, indent=indent)
+    if indent is not None:
+        properties = properties.replace('\n', newline)
+    fp.write('{}],{}"properties": {}{}}}'.format('' if first else newline,
+                                                  newline if indent is not None else ' ',
+                                                  properties,
+                                                  '\n' if indent is not None else ''))
+    fp.flush()
+
+# -----------------------------------------------------------------------------
+
 def dump(obj, fp, *args, **kwargs):
     """Dump shapely geometry object :obj: to a file :fp:."""
     json.dump(geo.mapping(obj), fp, *args, **kwargs)
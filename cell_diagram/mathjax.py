@@ -1,9 +1,236 @@
-from lxml import etree
+"""
+Typeset LaTeX labels as SVG with MathJax, through `mj_server.js` or a pool
+of persistent worker processes.
+
+Typesetting a label can be tried from the command line, from the directory
+above the package, with::
+
+    python -m cell_diagram.mathjax
+
+as the module's relative imports mean it can't be run as a script.
+"""
+
+from collections import OrderedDict
+import contextlib
+import hashlib
 import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from xml.sax.saxutils import quoteattr
+
+from lxml import etree
+
+# -----------------------------------------------------------------------------
+
+from .cache import LRUCache, TypesetCache
+from .mathjax_pool import FormulaError, WorkerPool
+from .utils import LazyModule
+
+# Only imported when labels are typeset
+asyncio = LazyModule('asyncio')
+httpclient = LazyModule('tornado.httpclient')
+httplib = LazyModule('http.client')
+
+# -----------------------------------------------------------------------------
+
+MATHJAX_URL = 'http://localhost:8003/'
+
+MATHJAX_OPTIONS = {
+    'format': 'TeX',
+    'svg': True,
+##  'ex': 6,   ###  ?????
+    'width': 10000,
+    'linebreaks': False,
+}
+
+# Identifies the server side MathJax configuration in `mj_index.js`, which
+# also determines the SVG we get back. Change this whenever that changes.
+MATHJAX_CONFIG = 'mathjax-node-sre STIX-Web'
+
+# The maximum number of concurrent requests when prefetching; `mj_index.js`
+# forks a worker per CPU.
+TYPESET_CONCURRENCY = os.cpu_count() or 1
+
+# Timeouts, in seconds, for each request to MathJax
+CONNECT_TIMEOUT = 1
+REQUEST_TIMEOUT = 5
+
+# The total time, in seconds, allowed for typesetting when converting a diagram
+TYPESET_DEADLINE = 10
+
+# -----------------------------------------------------------------------------
+
+class TypesetError(IOError):
+    pass
+
+# -----------------------------------------------------------------------------
+
+class CircuitBreaker(object):
+    """
+    Stop calling MathJax after repeated failures.
+
+    Once open, the breaker lets a single trial request through every
+    `reset_timeout` seconds and closes again when one succeeds.
+    """
+    def __init__(self, failure_threshold=3, reset_timeout=30):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        if self._opened_at is None:
+            return True
+        elif time.monotonic() - self._opened_at >= self._reset_timeout:
+            self._opened_at = time.monotonic()   # Allow one trial request
+            return True
+        return False
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+
+    def record_failure(self):
+        self._failures += 1
+        if self._failures >= self._failure_threshold:
+            if self._opened_at is None:
+                logging.warning('MathJax is failing, using plain text labels')
+            self._opened_at = time.monotonic()
+
+breaker = CircuitBreaker()
+
+# -----------------------------------------------------------------------------
+
+class Deadline(object):
+    """
+    The time by which a conversion's labels must be typeset, and the number
+    of labels it rendered as plain text because they couldn't be.
+    """
+    def __init__(self, seconds=None, expires=None):
+        self.expires = time.monotonic() + (seconds if seconds is not None else TYPESET_DEADLINE)
+        if expires is not None:
+            self.expires = min(expires, self.expires)
+        self.degraded = 0
+
+# Each thread converts its own diagram
+_local = threading.local()
+
+@contextlib.contextmanager
+def deadline(seconds=None):
+    """
+    Limit the total time spent typesetting within the context, which is
+    usually a diagram's conversion, from parsing to its last output.
+
+    A context opened within another, without `seconds`, joins it, so that
+    parsing and rendering share one deadline.
+
+    :param seconds: Defaults to `TYPESET_DEADLINE`. An enclosing deadline
+                    that expires earlier takes precedence.
+    :return: The `Deadline`.
+    """
+    previous = getattr(_local, 'deadline', None)
+    if previous is not None and seconds is None:
+        yield previous
+        return
+    _local.deadline = Deadline(seconds, previous.expires if previous is not None else None)
+    try:
+        yield _local.deadline
+    finally:
+        _local.deadline = previous
+
+def record_degraded():
+    """
+    Count a label rendered as plain text against the current deadline.
+    """
+    current = getattr(_local, 'deadline', None)
+    if current is not None:
+        current.degraded += 1
+
+def request_timeout():
+    """
+    The timeout for the next request, taking account of any deadline.
+    """
+    current = getattr(_local, 'deadline', None)
+    if current is None:
+        return REQUEST_TIMEOUT
+    remaining = current.expires - time.monotonic()
+    if remaining <= 0:
+        raise TypesetError('Typesetting deadline has passed')
+    return min(REQUEST_TIMEOUT, remaining)
+
+def deadline_expires():
+    """
+    The `time.monotonic()` time at which the current deadline expires, or
+    `None` when there is no deadline.
+    """
+    current = getattr(_local, 'deadline', None)
+    return current.expires if current is not None else None
+
+def check_available():
+    timeout = request_timeout()
+    if not breaker.allow():
+        raise TypesetError('MathJax is unavailable')
+    return timeout
+
+# -----------------------------------------------------------------------------
+
+cache = TypesetCache(os.environ.get('CELLDL_TYPESET_CACHE'))
 
-from tornado.httpclient import HTTPRequest, HTTPClient, HTTPError
+# Cleaned labels, keyed by raw SVG cache key and id base, for when a
+# diagram is rebuilt in the same process
+_cleaned = LRUCache(4000)
 
-## TODO: Use AsyncHTTPClient
+def configure_cache(path=None, **kwds):
+    """
+    Replace the typeset cache, optionally with one backed by an SQLite
+    database at `path`.
+    """
+    global cache
+    cache = TypesetCache(path, **kwds)
+    return cache
+
+def cache_stats():
+    return dict(cache.stats(), cleaned=_cleaned.stats())
+
+# -----------------------------------------------------------------------------
+
+# Labels are typeset by the HTTP server in `mj_server.js` unless we are
+# using a pool of MathJax worker processes.
+_worker_pool = None
+
+def use_worker_pool(size=None, command=None):
+    """
+    Typeset using a pool of persistent MathJax processes instead of the
+    HTTP server.
+    """
+    global _worker_pool
+    close_worker_pool()
+    _worker_pool = WorkerPool(size, command)
+    return _worker_pool
+
+def close_worker_pool():
+    global _worker_pool
+    if _worker_pool is not None:
+        _worker_pool.close()
+        _worker_pool = None
+
+def _restart_worker_pool_in_child():
+    # A forked process must not share its parent's worker pipes, so it
+    # starts workers of its own as it needs them
+    global _worker_pool
+    if _worker_pool is not None:
+        _worker_pool = WorkerPool(_worker_pool.size, _worker_pool.command)
+
+os.register_at_fork(after_in_child=_restart_worker_pool_in_child)
+
+# -----------------------------------------------------------------------------
 
 def suffix_ids(xml, attribute, id_base, new_attrib=None):
     for e in xml.findall('.//*[@{}]'.format(attribute)):
@@ -13,7 +240,40 @@ def suffix_ids(xml, attribute, id_base, new_attrib=None):
             e.attrib[new_attrib] = e.attrib[attribute] + '_' + id_base
             del e.attrib[attribute]
 
+def share_glyphs(xml):
+    """
+    Move glyph outlines out of a typeset label's `<defs>` so that they can
+    be shared by all labels in a diagram.
+
+    A glyph's id is derived from its path data and so is the same wherever
+    it is used.
+
+    :return: A tuple of a dictionary mapping the label's glyph ids to their
+             shared ids, and a dictionary with the SVG of each shared glyph.
+    """
+    shared_ids = {}
+    glyphs = {}
+    for defs in xml.findall('{http://www.w3.org/2000/svg}defs'):
+        for path in defs.findall('{http://www.w3.org/2000/svg}path'):
+            id = path.attrib.pop('id', None)
+            if id is None:
+                continue
+            attributes = ''.join(' {}={}'.format(name, quoteattr(value))
+                                   for name, value in sorted(path.attrib.items()))
+            glyph_id = '_GLYPH_{}_'.format(hashlib.sha1(attributes.encode('utf-8')).hexdigest()[:12])
+            shared_ids[id] = glyph_id
+            glyphs[glyph_id] = '<path id="{}"{}/>'.format(glyph_id, attributes)
+            defs.remove(path)
+        if len(defs) == 0:
+            xml.remove(defs)
+    return (shared_ids, glyphs)
+
 def clean_svg(svg, id_base):
+    """
+    :return: A tuple of the SVG for the label, its size as
+             `(width, height, vertical-align, viewBox)`, and a
+             dictionary of the shared glyphs it uses.
+    """
     if not svg.startswith(b'<svg '):
         raise ValueError(svg)
     xml = etree.fromstring(svg)
@@ -27,42 +287,268 @@ def clean_svg(svg, id_base):
     title = xml.find('{http://www.w3.org/2000/svg}title')
     if title is not None:
         xml.remove(title)
+    (shared_ids, glyphs) = share_glyphs(xml)
     suffix_ids(xml, 'id', id_base)
-    suffix_ids(xml, '{http://www.w3.org/1999/xlink}href', id_base) ## , new_attrib='href)  ## SVG 2 only
-    return (etree.tostring(xml, encoding='unicode'), (w, h, va, vb))
+    href = '{http://www.w3.org/1999/xlink}href'    ## 'href' in SVG 2
+    for e in xml.iter():
+        target = e.attrib.get(href)
+        if target is not None and target.startswith('#'):
+            shared_id = shared_ids.get(target[1:])
+            e.attrib[href] = ('#' + shared_id) if shared_id else (target + '_' + id_base)
+    return (etree.tostring(xml, encoding='unicode'), (w, h, va, vb), glyphs)
 
-def typeset(latex, id_base):
+def mathjax_params(latex):
     if latex.startswith('$') and latex.endswith('$'):
         latex = latex[1:-1]
-    mathjax = json.dumps({
-        'format': 'TeX',
-        'math': latex,
-        'svg':True,
-##        'ex': 6,   ###  ?????
-        'width': 10000,
-        'linebreaks': False,
-    });
+    params = dict(MATHJAX_OPTIONS)
+    params['math'] = latex
+    return params
+
+def cache_key(params):
+    return TypesetCache.key(dict(params, config=MATHJAX_CONFIG))
+
+def mathjax_request(params, timeout=REQUEST_TIMEOUT):
     headers = { 'Content-Type': 'application/json' }
-    request = HTTPRequest('http://localhost:8003/',
-                          method='POST',
-                          headers=headers,
-                          body=mathjax)
-    http_client = HTTPClient()
+    return httpclient.HTTPRequest(MATHJAX_URL,
+                       method='POST',
+                       headers=headers,
+                       body=json.dumps(params),
+                       connect_timeout=min(CONNECT_TIMEOUT, timeout),
+                       request_timeout=timeout)
+
+def fetch(params):
+    """
+    Get raw SVG from MathJax.
 
+    :raises TypesetError: if the formula can't be typeset, MathJax is
+                          unavailable, or the deadline has passed.
+    """
+    timeout = check_available()
     try:
-        response = http_client.fetch(request)
-        svg = clean_svg(response.body, id_base)
-    except HTTPError as e:
-        # HTTPError is raised for non-200 responses; the response
-        # can be found in e.response.
-        svg = '<text>ERROR 1</text>'
-    except IOError as e:
-        # Other errors are possible, such as IOError.
-        svg = '<text>ERROR 2</text>'
-    http_client.close()
+        if _worker_pool is not None:
+            raw_svg = _worker_pool.typeset(params, REQUEST_TIMEOUT, deadline_expires())
+        else:
+            http_client = httpclient.HTTPClient()
+            try:
+                raw_svg = http_client.fetch(mathjax_request(params, timeout)).body
+            finally:
+                http_client.close()
+    except FormulaError as err:
+        breaker.record_success()
+        raise TypesetError(str(err))
+    except httpclient.HTTPError as err:
+        # MathJax responds with 400 when it can't typeset the formula
+        if err.code == 400:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+        raise TypesetError(str(err))
+    except IOError as err:
+        breaker.record_failure()
+        raise TypesetError(str(err))
+    breaker.record_success()
+    return raw_svg
 
+def typeset(latex, id_base):
+    """
+    :return: The result of `clean_svg()` for the typeset label.
+    :raises TypesetError: if the label can't be typeset.
+    """
+    params = mathjax_params(latex)
+    key = cache_key(params)
+    cleaned = _cleaned.get((key, id_base))
+    if cleaned is not None:
+        return cleaned
+    raw_svg = cache.get(key)
+    if raw_svg is not None:
+        # Ids are suffixed each time the SVG is used
+        cleaned = clean_svg(raw_svg, id_base)
+        _cleaned.put((key, id_base), cleaned)
+        return cleaned
+
+    raw_svg = fetch(params)
+    try:
+        svg = clean_svg(raw_svg, id_base)
+    except (ValueError, etree.XMLSyntaxError) as err:
+        raise TypesetError('Invalid SVG from MathJax: {}'.format(err))
+    cache.put(key, raw_svg)
     return svg
 
+# -----------------------------------------------------------------------------
+
+async def _fetch_all(pending, concurrency):
+    http_client = httpclient.AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_one(key, params):
+        async with semaphore:
+            try:
+                timeout = check_available()
+                response = await http_client.fetch(mathjax_request(params, timeout))
+            except TypesetError:
+                return
+            except (httpclient.HTTPError, IOError) as err:
+                if not isinstance(err, httpclient.HTTPError) or err.code != 400:
+                    breaker.record_failure()
+                # `typeset()` will try again when the label is needed
+                logging.warning('Cannot typeset %s: %s', params['math'], err)
+                return
+        breaker.record_success()
+        cache.put(key, response.body)
+
+    try:
+        await asyncio.gather(*[fetch_one(key, params) for key, params in pending.items()])
+    finally:
+        http_client.close()
+
+# -----------------------------------------------------------------------------
+
+def _pool_typeset(pending):
+    results = {}
+    try:
+        check_available()
+    except TypesetError:
+        return results
+    # Each label is timed from when a worker starts on it, and none may
+    # run past the deadline
+    for key, raw_svg in zip(pending.keys(), _worker_pool.typeset_many(list(pending.values()),
+                                                                      REQUEST_TIMEOUT,
+                                                                      deadline_expires())):
+        if raw_svg is not None:
+            cache.put(key, raw_svg)
+            results[key] = raw_svg
+    return results
+
+# -----------------------------------------------------------------------------
+
+_batch_connection = None
+
+def _batch_request(body, timeout):
+    global _batch_connection
+    url = urllib.parse.urlsplit(MATHJAX_URL)
+    for attempt in range(2):
+        if _batch_connection is None:
+            _batch_connection = httplib.HTTPConnection(url.hostname, url.port)
+        _batch_connection.timeout = timeout
+        if _batch_connection.sock is not None:
+            _batch_connection.sock.settimeout(timeout)
+        try:
+            _batch_connection.request('POST', url.path or '/', body=body,
+                                      headers={ 'Content-Type': 'application/json' })
+            return _batch_connection.getresponse()
+        except (httplib.HTTPException, ConnectionError):
+            # The server may have closed an idle keep-alive connection
+            _batch_connection.close()
+            _batch_connection = None
+            if attempt:
+                raise
+
+def _batch_typeset(pending):
+    global _batch_connection
+    results = {}
+    pending_keys = list(pending.keys())
+    timeout = check_available()
+    try:
+        response = _batch_request(json.dumps(list(pending.values())), timeout)
+        if response.status != 200:
+            response.read()
+            raise IOError('MathJax batch request failed: {} {}'.format(response.status, response.reason))
+        while True:
+            line = response.readline()
+            if not line:
+                break
+            result = json.loads(line)
+            key = pending_keys[result['index']]
+            if 'svg' in result:
+                raw_svg = result['svg'].encode('utf-8')
+                cache.put(key, raw_svg)
+                results[key] = raw_svg
+            else:
+                logging.warning('Cannot typeset %s: %s', pending[key]['math'],
+                                                         ' '.join(result.get('errors', [])))
+    except (IOError, httplib.HTTPException) as err:
+        # Includes socket timeouts; the connection is no longer usable
+        if _batch_connection is not None:
+            _batch_connection.close()
+            _batch_connection = None
+        breaker.record_failure()
+        raise TypesetError(str(err))
+    breaker.record_success()
+    return results
+
+def typeset_many(latex_list):
+    """
+    Typeset a list of labels with a single batch request to the MathJax
+    server, over a connection that is kept open for subsequent batches,
+    or across the worker pool if we are using one.
+
+    Results are cached and uncached labels are the only ones sent to the
+    server.
+
+    :return: A list with the server's raw SVG for each label, or `None`
+             for labels that couldn't be typeset.
+    """
+    keys = []
+    results = {}
+    pending = OrderedDict()
+    for latex in latex_list:
+        params = mathjax_params(latex)
+        key = cache_key(params)
+        keys.append(key)
+        if key not in results and key not in pending:
+            raw_svg = cache.get(key)
+            if raw_svg is not None:
+                results[key] = raw_svg
+            else:
+                pending[key] = params
+    if pending and _worker_pool is not None:
+        results.update(_pool_typeset(pending))
+    elif pending:
+        try:
+            results.update(_batch_typeset(pending))
+        except TypesetError as err:
+            logging.warning('Cannot typeset labels: %s', err)
+    return [results.get(key) for key in keys]
+
+# -----------------------------------------------------------------------------
+
+def prefetch(labels, concurrency=None):
+    """
+    Typeset labels concurrently, leaving the results in the cache for
+    `typeset()` to use.
+
+    Requests are made from a new event loop, or, when called from a
+    coroutine, in a single blocking batch request as `typeset_many()`.
+
+    :param labels: An iterable of LaTeX strings.
+    :param concurrency: The maximum number of requests in flight, defaults
+                        to `TYPESET_CONCURRENCY`.
+    :return: The number of labels that were not already cached.
+    """
+    keys = set()
+    pending = OrderedDict()
+    for latex in labels:
+        params = mathjax_params(latex)
+        key = cache_key(params)
+        keys.add(key)
+        if key not in pending and cache.get(key) is None:
+            pending[key] = params
+    # Every label must stay in memory until it is used
+    cache.reserve(len(keys))
+    if pending and _worker_pool is not None:
+        _pool_typeset(pending)
+    elif pending:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(_fetch_all(pending, concurrency or TYPESET_CONCURRENCY))
+        else:
+            try:
+                _batch_typeset(pending)
+            except TypesetError as err:
+                logging.warning('Cannot typeset labels: %s', err)
+    return len(pending)
 
 if __name__ == '__main__':
+    # Run with `python -m cell_diagram.mathjax`
     print(typeset('a', 'ID'))
@@ -0,0 +1,228 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+import itertools
+import json
+import logging
+import os
+import queue
+import selectors
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# -----------------------------------------------------------------------------
+
+# The persistent typesetter in `mathjax.js`
+WORKER_COMMAND = ['node', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                       'mathjax.js')]
+
+WORKER_TIMEOUT = 30   # seconds
+
+# -----------------------------------------------------------------------------
+
+class WorkerError(IOError):
+    pass
+
+class FormulaError(WorkerError):
+    pass
+
+# -----------------------------------------------------------------------------
+
+class Worker(object):
+    """
+    A MathJax process that we talk to over its stdin and stdout, one JSON
+    request and result per line.
+    """
+    def __init__(self, command):
+        self._command = command
+        self._process = None
+        self._selector = None
+        self._buffer = bytearray()
+        self._request_ids = itertools.count()
+        self.start()
+
+    @property
+    def alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        self.stop()
+        try:
+            self._process = subprocess.Popen(self._command,
+                                             stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE)
+        except OSError as err:
+            raise WorkerError('Cannot start MathJax worker: {}'.format(err))
+        # Results are read as they arrive, so that a worker which stops
+        # part way through a line can't block us
+        os.set_blocking(self._process.stdout.fileno(), False)
+        self._buffer = bytearray()
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._process.stdout, selectors.EVENT_READ)
+
+    def stop(self):
+        if self._process is not None:
+            self._selector.close()
+            if self._process.poll() is None:
+                self._process.kill()
+            self._process.wait()
+            self._process.stdin.close()
+            self._process.stdout.close()
+            self._process = None
+
+    def _read_line(self, expires):
+        while True:
+            end = self._buffer.find(b'\n')
+            if end >= 0:
+                line = bytes(self._buffer[:end + 1])
+                del self._buffer[:end + 1]
+                return line
+            remaining = expires - time.monotonic()
+            if remaining <= 0 or not self._selector.select(remaining):
+                raise WorkerError('MathJax worker timed out')
+            try:
+                data = os.read(self._process.stdout.fileno(), 65536)
+            except BlockingIOError:
+                continue
+            if not data:
+                raise WorkerError('MathJax worker has died')
+            self._buffer.extend(data)
+
+    def typeset(self, params, timeout=WORKER_TIMEOUT):
+        expires = time.monotonic() + timeout
+        request_id = next(self._request_ids)
+        try:
+            self._process.stdin.write(json.dumps(dict(id=request_id, params=params)).encode('utf-8') + b'\n')
+            self._process.stdin.flush()
+        except (BrokenPipeError, OSError) as err:
+            raise WorkerError('MathJax worker has died: {}'.format(err))
+        result = json.loads(self._read_line(expires))
+        if result.get('id') != request_id:
+            raise WorkerError('MathJax worker is out of step')
+        if 'errors' in result:
+            raise FormulaError(' '.join(result['errors']))
+        return result['svg'].encode('utf-8')
+
+# -----------------------------------------------------------------------------
+
+class WorkerPool(object):
+    """
+    A pool of persistent MathJax worker processes.
+
+    Workers that crash or stop responding are restarted and their request
+    retried once.
+
+    :param size: The number of worker processes, defaults to one per CPU.
+    :param command: The command that starts a worker.
+    :param timeout: Seconds to wait for a worker to typeset a formula.
+    """
+    def __init__(self, size=None, command=None, timeout=WORKER_TIMEOUT):
+        self._size = size or os.cpu_count() or 1
+        self._command = command if command is not None else WORKER_COMMAND
+        self._timeout = timeout
+        self._idle = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self.restarts = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def command(self):
+        return self._command
+
+    def _get_worker(self):
+        # Workers are started as they are first needed
+        with self._lock:
+            if self._idle.empty() and len(self._workers) < self._size:
+                worker = Worker(self._command)
+                self._workers.append(worker)
+                return worker
+        return self._idle.get()
+
+    def typeset(self, params, timeout=None, expires=None):
+        """
+        :param timeout: Overrides the pool's timeout for this request.
+        :param expires: A `time.monotonic()` time by which the request,
+                        including any retry, must have finished.
+        :return: The raw SVG from MathJax.
+        """
+        timeout = timeout if timeout is not None else self._timeout
+        worker = self._get_worker()
+        try:
+            for attempt in range(2):
+                if expires is not None:
+                    remaining = expires - time.monotonic()
+                    if remaining <= 0:
+                        raise WorkerError('Typesetting deadline has passed')
+                    attempt_timeout = min(timeout, remaining)
+                else:
+                    attempt_timeout = timeout
+                if not worker.alive:
+                    self._restart(worker)
+                try:
+                    return worker.typeset(params, attempt_timeout)
+                except FormulaError:
+                    raise
+                except WorkerError:
+                    # The worker has crashed or hung and is no longer in
+                    # step with us
+                    self._restart(worker)
+                    if attempt:
+                        raise
+        finally:
+            self._idle.put(worker)
+
+    def _restart(self, worker):
+        logging.warning('Restarting MathJax worker')
+        self.restarts += 1
+        worker.start()
+
+    def typeset_many(self, params_list, timeout=None, expires=None):
+        """
+        Typeset concurrently across the pool's workers.
+
+        :param timeout: Overrides the pool's timeout for each request.
+        :param expires: A `time.monotonic()` time by which all requests
+                        must have finished.
+        :return: A list with the raw SVG for each set of parameters,
+                 or `None` where typesetting failed.
+        """
+        def typeset(params):
+            try:
+                return self.typeset(params, timeout, expires)
+            except WorkerError as err:
+                logging.warning('Cannot typeset %s: %s', params.get('math'), err)
+                return None
+        with ThreadPoolExecutor(max_workers=self._size) as executor:
+            return list(executor.map(typeset, params_list))
+
+    def close(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.stop()
+            self._workers = []
+            self._idle = queue.Queue()
+
+# -----------------------------------------------------------------------------
@@ -34,7 +34,9 @@ from . import SyntaxError
 
 from . import bondgraph as bg
 from . import diagram as dia
+from . import mathjax
 
+from .cache import LRUCache
 from .svg_elements import Gradient
 
 # -----------------------------------------------------------------------------
@@ -246,6 +248,9 @@ def get_colour_value(tokens):
 
 
 class StyleSheet(cssselect2.Matcher):
+    # Compiled stylesheets, keyed by their text
+    _compiled = LRUCache(64)
+
     def __init__(self, stylesheet):
         '''Parse CSS and add rules to the matcher.'''
         super().__init__()
@@ -260,6 +265,15 @@ class StyleSheet(cssselect2.Matcher):
             for selector in selectors:
                 self.add_selector(selector, declarations)
 
+    @classmethod
+    def compiled(cls, stylesheet):
+        '''A matcher for the stylesheet, compiled once and then reused.'''
+        matcher = cls._compiled.get(stylesheet)
+        if matcher is None:
+            matcher = cls(stylesheet)
+            cls._compiled.put(stylesheet, matcher)
+        return matcher
+
     def match(self, element):
         rules = {}
         matches = super().match(element)
@@ -470,9 +484,13 @@ class Parser(object):
             xml_root = etree.parse(file)
         except (etree.ParseError, etree.XMLSyntaxError) as err:
             lineno, column = err.position
-            with open(file) as f:
-                t = f.read()
-                line = next(itertools.islice(io.StringIO(t), lineno-1, None))
+            if hasattr(file, 'getvalue'):
+                t = file.getvalue()
+                t = t.decode('utf-8', 'replace') if isinstance(t, bytes) else t
+            else:
+                with open(file) as f:
+                    t = f.read()
+            line = next(itertools.islice(io.StringIO(t), lineno-1, None))
             error = ("{}\n{}".format(err, line))
         if error:
             raise SyntaxError(error)
@@ -480,12 +498,12 @@ class Parser(object):
         try:
             # Load all style information before wrapping the root element
             if stylesheet is not None:
-                self._stylesheets.append(StyleSheet(stylesheet))
+                self._stylesheets.append(StyleSheet.compiled(stylesheet))
             for e in xml_root.iterfind(CellDL_namespace('style')):
                 if 'href' in e.attrib:
                     pass          ### TODO: Load external stylesheets...
                 else:
-                    self._stylesheets.append(StyleSheet(e.text))
+                    self._stylesheets.append(StyleSheet.compiled(e.text))
         except cssselect2.parser.SelectorError as err:
             error = "{} when parsing stylesheet.".format(err)
         if error:
@@ -515,6 +533,10 @@ class Parser(object):
         if error:
             raise SyntaxError(error)
 
+        # Typeset labels concurrently so they are ready when we generate SVG
+        with mathjax.deadline():
+            mathjax.prefetch(self._diagram.latex_labels())
+
         logging.debug('')
 
         # For all flow components
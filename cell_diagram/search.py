@@ -0,0 +1,163 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+A sidecar index for finding exported features by id, label or class.
+
+The index is written as JSON::
+
+    {
+        "layers": ["background.json", ...],
+        "fields": ["id", "label", "classes", "bbox", "centroid", "layer"],
+        "features": [["#q1", "$q_1$", ["sodium"], [x0, y0, x1, y1], [x, y], 0], ...],
+        "keys": [["#q1", 0], ["$q_1$", 0], ["sodium", 0], ...]
+    }
+
+with `bbox` and `centroid` in map coordinates and `layer` indexing the
+`layers` list. `keys` is sorted so that a viewer can binary search it for
+all the features with an id, label or class.
+"""
+
+# -----------------------------------------------------------------------------
+
+import bisect
+import json
+
+import numpy as np
+import shapely
+
+# -----------------------------------------------------------------------------
+
+from . import geojson as GeoJSON
+
+# -----------------------------------------------------------------------------
+
+FIELDS = ['id', 'label', 'classes', 'bbox', 'centroid', 'layer']
+
+# Decimal places kept in coordinates
+PRECISION = 3
+
+# -----------------------------------------------------------------------------
+
+class SearchIndex(object):
+    """
+    :param diagram: The diagram whose features are indexed, used to find
+                    the label and classes of a feature's element.
+    :param transform: The affine transform from diagram to map coordinates
+                      used when exporting the features.
+    """
+    def __init__(self, diagram, transform=None):
+        self._diagram = diagram
+        self._transform = transform if transform is not None else GeoJSON.DEFAULT_TRANSFORM
+        self._layers = []
+        self._entries = []
+        self._geometries = []
+        self._radii = []
+        self._features = None
+        self._keys = None
+
+    def collect(self, features, layer_file=None):
+        """
+        Index features as they are generated, passing them on unchanged.
+
+        :param layer_file: The file that the features are written to.
+        """
+        if layer_file not in self._layers:
+            self._layers.append(layer_file)
+        layer = self._layers.index(layer_file)
+        for feature in features:
+            id = feature.properties.get('id')
+            element = self._diagram.find_element(id) if id else None
+            self._entries.append((id,
+                                  element.label if element is not None else None,
+                                  sorted(element.classes) if element is not None else [],
+                                  layer))
+            self._geometries.append(feature.diagram_geometry)
+            # A compact circle is a point with a radius
+            self._radii.append(feature.properties.get('radius', 0.0))
+            self._features = None
+            yield feature
+
+    def add(self, features, layer_file=None):
+        for feature in self.collect(features, layer_file):
+            pass
+
+    def _build(self):
+        if self._features is not None:
+            return
+        # Bounds and centroids of all features at once, in diagram
+        # coordinates and then mapped. An axis-aligned box stays one
+        # under scaling and flipping.
+        geometries = np.array(self._geometries, dtype=object)
+        bounds = shapely.bounds(geometries).reshape(-1, 4)
+        radii = np.array(self._radii, dtype=float).reshape(-1, 1)
+        bounds = np.hstack([bounds[:, :2] - radii, bounds[:, 2:] + radii])
+        centroids = shapely.centroid(geometries)
+        (lower, upper, centres) = (
+            GeoJSON.transform_coordinates(coords, self._transform).round(PRECISION)
+                for coords in [bounds[:, :2], bounds[:, 2:],
+                               np.column_stack([shapely.get_x(centroids), shapely.get_y(centroids)])])
+        boxes = np.hstack([np.minimum(lower, upper), np.maximum(lower, upper)])
+        # Empty geometries have no position
+        boxes = [None if np.isnan(box).any() else box for box in boxes.tolist()]
+        centres = [None if np.isnan(centre).any() else centre for centre in centres.tolist()]
+        self._features = sorted(([id, label, classes, box, centre, layer]
+                                    for (id, label, classes, layer), box, centre
+                                        in zip(self._entries, boxes, centres)),
+                                key=lambda feature: (feature[0] or '', feature[5]))
+        keys = []
+        for n, (id, label, classes, _, _, _) in enumerate(self._features):
+            names = set(classes)
+            names.update(name for name in [id, label] if name)
+            keys.extend([name, n] for name in names)
+        self._keys = sorted(keys)
+
+    def lookup(self, key):
+        """
+        :return: A list of features, as dictionaries with `FIELDS` as keys,
+                 that have `key` as their id, label or one of their classes.
+        """
+        self._build()
+        start = bisect.bisect_left(self._keys, [key, -1])
+        found = []
+        for (name, n) in self._keys[start:]:
+            if name != key:
+                break
+            feature = dict(zip(FIELDS, self._features[n]))
+            feature['layer'] = self._layers[feature['layer']]
+            found.append(feature)
+        return found
+
+    def __len__(self):
+        return len(self._entries)
+
+    def as_dict(self):
+        self._build()
+        return {
+            'layers': self._layers,
+            'fields': FIELDS,
+            'features': self._features,
+            'keys': self._keys,
+        }
+
+    def write(self, fp):
+        json.dump(self.as_dict(), fp, separators=(',', ':'))
+
+# -----------------------------------------------------------------------------
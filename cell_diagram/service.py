@@ -0,0 +1,447 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+A local HTTP service that renders CellDL, keeping stylesheets, typeset
+labels and recently parsed diagrams in memory between requests.
+
+``POST /render`` takes either a JSON object::
+
+    {
+        "celldl": "<cell-diagram ...>...</cell-diagram>",
+        "stylesheet": "...",                 (optional)
+        "format": "svg",                     (or "geojson", "topojson" or "layers")
+        "classes": ["sodium", ...],          (the layers for "layers")
+        "compact": false,
+        "step": 1.0,
+        "map_extent": [x0, y0, x1, y1]
+    }
+
+or the CellDL itself, with the other fields as query arguments. Layers are
+returned as a JSON object with the SVG and GeoJSON of each layer.
+
+``GET /metrics`` returns request latencies and cache statistics as JSON.
+"""
+
+# -----------------------------------------------------------------------------
+
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import tornado.web
+
+# -----------------------------------------------------------------------------
+
+from . import SyntaxError
+from . import geojson as GeoJSON
+from . import mathjax
+
+from .cache import LRUCache
+from .parser import Parser, StyleSheet
+from .svg_elements import DefinesStore
+
+# -----------------------------------------------------------------------------
+
+FORMATS = {
+    'svg': 'image/svg+xml',
+    'geojson': 'application/geo+json',
+    'topojson': 'application/json',
+    'layers': 'application/json',
+}
+
+# Diagrams kept parsed and laid out
+MAX_DIAGRAMS = 32
+
+# Latencies kept for each format
+LATENCY_SAMPLES = 1000
+
+# Renders made by a pool worker before it is replaced
+MAX_REQUESTS = 500
+
+# Requests waiting or being rendered, per pool worker
+QUEUE_DEPTH = 4
+
+# -----------------------------------------------------------------------------
+
+class RenderOptions(tuple):
+    """
+    The hashable options of a render request.
+    """
+    FIELDS = ('format', 'classes', 'compact', 'step', 'map_extent')
+
+    def __new__(cls, format='svg', classes=None, compact=False, step=None, map_extent=None):
+        if format not in FORMATS:
+            raise ValueError('Unknown format: {}'.format(format))
+        if format == 'layers' and not classes:
+            raise ValueError('Layers need classes')
+        if map_extent is not None and len(map_extent) != 4:
+            raise ValueError('A map extent has four values')
+        return super().__new__(cls, (format,
+                                     tuple(classes) if classes else None,
+                                     bool(compact),
+                                     float(step) if step is not None else None,
+                                     tuple(float(v) for v in map_extent) if map_extent else None))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    def __getattr__(self, name):
+        try:
+            return self[self.FIELDS.index(name)]
+        except ValueError:
+            raise AttributeError(name)
+
+# -----------------------------------------------------------------------------
+
+def render(diagram, options):
+    """
+    :return: The text of a diagram rendered with `RenderOptions`.
+    """
+    transform = (GeoJSON.extent_transform(diagram.width, diagram.height, options.map_extent)
+                 if options.map_extent else None)
+    if options.format == 'svg':
+        return diagram.svg()
+    fp = io.StringIO()
+    if options.format == 'geojson':
+        diagram.write_geojson(fp, transform=transform, compact=options.compact, step=options.step)
+    elif options.format == 'topojson':
+        diagram.write_topojson(fp, transform=transform, compact=options.compact, step=options.step)
+    else:
+        layers = diagram.render_layers(options.classes, geojson=True, compact=options.compact)
+        fp.write('{')
+        for n, (layer, (svg, features)) in enumerate(layers.items()):
+            # Each layer's GeoJSON is already JSON text
+            fp.write('{}{}:{{"svg":{},"geojson":'.format(',' if n else '',
+                                                        json.dumps(layer), json.dumps(svg)))
+            diagram.write_geojson(fp, layer=layer, transform=transform, compact=options.compact,
+                                  step=options.step, features=features)
+            fp.write('}')
+        fp.write('}')
+    return fp.getvalue()
+
+# -----------------------------------------------------------------------------
+
+class Metrics(object):
+    def __init__(self):
+        self.requests = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.rejected = 0
+        self._latencies = {}
+
+    def record(self, format, seconds):
+        self.requests += 1
+        self._latencies.setdefault(format, deque(maxlen=LATENCY_SAMPLES)).append(seconds)
+
+    @staticmethod
+    def _summary(latencies):
+        ordered = sorted(latencies)
+        def percentile(p):
+            return round(1000*ordered[min(len(ordered) - 1, int(p*len(ordered)))], 3)
+        return dict(count=len(ordered), p50_ms=percentile(0.5), p95_ms=percentile(0.95),
+                    max_ms=round(1000*ordered[-1], 3))
+
+    def as_dict(self):
+        return dict(requests=self.requests,
+                    coalesced=self.coalesced,
+                    errors=self.errors,
+                    rejected=self.rejected,
+                    latency={format: self._summary(latencies)
+                                for format, latencies in self._latencies.items()})
+
+# -----------------------------------------------------------------------------
+
+class DiagramCache(object):
+    """
+    Parsed diagrams and their rendered outputs, for use by one thread.
+    """
+    def __init__(self, max_diagrams=MAX_DIAGRAMS):
+        self._diagrams = LRUCache(max_diagrams)
+
+    def _diagram(self, key, celldl, stylesheet):
+        entry = self._diagrams.get(key)
+        if entry is None:
+            DefinesStore.clear()
+            diagram = Parser().parse(io.BytesIO(celldl), stylesheet)
+            # Keep the definitions made when parsing, such as gradients,
+            # to restore whenever the diagram is rendered
+            entry = (diagram, DefinesStore.save(), {})
+            self._diagrams.put(key, entry)
+        return entry
+
+    def render(self, key, celldl, stylesheet, options):
+        # Each request is a conversion with its own typesetting deadline
+        with mathjax.deadline() as typesetting:
+            (diagram, defines, outputs) = self._diagram(key, celldl, stylesheet)
+            output = outputs.get(options)
+            if output is None:
+                DefinesStore.restore(defines)
+                output = render(diagram, options)
+                # Output with plain text labels isn't kept, so that a later
+                # request can typeset them
+                if typesetting.degraded == 0:
+                    outputs[options] = output
+        return output
+
+    def stats(self):
+        return dict(diagrams=self._diagrams.stats(),
+                    stylesheets=StyleSheet._compiled.stats(),
+                    typeset=mathjax.cache_stats())
+
+# -----------------------------------------------------------------------------
+
+class Overloaded(Exception):
+    pass
+
+class Renderer(object):
+    """
+    Render diagrams on a single worker thread, since SVG definitions and
+    their numbering are global, keeping the event loop free to accept
+    requests.
+
+    Identical requests that arrive while one is being rendered share its
+    result.
+    """
+    def __init__(self, max_diagrams=MAX_DIAGRAMS):
+        self._cache = DiagramCache(max_diagrams)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._inflight = {}
+        self.metrics = Metrics()
+
+    def _submit(self, key, celldl, stylesheet, options):
+        return asyncio.get_running_loop().run_in_executor(self._executor, self._cache.render,
+                                                          key, celldl, stylesheet, options)
+
+    async def render(self, celldl, stylesheet, options):
+        """
+        :param celldl: The CellDL XML, as bytes.
+        :param stylesheet: Optional CSS applied before the diagram's own.
+        :param options: `RenderOptions`.
+        :return: The rendered text.
+        :raises Overloaded: if there is no room to queue the request.
+        """
+        digest = hashlib.sha256(celldl)
+        digest.update(b'\0' + (stylesheet or '').encode('utf-8'))
+        key = digest.hexdigest()
+        future = self._inflight.get((key, options))
+        if future is None:
+            future = self._submit(key, celldl, stylesheet, options)
+            self._inflight[(key, options)] = future
+            future.add_done_callback(lambda f: self._inflight.pop((key, options), None))
+        else:
+            self.metrics.coalesced += 1
+        # Cancelling one request mustn't cancel the others waiting on it
+        return await asyncio.shield(future)
+
+    def stats(self):
+        return dict(self.metrics.as_dict(), **self._cache.stats())
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+# -----------------------------------------------------------------------------
+
+# The diagram cache of a pool worker process
+_worker_cache = None
+
+def _init_worker(max_diagrams, typeset_cache):
+    global _worker_cache
+    if typeset_cache is not None:
+        mathjax.configure_cache(typeset_cache)
+    _worker_cache = DiagramCache(max_diagrams)
+
+def _worker_render(key, celldl, stylesheet, options):
+    output = _worker_cache.render(key, celldl, stylesheet, options)
+    return (os.getpid(), output, _worker_cache.stats())
+
+class PoolRenderer(Renderer):
+    """
+    Render diagrams on a pool of worker processes, to use more than one
+    core.
+
+    Workers are started from a server process that has already imported
+    the package, so starting one is quick, and each is replaced after
+    `max_requests` renders so that global state such as `DefinesStore`
+    can't grow without bound. At most `queue_depth` requests per worker
+    are waiting or being rendered; beyond that requests are refused with
+    `Overloaded` rather than queued.
+
+    If a worker dies abruptly the pool is started again, and requests
+    that were waiting or being rendered are retried once before failing
+    with `BrokenProcessPool`.
+    """
+    def __init__(self, workers=None, max_diagrams=MAX_DIAGRAMS, max_requests=MAX_REQUESTS,
+                 queue_depth=QUEUE_DEPTH, typeset_cache=None):
+        self._cache = None
+        self._inflight = {}
+        self.metrics = Metrics()
+        self._workers = workers if workers else os.cpu_count()
+        self._capacity = self._workers*queue_depth
+        self._pending = 0
+        # Cache statistics last reported by each worker
+        self._worker_stats = LRUCache(self._workers)
+        self._worker_args = (max_diagrams, max_requests, typeset_cache)
+        self._executor = self._start_executor()
+
+    def _start_executor(self):
+        (max_diagrams, max_requests, typeset_cache) = self._worker_args
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload([__name__])
+        else:
+            context = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(max_workers=self._workers, mp_context=context,
+                                   initializer=_init_worker,
+                                   initargs=(max_diagrams, typeset_cache),
+                                   max_tasks_per_child=max_requests)
+
+    def _restart_executor(self, broken):
+        # A worker died and took the pool with it. Requests that fail
+        # together only restart it once.
+        if self._executor is broken:
+            logging.warning('Restarting render worker pool')
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._start_executor()
+        return self._executor
+
+    def _submit(self, key, celldl, stylesheet, options):
+        if self._pending >= self._capacity:
+            raise Overloaded('{} requests are already queued'.format(self._pending))
+        result = asyncio.get_running_loop().create_future()
+        def submit(retry):
+            executor = self._executor
+            try:
+                submitted = executor.submit(_worker_render, key, celldl, stylesheet, options)
+            except BrokenProcessPool:
+                executor = self._restart_executor(executor)
+                submitted = executor.submit(_worker_render, key, celldl, stylesheet, options)
+            self._pending += 1
+            def finished(f):
+                self._pending -= 1
+                if f.cancelled():
+                    result.cancel()
+                elif isinstance(f.exception(), BrokenProcessPool) and retry:
+                    # The request may have been queued on a pool that
+                    # was already broken, so it gets one more try
+                    self._restart_executor(executor)
+                    submit(False)
+                elif f.exception() is not None:
+                    result.set_exception(f.exception())
+                else:
+                    (pid, output, stats) = f.result()
+                    self._worker_stats.put(pid, stats)
+                    result.set_result(output)
+            asyncio.wrap_future(submitted).add_done_callback(finished)
+        submit(True)
+        return result
+
+    def stats(self):
+        stats = dict(self.metrics.as_dict(), pending=self._pending, capacity=self._capacity)
+        stats['workers'] = {str(pid): worker_stats
+                                for pid, worker_stats in self._worker_stats.items()}
+        return stats
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+# -----------------------------------------------------------------------------
+
+class RenderHandler(tornado.web.RequestHandler):
+    def initialize(self, renderer):
+        self._renderer = renderer
+
+    def _request(self):
+        if self.request.headers.get('Content-Type', '').startswith('application/json'):
+            request = json.loads(self.request.body)
+            celldl = request.pop('celldl').encode('utf-8')
+            stylesheet = request.pop('stylesheet', None)
+        else:
+            celldl = self.request.body
+            stylesheet = None
+            request = {}
+            for name in RenderOptions.FIELDS:
+                value = self.get_query_argument(name, None)
+                if value is not None:
+                    request[name] = (value.split(',') if name in ['classes', 'map_extent']
+                                else value.lower() in ['1', 'true', 'yes'] if name == 'compact'
+                                else value)
+        return (celldl, stylesheet, RenderOptions(**request))
+
+    async def post(self):
+        start = time.perf_counter()
+        try:
+            (celldl, stylesheet, options) = self._request()
+        except (KeyError, TypeError, ValueError) as err:
+            self._renderer.metrics.errors += 1
+            raise tornado.web.HTTPError(400, reason='Invalid request: {}'.format(err))
+        try:
+            output = await self._renderer.render(celldl, stylesheet, options)
+        except SyntaxError as err:
+            self._renderer.metrics.errors += 1
+            self.set_status(400, reason='Invalid CellDL')
+            self.set_header('Content-Type', 'text/plain')
+            self.finish(str(err))
+            return
+        except Overloaded as err:
+            self._renderer.metrics.rejected += 1
+            self.set_status(503, reason='Overloaded')
+            self.set_header('Retry-After', '1')
+            self.finish(str(err))
+            return
+        except BrokenProcessPool as err:
+            # The pool is restarted for the next request
+            self._renderer.metrics.errors += 1
+            self.set_status(503, reason='Render worker failed')
+            self.set_header('Retry-After', '1')
+            self.finish(str(err))
+            return
+        self.set_header('Content-Type', FORMATS[options.format])
+        self.finish(output)
+        self._renderer.metrics.record(options.format, time.perf_counter() - start)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, renderer):
+        self._renderer = renderer
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(self._renderer.stats()))
+
+# -----------------------------------------------------------------------------
+
+def make_app(renderer=None):
+    if renderer is None:
+        renderer = Renderer()
+    return tornado.web.Application([
+        (r'/render', RenderHandler, dict(renderer=renderer)),
+        (r'/metrics', MetricsHandler, dict(renderer=renderer)),
+    ])
+
+# -----------------------------------------------------------------------------
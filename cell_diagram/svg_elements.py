@@ -18,7 +18,10 @@
 #
 # -----------------------------------------------------------------------------
 
+import contextlib
+import logging
 from math import cos, sin, asin, pi
+from xml.sax.saxutils import escape
 
 # -----------------------------------------------------------------------------
 
@@ -54,6 +57,16 @@ class DefinesStore(object):
     _ids = []
     _svg_to_id = {}
     _id_to_svg = {}
+    # Classes that number the ids they define, so that clearing or
+    # restoring the store also restores their numbering
+    _numbered = []
+    # Sets of ids being recorded as used
+    _recorders = []
+
+    @classmethod
+    def numbered(cls, numbered_cls):
+        cls._numbered.append(numbered_cls)
+        return numbered_cls
 
     @classmethod
     def add(cls, id, svg):
@@ -61,32 +74,81 @@ class DefinesStore(object):
             cls._ids.append(id)
             cls._svg_to_id[svg] = id
             cls._id_to_svg[id] = svg
+        cls._used(id)
         return "url(#{})".format(id)
 
     @classmethod
     def get_url(cls, svg):
         id = cls._svg_to_id.get(svg, None)
         if id is not None:
+            cls._used(id)
             return "url(#{})".format(id)
 
     @classmethod
-    def defines(cls):
-        return cls._id_to_svg.values()
+    def _used(cls, id):
+        for used in cls._recorders:
+            used.add(id)
+
+    @classmethod
+    @contextlib.contextmanager
+    def recording(cls):
+        """
+        Collect the ids of definitions that are added or looked up within
+        the context, whether or not they were already defined.
+        """
+        used = set()
+        cls._recorders.append(used)
+        try:
+            yield used
+        finally:
+            cls._recorders.remove(used)
+
+    @classmethod
+    def defines(cls, ids=None):
+        """
+        :param ids: Only return these definitions, in the order they were
+                    defined.
+        """
+        if ids is None:
+            return cls._id_to_svg.values()
+        return [cls._id_to_svg[id] for id in cls._ids if id in ids]
+
+    @classmethod
+    def clear(cls):
+        """
+        Remove all definitions and restart id numbering, as before any
+        diagram was rendered.
+        """
+        cls._ids.clear()
+        cls._svg_to_id.clear()
+        cls._id_to_svg.clear()
+        for numbered_cls in cls._numbered:
+            numbered_cls._next_id = 0
 
     @classmethod
-    def reset(cls, top):
-        for id in cls._ids[top:]:
-            svg = cls._id_to_svg.pop(id)
-            cls._svg_to_id.pop(svg)
-        del cls._ids[top:]
+    def save(cls):
+        """
+        :return: A copy of the store's definitions and numbering, for
+                 `restore()` to put back.
+        """
+        return (list(cls._ids), dict(cls._svg_to_id), dict(cls._id_to_svg),
+                tuple(numbered_cls._next_id for numbered_cls in cls._numbered))
 
     @classmethod
-    def top(cls):
-        return len(cls._ids)
+    def restore(cls, saved):
+        (ids, svg_to_id, id_to_svg, next_ids) = saved
+        cls._ids[:] = ids
+        cls._svg_to_id.clear()
+        cls._svg_to_id.update(svg_to_id)
+        cls._id_to_svg.clear()
+        cls._id_to_svg.update(id_to_svg)
+        for numbered_cls, next_id in zip(cls._numbered, next_ids):
+            numbered_cls._next_id = next_id
 
 # -----------------------------------------------------------------------------
 
 
+@DefinesStore.numbered
 class Gradient(object):
     _next_id = 0
 
@@ -421,6 +483,7 @@ class PMRChannelInOut(PMRChannel):
 
 # -----------------------------------------------------------------------------
 
+@DefinesStore.numbered
 class Arrow(object):
     _next_id = 0
 
@@ -468,6 +531,7 @@ def svg_line(line, colour, reverse=False, display='', style=''):
 
 # -----------------------------------------------------------------------------
 
+@DefinesStore.numbered
 class Text(object):
     _next_id = 0
 
@@ -476,10 +540,25 @@ class Text(object):
         cls._next_id += 1
         return "_TEXT_{}_".format(cls._next_id)
 
+    @classmethod
+    def plain_text(cls, s, x, y):
+        if s.startswith('$') and s.endswith('$'):
+            s = s[1:-1]
+        return ('  <text text-anchor="middle" dominant-baseline="central"'
+                ' x="{}" y="{}">{}</text>').format(x, y, escape(s))
+
     @classmethod
     def typeset(cls, s, x, y, rotation=0):
-        svg, size = mathjax.typeset(s, cls.next_id())
-        w, h, va = (6*float(size[0][:-2]), 6*float(size[1][:-2]), 6*float(size[2][:-2]))
+        try:
+            svg, size, glyphs = mathjax.typeset(s, cls.next_id())
+            w, h, va = (6*float(size[0][:-2]), 6*float(size[1][:-2]), 6*float((size[2] or '0ex')[:-2]))
+        except (mathjax.TypesetError, TypeError, ValueError) as err:
+            logging.debug('Cannot typeset %s: %s', s, err)
+            mathjax.record_degraded()
+            return cls.plain_text(s, x, y)
+        # Glyph outlines are shared by all labels
+        for id, glyph in glyphs.items():
+            DefinesStore.add(id, glyph)
         # Use viewBox in size[3] to calculate scaling
         # Rotate text but first need to find center
         return ('<g transform="translate({}, {}) scale(0.015)">{}</g>'
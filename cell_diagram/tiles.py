@@ -0,0 +1,430 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+Cut a diagram's features into a z/x/y pyramid of Mapbox Vector Tiles.
+
+Tiles are in diagram coordinates, with the diagram in the top-left of a
+square world whose size is that of the diagram's larger side and with
+tile rows numbered from the top (the XYZ scheme).
+"""
+
+# -----------------------------------------------------------------------------
+
+import gzip
+import json
+import logging
+import math
+import os
+import sqlite3
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import shapely
+import shapely.geometry as geo
+from shapely.geometry.polygon import orient
+
+# -----------------------------------------------------------------------------
+
+TILE_EXTENT = 4096
+
+# Tile display size in pixels, used to scale simplification tolerances
+TILE_PIXELS = 256
+
+# Extra space, in tile units, around a tile when clipping
+TILE_BUFFER = 64
+
+# Points aren't simplified
+POINT_TYPE_ID = 0
+MULTIPOINT_TYPE_ID = 4
+
+# -----------------------------------------------------------------------------
+
+def max_zoom_for(world_size):
+    """
+    The zoom at which a tile covers at most one display tile of the diagram.
+    """
+    return max(0, int(math.ceil(math.log2(world_size/float(TILE_PIXELS)))))
+
+# -----------------------------------------------------------------------------
+
+# Protocol buffer encoding (https://github.com/mapbox/vector-tile-spec)
+
+def _varint(value):
+    data = bytearray()
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            data.append(bits | 0x80)
+        else:
+            data.append(bits)
+            return bytes(data)
+
+def _key(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+def _bytes_field(field, data):
+    return _key(field, 2) + _varint(len(data)) + data
+
+def _varint_field(field, value):
+    return _key(field, 0) + _varint(value)
+
+def _packed_field(field, values):
+    return _bytes_field(field, b''.join(_varint(v) for v in values))
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def _command(id, count):
+    return (id & 0x7) | (count << 3)
+
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+GEOM_POINT = 1
+GEOM_LINESTRING = 2
+GEOM_POLYGON = 3
+
+def _encode_value(value):
+    if isinstance(value, bool):
+        return _varint_field(7, int(value))
+    elif isinstance(value, int):
+        return _varint_field(6, _zigzag(value)) if value < 0 else _varint_field(5, value)
+    elif isinstance(value, float):
+        return _key(3, 1) + struct.pack('<d', value)
+    return _bytes_field(1, str(value).encode('utf-8'))
+
+# -----------------------------------------------------------------------------
+
+class _GeometryEncoder(object):
+    def __init__(self):
+        self._commands = []
+        self._cursor = (0, 0)
+
+    @property
+    def commands(self):
+        return self._commands
+
+    def _deltas(self, points):
+        params = []
+        (cx, cy) = self._cursor
+        for (x, y) in points:
+            params.extend([_zigzag(x - cx), _zigzag(y - cy)])
+            (cx, cy) = (x, y)
+        self._cursor = (cx, cy)
+        return params
+
+    def points(self, points):
+        self._commands.append(_command(MOVE_TO, len(points)))
+        self._commands.extend(self._deltas(points))
+
+    def line(self, points, closed=False):
+        self._commands.append(_command(MOVE_TO, 1))
+        self._commands.extend(self._deltas(points[:1]))
+        self._commands.append(_command(LINE_TO, len(points) - 1))
+        self._commands.extend(self._deltas(points[1:]))
+        if closed:
+            self._commands.append(_command(CLOSE_PATH, 1))
+
+def _tile_points(coords, origin, scale):
+    points = []
+    for (x, y) in coords:
+        point = (int(round((x - origin[0])*scale)), int(round((y - origin[1])*scale)))
+        if not points or point != points[-1]:
+            points.append(point)
+    return points
+
+def _ring_points(coords, origin, scale):
+    points = _tile_points(coords, origin, scale)
+    # The closing point is implied by ClosePath
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    return points if len(points) >= 3 else []
+
+def encode_geometry(geometry, origin, scale):
+    """
+    :return: A tuple of MVT geometry type and commands, or `None` if the
+             geometry vanishes at this scale.
+    """
+    encoder = _GeometryEncoder()
+    geom_type = None
+    for part in getattr(geometry, 'geoms', [geometry]):
+        if part.is_empty:
+            continue
+        if part.geom_type == 'Point':
+            geom_type = GEOM_POINT
+            encoder.points(_tile_points(part.coords, origin, scale))
+        elif part.geom_type in ['LineString', 'LinearRing']:
+            points = _tile_points(part.coords, origin, scale)
+            if len(points) >= 2:
+                geom_type = GEOM_LINESTRING
+                encoder.line(points)
+        elif part.geom_type == 'Polygon':
+            # Exterior rings have positive area, i.e. clockwise with y down
+            part = orient(part, 1.0)
+            exterior = _ring_points(part.exterior.coords, origin, scale)
+            if not exterior:
+                continue
+            geom_type = GEOM_POLYGON
+            encoder.line(exterior, closed=True)
+            for interior in part.interiors:
+                points = _ring_points(interior.coords, origin, scale)
+                if points:
+                    encoder.line(points, closed=True)
+        else:
+            logging.warning('Cannot tile %s geometry', part.geom_type)
+    if geom_type is None:
+        return None
+    return (geom_type, encoder.commands)
+
+# -----------------------------------------------------------------------------
+
+def encode_layer(name, features, origin, scale):
+    """
+    :param features: A list of `(id, geometry, properties)` tuples.
+    """
+    keys = []
+    key_index = {}
+    values = []
+    value_index = {}
+    encoded = []
+    for (id, geometry, properties) in features:
+        encoded_geometry = encode_geometry(geometry, origin, scale)
+        if encoded_geometry is None:
+            continue
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            if key not in key_index:
+                key_index[key] = len(keys)
+                keys.append(key)
+            value_key = (type(value).__name__, value)
+            if value_key not in value_index:
+                value_index[value_key] = len(values)
+                values.append(value)
+            tags.extend([key_index[key], value_index[value_key]])
+        encoded.append(_varint_field(1, id)
+                     + (_packed_field(2, tags) if tags else b'')
+                     + _varint_field(3, encoded_geometry[0])
+                     + _packed_field(4, encoded_geometry[1]))
+    if not encoded:
+        return b''
+    return (_varint_field(15, 2)
+          + _bytes_field(1, name.encode('utf-8'))
+          + b''.join(_bytes_field(2, feature) for feature in encoded)
+          + b''.join(_bytes_field(3, key.encode('utf-8')) for key in keys)
+          + b''.join(_bytes_field(4, _encode_value(value)) for value in values)
+          + _varint_field(5, TILE_EXTENT))
+
+# -----------------------------------------------------------------------------
+
+class Tiler(object):
+    """
+    :param layers: A dictionary of tile layer names to lists of
+                   `(geometry, properties)` tuples, in diagram coordinates.
+    :param world_size: The size of the square that zoom level 0 covers.
+    :param simplify: Simplification tolerance, in display pixels.
+    """
+    def __init__(self, layers, world_size, simplify=1.0):
+        self._layers = layers
+        self._world_size = world_size
+        self._simplify = simplify
+        self._trees = {name: shapely.STRtree([geometry for geometry, _ in features])
+                          for name, features in layers.items()}
+        # Each layer's geometries simplified for a zoom level, by zoom
+        self._simplified = {}
+
+    def tile_bounds(self, z, x, y):
+        size = self._world_size/2**z
+        return (x*size, y*size, (x + 1)*size, (y + 1)*size)
+
+    def tiles(self, min_zoom, max_zoom):
+        """
+        Tiles that may contain features.
+        """
+        geometries = [geometry for features in self._layers.values() for geometry, _ in features]
+        if not geometries:
+            return
+        (min_x, min_y, max_x, max_y) = shapely.total_bounds(geometries)
+        for z in range(min_zoom, max_zoom + 1):
+            size = self._world_size/2**z
+            limit = 2**z - 1
+            for x in range(max(0, int(min_x//size)), min(limit, int(max_x//size)) + 1):
+                for y in range(max(0, int(min_y//size)), min(limit, int(max_y//size)) + 1):
+                    yield (z, x, y)
+
+    def simplified(self, z):
+        """
+        The geometries of each layer simplified for zoom level `z`, made
+        once for all the level's tiles.
+        """
+        if z not in self._simplified:
+            tolerance = self._simplify*self._world_size/2**z/TILE_PIXELS
+            layers = {}
+            for name, features in self._layers.items():
+                geometries = np.array([geometry for geometry, _ in features], dtype=object)
+                points = np.isin(shapely.get_type_id(geometries), [POINT_TYPE_ID, MULTIPOINT_TYPE_ID])
+                simplified = geometries.copy()
+                simplified[~points] = shapely.simplify(geometries[~points], tolerance, preserve_topology=True)
+                layers[name] = simplified
+            self._simplified[z] = layers
+        return self._simplified[z]
+
+    def tile(self, z, x, y):
+        """
+        :return: The encoded vector tile, or `None` if it is empty.
+        """
+        bounds = self.tile_bounds(z, x, y)
+        size = bounds[2] - bounds[0]
+        scale = TILE_EXTENT/size
+        margin = TILE_BUFFER/scale
+        clip = (bounds[0] - margin, bounds[1] - margin, bounds[2] + margin, bounds[3] + margin)
+        simplified = self.simplified(z)
+        data = []
+        for name, features in self._layers.items():
+            clipped = []
+            for index in sorted(self._trees[name].query(geo.box(*clip))):
+                properties = features[index][1]
+                geometry = shapely.clip_by_rect(simplified[name][index], *clip)
+                if not geometry.is_empty:
+                    clipped.append((int(index) + 1, geometry, properties))
+            layer = encode_layer(name, clipped, bounds[:2], scale)
+            if layer:
+                data.append(_bytes_field(3, layer))
+        return b''.join(data) if data else None
+
+# -----------------------------------------------------------------------------
+
+_tiler = None
+
+def _init_worker(tiler):
+    global _tiler
+    _tiler = tiler
+
+def _make_tile(tile):
+    return (tile, _tiler.tile(*tile))
+
+# -----------------------------------------------------------------------------
+
+# Tile writers have `open(metadata)`, `write(z, x, y, data)` and `close()`
+
+class DirectoryWriter(object):
+    def __init__(self, path):
+        self._path = path
+
+    def open(self, metadata):
+        os.makedirs(self._path, exist_ok=True)
+        with open(os.path.join(self._path, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f, indent=2)
+
+    def write(self, z, x, y, data):
+        directory = os.path.join(self._path, str(z), str(x))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, '{}.mvt'.format(y)), 'wb') as f:
+            f.write(data)
+
+    def close(self):
+        pass
+
+class MBTilesWriter(object):
+    def __init__(self, path):
+        self._path = path
+
+    def open(self, metadata):
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        self._db = sqlite3.connect(self._path)
+        self._db.executescript("""
+            CREATE TABLE metadata (name TEXT, value TEXT);
+            CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER,
+                                tile_row INTEGER, tile_data BLOB);
+            CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);""")
+        self._db.executemany('INSERT INTO metadata VALUES (?, ?)',
+                             [(name, value if isinstance(value, str) else json.dumps(value))
+                                for name, value in metadata.items()])
+
+    def write(self, z, x, y, data):
+        # MBTiles rows are numbered from the bottom and tiles are compressed
+        self._db.execute('INSERT INTO tiles VALUES (?, ?, ?, ?)',
+                         (z, x, 2**z - 1 - y, gzip.compress(data)))
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+# -----------------------------------------------------------------------------
+
+def tile_features(features):
+    """
+    Tiler input from GeoJSON features, in diagram coordinates.
+    """
+    return [(feature.diagram_geometry, feature.properties) for feature in features]
+
+def write_tiles(layers, path, world_size, min_zoom=0, max_zoom=None, simplify=1.0,
+                jobs=None, name='diagram'):
+    """
+    Build a tile pyramid on a pool of processes and write it to a directory
+    or, if `path` ends with `.mbtiles`, an MBTiles file.
+
+    :param layers: A dictionary of tile layer names to lists of
+                   `(geometry, properties)` tuples, in diagram coordinates.
+    :return: The number of tiles written.
+    """
+    if max_zoom is None:
+        max_zoom = max_zoom_for(world_size)
+    tiler = Tiler(layers, world_size, simplify)
+    writer = MBTilesWriter(path) if path.endswith('.mbtiles') else DirectoryWriter(path)
+    writer.open({
+        'name': name,
+        'format': 'pbf',
+        'minzoom': str(min_zoom),
+        'maxzoom': str(max_zoom),
+        'json': {'vector_layers': [{'id': layer, 'fields': {'id': 'String'},
+                                    'minzoom': min_zoom, 'maxzoom': max_zoom}
+                                        for layer in layers]},
+    })
+    count = 0
+    tiles = list(tiler.tiles(min_zoom, max_zoom))
+    # Simplify before any workers are started, so that they share the results
+    for z in range(min_zoom, max_zoom + 1):
+        tiler.simplified(z)
+    executor = None
+    try:
+        if jobs == 1:
+            results = ((tile, tiler.tile(*tile)) for tile in tiles)
+        else:
+            executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                           initargs=(tiler,))
+            results = executor.map(_make_tile, tiles, chunksize=16)
+        for (tile, data) in results:
+            if data is not None:
+                writer.write(*tile, data)
+                count += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        writer.close()
+    return count
+
+# -----------------------------------------------------------------------------
@@ -0,0 +1,231 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+Write features as TopoJSON (https://github.com/topojson/topojson-specification).
+
+Lines and rings are cut where they meet or part, so that vertices shared by
+several features, such as where flows run into the same transporter, are
+stored once as an arc. Arcs are quantised and delta-encoded.
+"""
+
+# -----------------------------------------------------------------------------
+
+import json
+import math
+
+import shapely
+
+# -----------------------------------------------------------------------------
+
+from . import geojson as GeoJSON
+
+# -----------------------------------------------------------------------------
+
+# Number of grid positions along each axis when no grid step is given
+DEFAULT_QUANTIZATION = 100000
+
+# -----------------------------------------------------------------------------
+
+class Quantizer(object):
+    def __init__(self, bounds, step=None):
+        (min_x, min_y, max_x, max_y) = bounds
+        if step is None:
+            step = max(max_x - min_x, max_y - min_y)/(DEFAULT_QUANTIZATION - 1) or 1
+        else:
+            # Align with the grid of quantised GeoJSON
+            (min_x, min_y) = (step*math.floor(min_x/step), step*math.floor(min_y/step))
+        self._origin = (min_x, min_y)
+        self._step = step
+
+    @property
+    def transform(self):
+        return {'scale': [self._step, self._step], 'translate': list(self._origin)}
+
+    def points(self, coords):
+        points = []
+        for (x, y) in coords:
+            point = (int(round((x - self._origin[0])/self._step)),
+                     int(round((y - self._origin[1])/self._step)))
+            if not points or point != points[-1]:
+                points.append(point)
+        return points
+
+# -----------------------------------------------------------------------------
+
+class Topology(object):
+    """
+    :param geometries: A list of shapely geometries, in map coordinates.
+    :param step: The quantisation grid step, in map units.
+    """
+    def __init__(self, geometries, step=None):
+        bounds = shapely.total_bounds(geometries) if len(geometries) else (0, 0, 1, 1)
+        self._quantizer = Quantizer(bounds, step)
+        self._geometries = [self._quantize(geometry) for geometry in geometries]
+        self._junctions = self._find_junctions()
+        self._arcs = []
+        self._arc_index = {}
+
+    def _quantize(self, geometry):
+        # Nested lists of integer point lists, as `(type, parts)`
+        if geometry is None or geometry.is_empty:
+            return (None, None)
+        kind = geometry.geom_type
+        if kind == 'Point':
+            return (kind, self._quantizer.points(geometry.coords)[0])
+        elif kind == 'MultiPoint':
+            return (kind, [self._quantizer.points(p.coords)[0] for p in geometry.geoms])
+        elif kind in ['LineString', 'LinearRing']:
+            return ('LineString', self._quantizer.points(geometry.coords))
+        elif kind == 'MultiLineString':
+            return (kind, [self._quantizer.points(g.coords) for g in geometry.geoms])
+        elif kind == 'Polygon':
+            return (kind, self._polygon(geometry))
+        elif kind == 'MultiPolygon':
+            return (kind, [self._polygon(g) for g in geometry.geoms])
+        raise TypeError('Cannot convert {} to TopoJSON'.format(kind))
+
+    def _polygon(self, polygon):
+        rings = [self._quantizer.points(polygon.exterior.coords)]
+        rings.extend(self._quantizer.points(ring.coords) for ring in polygon.interiors)
+        # Closing points are made implicit while finding junctions
+        return [ring[:-1] if len(ring) > 1 and ring[0] == ring[-1] else ring for ring in rings]
+
+    def _lines_and_rings(self):
+        for (kind, parts) in self._geometries:
+            if kind == 'LineString':
+                yield (parts, False)
+            elif kind == 'MultiLineString':
+                for line in parts:
+                    yield (line, False)
+            elif kind == 'Polygon':
+                for ring in parts:
+                    yield (ring, True)
+            elif kind == 'MultiPolygon':
+                for polygon in parts:
+                    for ring in polygon:
+                        yield (ring, True)
+
+    def _find_junctions(self):
+        # A point is a junction if it ends a line or if lines reach or
+        # leave it from different neighbours
+        neighbours = {}
+        junctions = set()
+        for (points, closed) in self._lines_and_rings():
+            count = len(points)
+            for n, point in enumerate(points):
+                if not closed and (n == 0 or n == count - 1):
+                    junctions.add(point)
+                    continue
+                pair = (points[n - 1], points[(n + 1) % count])
+                seen = neighbours.setdefault(point, pair)
+                if seen != pair and seen != pair[::-1]:
+                    junctions.add(point)
+        return junctions
+
+    def _arc(self, points):
+        key = tuple(points)
+        index = self._arc_index.get(key)
+        if index is None:
+            reverse = self._arc_index.get(key[::-1])
+            if reverse is not None:
+                return ~reverse
+            index = len(self._arcs)
+            self._arcs.append(points)
+            self._arc_index[key] = index
+        return index
+
+    def _cut(self, points, closed):
+        if closed:
+            starts = [n for n, point in enumerate(points) if point in self._junctions]
+            if not starts:
+                # Rings without junctions are matched whatever their start
+                # point and direction
+                start = points.index(min(points))
+                ring = points[start:] + points[:start + 1]
+                return [self._arc(ring)]
+            points = points[starts[0]:] + points[:starts[0] + 1]
+        arcs = []
+        start = 0
+        for n in range(1, len(points)):
+            if n == len(points) - 1 or points[n] in self._junctions:
+                arcs.append(self._arc(points[start:n + 1]))
+                start = n
+        return arcs
+
+    def _object(self, geometry, properties):
+        (kind, parts) = geometry
+        obj = {'type': kind}
+        if kind in ['Point', 'MultiPoint']:
+            obj['coordinates'] = parts
+        elif kind == 'LineString':
+            obj['arcs'] = self._cut(parts, False)
+        elif kind == 'MultiLineString':
+            obj['arcs'] = [self._cut(line, False) for line in parts]
+        elif kind == 'Polygon':
+            obj['arcs'] = [self._cut(ring, True) for ring in parts]
+        elif kind == 'MultiPolygon':
+            obj['arcs'] = [[self._cut(ring, True) for ring in polygon] for polygon in parts]
+        properties = dict(properties)
+        if 'id' in properties:
+            obj['id'] = properties.pop('id')
+        if properties:
+            obj['properties'] = properties
+        return obj
+
+    @staticmethod
+    def _delta_encode(points):
+        encoded = [list(points[0])]
+        for (p, q) in zip(points, points[1:]):
+            encoded.append([q[0] - p[0], q[1] - p[1]])
+        return encoded
+
+    def topology(self, properties, name='features'):
+        """
+        :param properties: A list of feature properties, in the same order
+                           as the geometries.
+        """
+        objects = [self._object(geometry, props)
+                    for geometry, props in zip(self._geometries, properties)]
+        return {
+            'type': 'Topology',
+            'transform': self._quantizer.transform,
+            'objects': {name: {'type': 'GeometryCollection', 'geometries': objects}},
+            'arcs': [self._delta_encode(arc) for arc in self._arcs],
+        }
+
+# -----------------------------------------------------------------------------
+
+def topology(features, transform=GeoJSON.DEFAULT_TRANSFORM, step=None, name='features'):
+    """
+    :param features: GeoJSON features, in diagram coordinates.
+    :param step: The quantisation grid step, in map units.
+    """
+    features = list(features)
+    GeoJSON.transform_features(features, transform)
+    geometries = [feature.geometry for feature in features]
+    properties = [feature.map_properties for feature in features]
+    return Topology(geometries, step).topology(properties, name)
+
+def write(features, fp, transform=GeoJSON.DEFAULT_TRANSFORM, step=None, name='features',
+          indent=None):
+    json.dump(topology(features, transform, step, name), fp, indent=indent)
+
+# -----------------------------------------------------------------------------
@@ -18,10 +18,38 @@
 #
 #------------------------------------------------------------------------------
 
+import contextlib
+import hashlib
+import importlib
+import io
 import os
 
 #------------------------------------------------------------------------------
 
+class LazyModule(object):
+    """
+    A stand-in for a module that is only imported when one of its attributes
+    is first used, so that heavy dependencies aren't loaded by code paths
+    that don't need them.
+    """
+    def __init__(self, name):
+        object.__setattr__(self, '_name', name)
+
+    @property
+    def module(self):
+        return importlib.import_module(self._name)
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.module, name, value)
+
+    def __repr__(self):
+        return '<lazy module {!r}>'.format(self._name)
+
+#------------------------------------------------------------------------------
+
 def layer_matches(layer, classes, excludes):
     return (not layer
          or layer in classes
@@ -29,6 +57,34 @@ def layer_matches(layer, classes, excludes):
 
 #------------------------------------------------------------------------------
 
+class LayerRouter(object):
+    """
+    Find the layers that an element belongs to: a background layer of
+    elements without any of the layer classes, and a layer for each class.
+
+    Routes are computed once for each distinct set of element classes.
+    """
+    def __init__(self, classes, background='background'):
+        self._classes = list(classes)
+        self._excludes = frozenset(classes)
+        self._background = background
+        self._routes = {}
+
+    @property
+    def layers(self):
+        return [self._background] + self._classes
+
+    def route(self, classes):
+        layers = self._routes.get(classes)
+        if layers is None:
+            layers = tuple(layer for layer in self.layers
+                            if layer_matches(layer, classes,
+                                             self._excludes if layer == self._background else None))
+            self._routes[classes] = layers
+        return layers
+
+#------------------------------------------------------------------------------
+
 def mkdir(path):
     try:
         os.mkdir(path, mode=0o755)
@@ -36,3 +92,57 @@ def mkdir(path):
         pass
 
 #------------------------------------------------------------------------------
+
+# Digests of the output files written so far, when tracking outputs
+_written = None
+
+def track_outputs():
+    """
+    From now on, only rewrite output files whose contents have changed since
+    they were last written by this process.
+    """
+    global _written
+    if _written is None:
+        _written = {}
+
+class ChangedOutput(io.StringIO):
+    """
+    A text file that is written to disk when closed, if its contents differ
+    from what was last written.
+    """
+    def __init__(self, path, written):
+        super().__init__()
+        self._path = path
+        self._written = written
+
+    def close(self):
+        if not self.closed:
+            text = self.getvalue()
+            digest = hashlib.sha1(text.encode('utf-8')).digest()
+            if self._written.get(self._path) != digest or not os.path.exists(self._path):
+                with open(self._path, 'w') as f:
+                    f.write(text)
+                self._written[self._path] = digest
+        super().close()
+
+# Lists of the output files opened, while recording
+_recorders = []
+
+@contextlib.contextmanager
+def recording_outputs():
+    """
+    Collect the paths of output files opened within the context.
+    """
+    paths = []
+    _recorders.append(paths)
+    try:
+        yield paths
+    finally:
+        _recorders.remove(paths)
+
+def open_output(path):
+    for paths in _recorders:
+        paths.append(path)
+    return open(path, 'w') if _written is None else ChangedOutput(path, _written)
+
+#------------------------------------------------------------------------------
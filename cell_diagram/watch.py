@@ -0,0 +1,125 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+Rebuild a diagram's outputs whenever its CellDL file changes.
+"""
+
+# -----------------------------------------------------------------------------
+
+import hashlib
+import logging
+import os
+import time
+import traceback
+
+# -----------------------------------------------------------------------------
+
+from .batch import stylesheet_files
+from .svg_elements import DefinesStore
+
+# -----------------------------------------------------------------------------
+
+# Seconds between checks for changes
+POLL_INTERVAL = 0.05
+
+# -----------------------------------------------------------------------------
+
+class Watcher(object):
+    """
+    Poll a CellDL file, and the stylesheets it references, calling
+    `rebuild(path)` after they change.
+
+    Files are only compared when their modification time or size changes,
+    and a rebuild is only made when their contents have changed, so saving
+    a file without editing it doesn't trigger one.
+    """
+    def __init__(self, path, rebuild, interval=POLL_INTERVAL):
+        self._path = path
+        self._rebuild = rebuild
+        self._interval = interval
+        self._files = [path]
+        self._stats = None
+        self._digest = None
+
+    def _stat(self):
+        stats = []
+        for file in self._files:
+            try:
+                s = os.stat(file)
+                stats.append((s.st_mtime_ns, s.st_size))
+            except OSError:
+                stats.append(None)
+        return stats
+
+    def _contents_digest(self):
+        digest = hashlib.sha1()
+        for file in self._files:
+            try:
+                with open(file, 'rb') as f:
+                    digest.update(f.read())
+            except OSError:
+                digest.update(b'\0missing')
+        return digest.digest()
+
+    def poll(self):
+        """
+        Rebuild if the files have changed since the last poll.
+
+        :return: True if a rebuild was made.
+        """
+        stats = self._stat()
+        if stats == self._stats:
+            return False
+        self._stats = stats
+        digest = self._contents_digest()
+        if digest == self._digest:
+            return False
+        self._digest = digest
+        # Definitions from the previous build are no longer wanted
+        DefinesStore.clear()
+        start = time.perf_counter()
+        try:
+            self._rebuild(self._path)
+            logging.info('Rebuilt %s in %.0f ms', self._path, 1000*(time.perf_counter() - start))
+        except Exception as err:
+            logging.debug(traceback.format_exc())
+            logging.error('%s: %s', self._path, err)
+        # The set of referenced stylesheets may have changed
+        files = [self._path] + stylesheet_files(self._path)
+        if files != self._files:
+            self._files = files
+            self._stats = self._stat()
+            self._digest = self._contents_digest()
+        return True
+
+    def run(self):
+        """
+        Poll until interrupted.
+        """
+        logging.info('Watching %s', self._path)
+        try:
+            while True:
+                self.poll()
+                time.sleep(self._interval)
+        except KeyboardInterrupt:
+            pass
+
+# -----------------------------------------------------------------------------
@@ -23,52 +23,107 @@ import os
 
 # -----------------------------------------------------------------------------
 
-import cell_diagram.geojson as GeoJSON
 import cell_diagram.utils as utils
 
-from cell_diagram.parser import Parser
-from cell_diagram.svg_elements import DefinesStore
+# Imported when first used, so that `--help` and simple conversions don't
+# pay for modules they don't need
+batch = utils.LazyModule('cell_diagram.batch')
+celldl = utils.LazyModule('cell_diagram.parser')
+GeoJSON = utils.LazyModule('cell_diagram.geojson')
+mathjax = utils.LazyModule('cell_diagram.mathjax')
+search = utils.LazyModule('cell_diagram.search')
+tiles = utils.LazyModule('cell_diagram.tiles')
+watcher = utils.LazyModule('cell_diagram.watch')
 
 # -----------------------------------------------------------------------------
 
 def parse(file, stylesheet=None):
-    parser = Parser()
+    parser = celldl.Parser()
     return parser.parse(file, stylesheet)
 
 # -----------------------------------------------------------------------------
 
-def export_diagram_layer(diagram, layer, file_path, geojson=False, excludes=None):
+def export_diagram_layer(diagram, layer, file_path, geojson=False, excludes=None, transform=None,
+                         sequence=False, indent=2, compact=False, topojson=False, step=None,
+                         index=None, svg=None, features=None):
     image_path = '{}/images/{}'.format(file_path, layer) if layer else file_path
     json_path = '{}/features/{}'.format(file_path, layer) if layer else file_path
 
-    svg = diagram.svg(layer=layer, excludes=excludes)
-    f = open('{}.svg'.format(image_path), 'w')
+    if svg is None:
+        svg = diagram.svg(layer=layer, excludes=excludes)
+    f = utils.open_output('{}.svg'.format(image_path))
     f.write(svg)
     f.close()
 
     if geojson:
-        json = diagram.geojson(layer=layer, excludes=excludes)
-        f = open('{}.json'.format(json_path), 'w')
-        f.write(GeoJSON.dumps(json, indent=2))
+        json_file = '{}.{}'.format(json_path, 'geojsons' if sequence else 'json')
+        f = utils.open_output(json_file)
+        diagram.write_geojson(f, layer=layer, excludes=excludes, transform=transform,
+                              sequence=sequence, indent=indent, compact=compact, step=step,
+                              index=index, index_layer=os.path.basename(json_file),
+                              features=features)
         f.close()
 
+    if topojson:
+        f = utils.open_output('{}.topojson'.format(json_path))
+        diagram.write_topojson(f, layer=layer, excludes=excludes, transform=transform,
+                               indent=indent, compact=compact, step=step, features=features)
+        f.close()
+
+
+def export_diagram_layers(diagram, classes, file_path, geojson=False, **options):
+    """
+    Export the background and each class as separate layers, rendering
+    them all in a single pass over the diagram.
+    """
+    layers = diagram.render_layers(classes, geojson=geojson or options.get('topojson'),
+                                   compact=options.get('compact', False))
+    for layer, (svg, features) in layers.items():
+        export_diagram_layer(diagram, layer, file_path, geojson, svg=svg, features=features,
+                             **options)
 
-def main(file, geojson=False, classes=None):
+
+def export_diagram_tiles(diagram, tile_path, classes=None, max_zoom=None, jobs=None, compact=False):
+    if classes:
+        layers = {'background': tiles.tile_features(
+                                    diagram.geojson_features(excludes=frozenset(classes),
+                                                             compact=compact))}
+        for cls in classes:
+            layers[cls] = tiles.tile_features(diagram.geojson_features(layer=cls, compact=compact))
+    else:
+        layers = {'diagram': tiles.tile_features(diagram.geojson_features(compact=compact))}
+    count = tiles.write_tiles(layers, tile_path, max(diagram.width, diagram.height),
+                              max_zoom=max_zoom, jobs=jobs)
+    logging.debug('Wrote %d vector tiles to %s', count, tile_path)
+
+
+def celldl_path(file):
     (root, extension) = os.path.splitext(file)
-    if not extension:
-        extension = '.xml'
+    return (root, extension if extension else '.xml')
+
+
+def main(file, **options):
+    (root, extension) = celldl_path(file)
+    # Parsing and export share one typesetting deadline
+    with mathjax.deadline():
+        export(parse(root + extension), root, **options)
 
-    diagram = parse(root + extension)
+
+def export(diagram, root, geojson=False, classes=None, map_extent=None, sequence=False, indent=2,
+           tile_path=None, max_zoom=None, jobs=None, compact=False, topojson=False, step=None,
+           search_index=False):
+    transform = (GeoJSON.extent_transform(diagram.width, diagram.height, map_extent)
+                 if map_extent else None)
+    index = search.SearchIndex(diagram, transform) if search_index and geojson else None
+    options = dict(transform=transform, sequence=sequence, indent=indent,
+                   compact=compact, topojson=topojson, step=step, index=index)
 
     if classes:
         utils.mkdir(root)
         utils.mkdir('{}/images'.format(root))
         utils.mkdir('{}/features'.format(root))
-        defines_top = DefinesStore.top()
-        export_diagram_layer(diagram, 'background', root, geojson, excludes=frozenset(classes))
-        for cls in classes:
-            DefinesStore.reset(defines_top)
-            export_diagram_layer(diagram, cls, root, geojson)
+        export_diagram_layers(diagram, classes, root, geojson, **options)
+        index_file = '{}/features/index.json'.format(root)
     else:
         try:
             import OpenCOR as oc
@@ -76,7 +131,31 @@ def main(file, geojson=False, classes=None):
             browser = oc.browserWebView()
             browser.setContent(svg, "image/svg+xml")
         except ModuleNotFoundError:
-            export_diagram_layer(diagram, None, root, geojson)
+            export_diagram_layer(diagram, None, root, geojson, **options)
+        index_file = '{}.index.json'.format(root)
+
+    if index is not None:
+        f = utils.open_output(index_file)
+        index.write(f)
+        f.close()
+
+    if tile_path:
+        export_diagram_tiles(diagram, tile_path, classes, max_zoom, jobs, compact)
+
+
+def watch(file, interval=None, **options):
+    """
+    Export a diagram and then export it again whenever it changes, keeping
+    compiled stylesheets and typeset labels in memory between rebuilds and
+    only rewriting outputs whose contents have changed.
+    """
+    (root, extension) = celldl_path(file)
+    utils.track_outputs()
+    def rebuild(path):
+        with mathjax.deadline():
+            export(parse(path), root, **options)
+    watcher.Watcher(root + extension, rebuild,
+                    interval if interval is not None else watcher.POLL_INTERVAL).run()
 
 
 if __name__ == '__main__':
@@ -87,15 +166,100 @@ if __name__ == '__main__':
                         help='show debugging')
     parser.add_argument('--geojson', action='store_true',
                         help='output features as GeoJSON')
+    parser.add_argument('--geojson-sequence', action='store_true',
+                        help='write features as a GeoJSON text sequence (RFC 8142)')
+    parser.add_argument('--compact', action='store_true',
+                        help="don't indent GeoJSON output")
+    parser.add_argument('--search-index', action='store_true',
+                        help='with --geojson, also write an index of features by id, label and class')
+    parser.add_argument('--topojson', action='store_true',
+                        help='output features as TopoJSON')
+    parser.add_argument('--quantize', metavar='STEP', type=float,
+                        help='snap GeoJSON and TopoJSON coordinates to a grid of this size in map units')
+    parser.add_argument('--compact-geometry', action='store_true',
+                        help='export circles as points with a radius and quantities as boxes with corner radii')
+    parser.add_argument('--circle-resolution', metavar='N', type=int,
+                        help='segments per quarter circle when circles are exported as polygons (default 16)')
+    parser.add_argument('--map-extent', metavar=('MIN_X', 'MIN_Y', 'MAX_X', 'MAX_Y'),
+                        type=float, nargs=4,
+                        help='map the diagram onto this extent in GeoJSON coordinates')
+    parser.add_argument('--tiles', metavar='TILE_PATH',
+                        help='write a vector tile pyramid to this directory or `.mbtiles` file')
+    parser.add_argument('--max-zoom', metavar='ZOOM', type=int,
+                        help='deepest zoom level of the tile pyramid')
+    parser.add_argument('--jobs', metavar='N', type=int,
+                        help='number of worker processes for tiles and --batch (default one per CPU)')
     parser.add_argument('--layer-classes', dest='classes', metavar='CLASS', nargs='+',
                         help='break SVG into separate files by classes')
     parser.add_argument('--celldl', metavar='CELLDL_FILE',
                         help='the CellDl file')
+    parser.add_argument('--batch', metavar='PATH', nargs='+',
+                        help='convert CellDL files in these directories or matching these globs')
+    parser.add_argument('--manifest', metavar='MANIFEST_FILE', default='.celldl2svg-manifest.json',
+                        help='with --batch, skip files unchanged since recorded here'
+                             ' (default `.celldl2svg-manifest.json`)')
+    parser.add_argument('--force', action='store_true',
+                        help='with --batch, convert files even if they are unchanged')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and convert the CellDL file again whenever it changes')
+    parser.add_argument('--typeset-cache', metavar='CACHE_FILE',
+                        help='keep typeset labels in this SQLite database')
+    parser.add_argument('--typeset-concurrency', metavar='N', type=int,
+                        help='maximum number of labels to typeset concurrently')
+    parser.add_argument('--typeset-deadline', metavar='SECONDS', type=float,
+                        help='time allowed for typesetting before using plain text labels')
+    parser.add_argument('--typeset-workers', metavar='N', type=int,
+                        help='typeset with a pool of N MathJax processes instead of `mj_server.js`')
     args = parser.parse_args()
+    if args.batch and args.tiles:
+        parser.error('--tiles cannot be used with --batch')
+    if not args.batch and not args.celldl:
+        parser.error('one of --celldl or --batch is required')
+    if args.watch and args.batch:
+        parser.error('--watch cannot be used with --batch')
+    if args.classes and args.jobs and args.jobs > 1 and not (args.tiles or args.batch):
+        # Layers are rendered in a single pass, not exported in parallel
+        parser.error('--jobs only applies to --tiles and --batch, not to --layer-classes')
 
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
+    elif args.watch:
+        logging.getLogger().setLevel(logging.INFO)
+
+    if args.circle_resolution:
+        GeoJSON.CIRCLE_RESOLUTION = args.circle_resolution
+
+    if args.typeset_cache:
+        mathjax.configure_cache(args.typeset_cache)
+    if args.typeset_concurrency:
+        mathjax.TYPESET_CONCURRENCY = args.typeset_concurrency
+    if args.typeset_deadline is not None:
+        mathjax.TYPESET_DEADLINE = args.typeset_deadline
+    if args.typeset_workers:
+        mathjax.use_worker_pool(args.typeset_workers)
+
+    options = dict(geojson=args.geojson, classes=args.classes, map_extent=args.map_extent,
+                   sequence=args.geojson_sequence, indent=None if args.compact else 2,
+                   tile_path=args.tiles, max_zoom=args.max_zoom, jobs=args.jobs,
+                   compact=args.compact_geometry, topojson=args.topojson, step=args.quantize,
+                   search_index=args.search_index)
+    try:
+        if args.batch:
+            files = batch.find_inputs(args.batch)
+            # Circle resolution only affects exported features
+            settings = (dict(circle_resolution=GeoJSON.CIRCLE_RESOLUTION)
+                        if args.geojson or args.topojson else None)
+            results = batch.convert_files(main, files, options,
+                                          manifest=batch.Manifest(args.manifest),
+                                          jobs=args.jobs, force=args.force, settings=settings)
+            print(batch.summary(results))
+        elif args.watch:
+            watch(args.celldl, **options)
+        else:
+            main(args.celldl, **options)
+    finally:
+        mathjax.close_worker_pool()
 
-    main(args.celldl, args.geojson, args.classes)
+    logging.debug('Typeset cache: %s', mathjax.cache_stats())
 
 # -----------------------------------------------------------------------------
@@ -0,0 +1,91 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+Serve CellDL rendering over HTTP; see `cell_diagram.service`.
+"""
+
+import logging
+import signal
+
+import tornado.ioloop
+
+# -----------------------------------------------------------------------------
+
+import cell_diagram.mathjax as mathjax
+import cell_diagram.service as service
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Render CellDL to SVG and GeoJSON over HTTP.')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='show debugging')
+    parser.add_argument('--port', type=int, default=8004,
+                        help='port to listen on (default 8004)')
+    parser.add_argument('--address', default='127.0.0.1',
+                        help='address to listen on (default 127.0.0.1)')
+    parser.add_argument('--max-diagrams', metavar='N', type=int, default=service.MAX_DIAGRAMS,
+                        help='number of parsed diagrams to keep (default {})'.format(service.MAX_DIAGRAMS))
+    parser.add_argument('--workers', metavar='N', type=int,
+                        help='render on a pool of N worker processes (0 for one per CPU)'
+                             ' instead of a thread in the server')
+    parser.add_argument('--max-requests', metavar='N', type=int, default=service.MAX_REQUESTS,
+                        help='replace a worker after it has made N renders'
+                             ' (default {})'.format(service.MAX_REQUESTS))
+    parser.add_argument('--queue-depth', metavar='N', type=int, default=service.QUEUE_DEPTH,
+                        help='requests queued per worker before refusing more'
+                             ' (default {})'.format(service.QUEUE_DEPTH))
+    parser.add_argument('--typeset-cache', metavar='CACHE_FILE',
+                        help='keep typeset labels in this SQLite database')
+    parser.add_argument('--typeset-workers', metavar='N', type=int,
+                        help='typeset with a pool of N MathJax processes instead of `mj_server.js`')
+    args = parser.parse_args()
+    if args.workers is not None and args.typeset_workers:
+        parser.error('--typeset-workers cannot be used with --workers')
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    if args.typeset_cache:
+        mathjax.configure_cache(args.typeset_cache)
+    if args.typeset_workers:
+        mathjax.use_worker_pool(args.typeset_workers)
+
+    if args.workers is not None:
+        renderer = service.PoolRenderer(args.workers, args.max_diagrams, args.max_requests,
+                                        args.queue_depth, args.typeset_cache)
+    else:
+        renderer = service.Renderer(args.max_diagrams)
+    service.make_app(renderer).listen(args.port, address=args.address)
+    print('Server listening on {}:{}'.format(args.address, args.port))
+    loop = tornado.ioloop.IOLoop.current()
+    # Shut down workers when terminated, as well as when interrupted
+    loop.asyncio_loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        renderer.close()
+        mathjax.close_worker_pool()
+
+# -----------------------------------------------------------------------------
@@ -1,24 +1,27 @@
-// a simple TeX-input example
+// A persistent typesetter for the worker pool in `cell_diagram/mathjax_pool.py`.
+//
+// Each line read from stdin is a JSON request, `{"id": ..., "params": {...}}`,
+// with `params` as for the HTTP server in `mj_index.js`. A JSON result line,
+// `{"id": ..., "svg": "..."}` or `{"id": ..., "errors": [...]}`, is written to
+// stdout for each request.
 
-var mathjax = require("mathjax-node");
+var readline = require('readline');
 
-mathjax.config({
-  MathJax: {
-    // traditional MathJax configuration
-  }
-});
-
-mathjax.start();
-
-process.stdin.pipe(require('split')()).on('data', function processLine(line) {
-  mathjax.typeset({
-    math: line,
-    format: "inline-TeX",
-    svg: true
-  }, function (data) {
-    if (!data.errors)
-      console.log(data.svg);
-    process.exit()
-  });
-});
+var mjAPI = require('./mj_index').startMathJax();
 
+readline.createInterface({input: process.stdin, terminal: false})
+    .on('line', function(line){
+        var request;
+        try {
+            request = JSON.parse(line);
+        } catch (error) {
+            process.stdout.write(JSON.stringify({id: null, errors: [String(error)]}) + '\n');
+            return;
+        }
+        mjAPI.typeset(request.params, function(result){
+            var reply = {id: request.id};
+            if (result.errors) reply.errors = result.errors.map(String);
+            else reply.svg = result.svg;
+            process.stdout.write(JSON.stringify(reply) + '\n');
+        });
+    });
@@ -35,11 +35,39 @@ function startMathJax(){
     return mjAPI;
 }
 
+// A batch request is a JSON array of typesetting parameters. Results are
+// streamed back as newline delimited JSON, one object per formula, in
+// the order they complete and identified by their index in the request.
+function handleBatchRequest(mjAPI, batch, response){
+    response.writeHead(200, {'Content-Type': 'application/x-ndjson'});
+    var remaining = batch.length;
+    if (remaining == 0) {
+        response.end();
+        return;
+    }
+    batch.forEach(function(params, index){
+        mjAPI.typeset(params, function(result){
+            var line = {index: index};
+            if (result.errors) line.errors = result.errors.map(String);
+            else if (params.svg) line.svg = result.svg;
+            else if (params.mml) line.mml = result.mml;
+            else if (params.png) line.png = result.png;
+            response.write(JSON.stringify(line) + '\n');
+            remaining -= 1;
+            if (remaining == 0) response.end();
+        });
+    });
+}
+
 function handleRequest(mjAPI, request, response){
     var str_params = '';
     request.on('data', function(chunk){str_params += chunk;});
     request.on('end', function(){
         var params = JSON.parse(str_params);
+        if (Array.isArray(params)) {
+            handleBatchRequest(mjAPI, params, response);
+            return;
+        }
         mjAPI.typeset(params, function(result){
             if (!result.errors) {
                 if (params.svg) {
@@ -100,6 +128,8 @@ var createServer = function(port) {
     return server;
 };
 
+exports.startMathJax = startMathJax;
+
 exports.start = function(port){
     if (cluster.isMaster) {
       // Fork workers.
@@ -0,0 +1,244 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+A stand-in for the MathJax server in `mj_server.js`, for benchmarks and
+testing on machines without node.
+
+It speaks the same protocol as `mj_index.js`, both single requests and
+batches, and returns deterministic canned SVG. With `--stdio` it instead
+behaves as a `mathjax.js` worker for `cell_diagram.mathjax_pool`.
+"""
+
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# -----------------------------------------------------------------------------
+
+# Formulae containing this are rejected, as MathJax rejects invalid TeX
+ERROR_MARKER = '\\error'
+
+# -----------------------------------------------------------------------------
+
+def glyph_path(c):
+    # A made up but deterministic outline for a character
+    h = hashlib.sha1(c.encode('utf-8')).digest()
+    return 'M{} 0L{} {}L{} {}Z'.format(h[0], h[1] + 100, h[2] + 400, h[3], h[4] + 300)
+
+def canned_svg(math):
+    """
+    SVG with the same structure as that from mathjax-node.
+    """
+    chars = [c for c in math if not c.isspace()]
+    glyphs = []
+    defined = set()
+    uses = []
+    for n, c in enumerate(chars):
+        id = 'E1-STUB-{:X}'.format(ord(c))
+        if id not in defined:
+            defined.add(id)
+            glyphs.append('<path stroke-width="1" id="{}" d="{}"></path>'.format(id, glyph_path(c)))
+        uses.append('<use xlink:href="#{}" x="{}" y="0"></use>'.format(id, 500*n))
+    width = 0.5 + 1.2*len(chars)
+    return ('<svg xmlns:xlink="http://www.w3.org/1999/xlink" width="{w:.3f}ex" height="2.343ex"'
+            ' style="vertical-align: -0.505ex;" viewBox="0 -791.3 {vw:.0f} 1008.6" role="img"'
+            ' focusable="false" xmlns="http://www.w3.org/2000/svg">'
+            '<title id="MathJax-SVG-1-Title">{title}</title>'
+            '<defs aria-hidden="true">{glyphs}</defs>'
+            '<g stroke="currentColor" fill="currentColor" stroke-width="0"'
+            ' transform="matrix(1 0 0 -1 0 0)" aria-hidden="true">{uses}</g></svg>'
+            ).format(w=width, vw=width*430.5,
+                     title=math.replace('&', '&amp;').replace('<', '&lt;'),
+                     glyphs=''.join(glyphs), uses=''.join(uses))
+
+# -----------------------------------------------------------------------------
+
+class Typesetter(object):
+    """
+    :param latency: Seconds to take for each formula.
+    :param jitter: Random variation, in seconds, added to the latency.
+    :param failure_rate: Probability that a request fails with a server error.
+    :param seed: Seeds the random failures and jitter.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, seed=0):
+        self._latency = latency
+        self._jitter = jitter
+        self._failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.formulae = 0
+
+    def _random_value(self):
+        with self._lock:
+            return self._random.random()
+
+    def delay(self):
+        if self._latency or self._jitter:
+            time.sleep(self._latency + self._jitter*self._random_value())
+
+    def should_fail(self):
+        return self._failure_rate > 0 and self._random_value() < self._failure_rate
+
+    def typeset(self, params):
+        """
+        :return: A tuple of SVG and a list of errors.
+        """
+        with self._lock:
+            self.formulae += 1
+        self.delay()
+        math = params.get('math', '')
+        if ERROR_MARKER in math:
+            return (None, ['TeX parse error: {}'.format(math)])
+        return (canned_svg(math), [])
+
+# -----------------------------------------------------------------------------
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, content_type, body):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, data):
+        data = data.encode('utf-8')
+        self.wfile.write('{:X}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def do_POST(self):
+        typesetter = self.server.typesetter
+        with typesetter._lock:
+            typesetter.requests += 1
+        length = int(self.headers.get('Content-Length', 0))
+        str_params = self.rfile.read(length).decode('utf-8')
+        params = json.loads(str_params)
+        if typesetter.should_fail():
+            self.send(500, 'text/plain', 'problem!\n')
+        elif isinstance(params, list):
+            # Stream results as newline delimited JSON
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for index, p in enumerate(params):
+                svg, errors = typesetter.typeset(p)
+                line = dict(index=index, errors=errors) if errors else dict(index=index, svg=svg)
+                self.send_chunk(json.dumps(line) + '\n')
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            svg, errors = typesetter.typeset(params)
+            if errors:
+                self.send(400, 'text/plain', 'Error 400: Request Failed. \n{}\n{}\n'
+                                             .format('\n'.join(errors), str_params))
+            else:
+                self.send(200, 'image/svg+xml', svg)
+
+# -----------------------------------------------------------------------------
+
+class StubMathJaxServer(ThreadingHTTPServer):
+    """
+    Serve in a background thread with `start()` and `stop()`, or
+    use `serve_forever()`.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=8003, host='localhost', **kwds):
+        super().__init__((host, port), RequestHandler)
+        self.typesetter = Typesetter(**kwds)
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address[:2])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+# -----------------------------------------------------------------------------
+
+def serve_stdio(typesetter):
+    # The line protocol of `mathjax.js`
+    for line in sys.stdin:
+        request = json.loads(line)
+        if typesetter.should_fail():
+            sys.exit(1)     # Simulate a crashed worker
+        svg, errors = typesetter.typeset(request['params'])
+        reply = dict(id=request['id'], errors=errors) if errors else dict(id=request['id'], svg=svg)
+        sys.stdout.write(json.dumps(reply) + '\n')
+        sys.stdout.flush()
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='A stand-in MathJax server.')
+    parser.add_argument('--port', type=int, default=8003,
+                        help='port to listen on (default 8003)')
+    parser.add_argument('--latency', type=float, default=0.0, metavar='SECONDS',
+                        help='time to take for each formula')
+    parser.add_argument('--jitter', type=float, default=0.0, metavar='SECONDS',
+                        help='random variation added to the latency')
+    parser.add_argument('--failure-rate', type=float, default=0.0, metavar='P',
+                        help='probability that a request fails')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for random failures and jitter')
+    parser.add_argument('--stdio', action='store_true',
+                        help='act as a `mathjax.js` worker on stdin and stdout')
+    args = parser.parse_args()
+
+    options = dict(latency=args.latency, jitter=args.jitter,
+                   failure_rate=args.failure_rate, seed=args.seed)
+    if args.stdio:
+        # Otherwise a restarted worker would fail in exactly the same way
+        options['seed'] += os.getpid()
+        serve_stdio(Typesetter(**options))
+    else:
+        server = StubMathJaxServer(args.port, **options)
+        print('Server listening on port {}'.format(args.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+# -----------------------------------------------------------------------------
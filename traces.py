@@ -0,0 +1,90 @@
+# -----------------------------------------------------------------------------
+#
+#  Cell Diagramming Language
+#
+#  Copyright (c) 2018  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# -----------------------------------------------------------------------------
+
+"""
+Simplification of traces for `animation.py`, which only needs NumPy and so
+can be imported without matplotlib or OpenCOR.
+"""
+
+# -----------------------------------------------------------------------------
+
+import numpy as np
+
+# -----------------------------------------------------------------------------
+
+# Default tolerance when simplifying a trace, as a fraction of its range
+SIMPLIFY_TOLERANCE = 0.001
+
+def simplify(t, y, tolerance=None):
+    """
+    The points of a trace to keep so that straight lines between them are
+    within `tolerance` of every value, by Ramer-Douglas-Peucker with errors
+    measured in the direction of `y`.
+
+    All segments still to be checked are checked at once, splitting those
+    with an error greater than `tolerance` at their worst point. A narrow
+    spike is kept, however few samples it has, as long as its peak is more
+    than `tolerance` from the line that would replace it.
+
+    :param t: Increasing sample times.
+    :param y: Values at the sample times.
+    :param tolerance: Largest allowed error, in the units of `y`. The default
+                      is `SIMPLIFY_TOLERANCE` of the range of `y`.
+    :return: An array of indices into `t` and `y`.
+    """
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(t) <= 2:
+        return np.arange(len(t))
+    if tolerance is None:
+        tolerance = SIMPLIFY_TOLERANCE*(np.max(y) - np.min(y))
+    keep = np.zeros(len(t), dtype=bool)
+    keep[[0, -1]] = True
+    starts = np.array([0])
+    ends = np.array([len(t) - 1])
+    while len(starts):
+        lengths = ends - starts - 1
+        interior = lengths > 0
+        starts, ends, lengths = starts[interior], ends[interior], lengths[interior]
+        if len(starts) == 0:
+            break
+        # The line across each segment, as `y = a + b*t`
+        dt = t[ends] - t[starts]
+        b = np.divide(y[ends] - y[starts], dt, out=np.zeros(len(dt)), where=(dt != 0))
+        a = y[starts] - b*t[starts]
+
+        # Errors at the interior points of all segments, `offsets` into them
+        offsets = np.cumsum(lengths) - lengths
+        index = np.repeat(starts + 1 - offsets, lengths) + np.arange(lengths.sum())
+        error = np.abs(y[index] - np.repeat(a, lengths) - np.repeat(b, lengths)*t[index])
+
+        # Split segments at their (first) worst point, when it's out of tolerance
+        worst = np.maximum.reduceat(error, offsets)
+        at_worst = np.flatnonzero(error == np.repeat(worst, lengths))
+        segment = np.searchsorted(offsets, at_worst, side='right') - 1
+        first = np.concatenate(([True], segment[1:] != segment[:-1]))
+        split = worst > tolerance
+        points = index[at_worst[first]][split]
+        keep[points] = True
+        starts = np.concatenate((starts[split], points))
+        ends = np.concatenate((points, ends[split]))
+    return np.flatnonzero(keep)
+
+# -----------------------------------------------------------------------------